@@ -0,0 +1,230 @@
+# benchmarks/bench_agents.py
+"""
+端到端基准：在本地假 OpenAI 服务器上驱动各个代理，无需真实模型。
+
+用法：
+    python benchmarks/bench_agents.py --sizes 1000 10000 100000 --latency 0.02
+    python benchmarks/bench_agents.py --sizes 1000000 --storage sqlite --output results.jsonl
+
+对每个规模（合成记忆条数）在独立子进程中：
+- 加载/保存记忆树（load_s / save_s）
+- MemoryAgent.search_memory、MemoryAgent.classify_and_store
+- ChatAgent.chat（含“是否记忆”判断、检索与最终回复）
+- MemoryTreeAgent.store / recall / recall_many（同样规模的键值记忆）
+每个阶段输出延迟分位数（毫秒）与 LLM 调用数、提示 token 数，
+以及与同类上一次调用相同前缀的 token 数（prefix_tokens_total / prefix_ratio，
+即前缀缓存可复用的部分；--prompt-layout prefix 对比提示布局的影响）；
+另报告峰值内存。结果按行输出 JSON，附带 git 版本，便于跨版本比较。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_openai  # noqa: E402
+from bench_nodes import build_tree_file  # noqa: E402
+
+SCHEMA_PATH = os.path.join(ROOT_DIR, "schema.json")
+
+SUBJECTS = ["我", "我妈妈", "我同事", "我女儿", "我朋友"]
+VERBS = ["喜欢", "去过", "在读", "买了", "讨厌", "正在学"]
+OBJECTS = ["篮球", "上海", "三体", "咖啡", "Python", "北京", "花生", "跑步", "猫", "钢琴",
+           "MacBook", "东京", "火锅", "围棋", "摄影", "Rust", "滑雪", "红楼梦", "绿茶", "杭州"]
+
+
+def synthetic_memory(i: int) -> str:
+    return f"{SUBJECTS[i % 5]}{VERBS[i // 5 % 6]}{OBJECTS[i // 30 % 20]}（第{i}条）"
+
+
+def synthetic_queries(n: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    templates = ["{s}{v}什么？", "关于{o}的事", "{s}和{o}有什么关系", "我{v}{o}吗"]
+    return [rng.choice(templates).format(s=rng.choice(SUBJECTS), v=rng.choice(VERBS),
+                                         o=rng.choice(OBJECTS)) for _ in range(n)]
+
+
+def synthetic_statements(n: int, seed: int) -> List[str]:
+    rng = random.Random(seed + 1)
+    return [f"{rng.choice(SUBJECTS)}{rng.choice(VERBS)}{rng.choice(OBJECTS)}" for _ in range(n)]
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "n": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p90_ms": round(pick(0.90) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def peak_rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_stage(server, inputs: List, fn: Callable) -> Dict:
+    """逐条执行 fn，统计延迟分位数与期间的 LLM 调用、提示 token"""
+    first_call = len(server.calls)
+    samples = []
+    for item in inputs:
+        start = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - start)
+    calls = server.calls[first_call:]
+    result = percentiles(samples)
+    prompt_tokens = [c["prompt_tokens"] for c in calls]
+    result.update({
+        "llm_calls": len(calls),
+        "prompt_tokens_total": sum(prompt_tokens),
+        "prompt_tokens_mean": round(sum(prompt_tokens) / len(prompt_tokens), 1) if calls else 0,
+        "prompt_tokens_max": max(prompt_tokens, default=0),
+        "completion_tokens_total": sum(c["completion_tokens"] for c in calls),
+        "prefix_tokens_total": sum(c["prefix_tokens"] for c in calls),
+        "prefix_ratio": (round(sum(c["prefix_tokens"] for c in calls) / sum(prompt_tokens), 3)
+                         if sum(prompt_tokens) else 0.0),
+    })
+    return result
+
+
+def run_size(size: int, args) -> Dict:
+    from chat_agent import ChatAgent
+    from memory_agent import MemoryAgent
+    from memory_tree import MemoryTree
+    from memory_tree_agent import MemoryTreeAgent
+
+    server, base_url = fake_openai.start(latency=args.latency)
+    llm = dict(model="fake", base_url=base_url, api_key="fake")
+    queries = synthetic_queries(args.queries, args.seed)
+    statements = synthetic_statements(args.queries, args.seed)
+    result: Dict = {"memories": size, "storage": args.storage, "latency_s": args.latency,
+                    "compact_nodes": args.compact_nodes, "prompt_layout": args.prompt_layout,
+                    "catalog": args.catalog, "catalog_top_n": args.catalog_top_n,
+                    "stages": {}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "memory_tree.json")
+        build_tree_file(path, size, synthetic_memory)
+        if args.storage in ("sqlite", "sharded"):
+            from migrate_to_sqlite import migrate_tree
+            suffix = ".db" if args.storage == "sqlite" else ".shards"
+            migrate_tree(path, os.path.splitext(path)[0] + suffix, SCHEMA_PATH, journal=False,
+                         sharded=args.storage == "sharded")
+
+        start = time.perf_counter()
+        tree = MemoryTree(SCHEMA_PATH, path, storage=args.storage, compact_nodes=args.compact_nodes)
+        result["load_s"] = round(time.perf_counter() - start, 3)
+        result["nodes"] = len(tree.nodes)
+
+        start = time.perf_counter()
+        agent = MemoryAgent(tree, prompt_layout=args.prompt_layout, catalog=args.catalog,
+                            catalog_top_n=args.catalog_top_n, **llm)
+        result["index_build_s"] = round(time.perf_counter() - start, 3)
+
+        result["stages"]["memory.search_memory"] = run_stage(server, queries, agent.search_memory)
+        result["stages"]["memory.classify_and_store"] = run_stage(
+            server, statements, agent.classify_and_store)
+
+        chat = ChatAgent(tree, prompt_layout=args.prompt_layout, catalog=args.catalog,
+                         catalog_top_n=args.catalog_top_n, **llm)
+        turns = [x for pair in zip(statements, queries) for x in pair]
+        result["stages"]["chat.chat"] = run_stage(server, turns, chat.chat)
+        chat.flush()
+        chat.context.flush()
+
+        start = time.perf_counter()
+        tree.save_to_file()
+        result["save_s"] = round(time.perf_counter() - start, 3)
+        tree.close()
+
+        tree_agent = MemoryTreeAgent()
+        items = [(f"/{OBJECTS[i % 20]}/{SUBJECTS[i % 5]}/item{i}", synthetic_memory(i))
+                 for i in range(size)]
+        result["stages"]["tree_agent.store"] = run_stage(
+            server, items, lambda item: tree_agent.store(*item))
+        rng = random.Random(args.seed)
+        recalls = []
+        for i in range(args.queries):
+            if i % 2:
+                recalls.append({"type": "exact", "path": items[rng.randrange(size)][0]})
+            else:
+                recalls.append({"type": "keyword", "keyword": rng.choice(OBJECTS + VERBS)})
+        result["stages"]["tree_agent.recall"] = run_stage(server, recalls, tree_agent.recall)
+        # 同样的查询一次批量执行（单个样本即整批耗时）
+        result["stages"]["tree_agent.recall_many"] = run_stage(server, [recalls], tree_agent.recall_many)
+
+    server.shutdown()
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--latency", type=float, default=0.02, help="假服务器每次调用的延迟（秒）")
+    parser.add_argument("--queries", type=int, default=20, help="每个阶段的调用次数")
+    parser.add_argument("--storage", default="journal", choices=("json", "journal", "sqlite", "sharded"))
+    parser.add_argument("--compact-nodes", action="store_true")
+    parser.add_argument("--prompt-layout", default="default", choices=("default", "prefix"))
+    parser.add_argument("--catalog", default="json", choices=("json", "compact"))
+    parser.add_argument("--catalog-top-n", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="把结果追加到该 JSON lines 文件")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(run_size(args.worker, args), ensure_ascii=False))
+        return
+
+    meta = {"git_rev": git_rev(), "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    passthrough = ["--latency", str(args.latency), "--queries", str(args.queries),
+                   "--storage", args.storage, "--seed", str(args.seed),
+                   "--prompt-layout", args.prompt_layout, "--catalog", args.catalog]
+    if args.compact_nodes:
+        passthrough.append("--compact-nodes")
+    if args.catalog_top_n is not None:
+        passthrough += ["--catalog-top-n", str(args.catalog_top_n)]
+    for size in args.sizes:
+        # 每个规模一个子进程，峰值内存互不干扰
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", str(size)]
+                             + passthrough, check=True, capture_output=True, text=True)
+        result = dict(meta, **json.loads(out.stdout.strip().splitlines()[-1]))
+        line = json.dumps(result, ensure_ascii=False)
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# benchmarks/bench_nodes.py
+"""
+对比 pydantic MemoryNode 与 CompactMemoryNode 在大树上的内存占用与加载/保存耗时。
+
+用法：
+    python benchmarks/bench_nodes.py --sizes 10000 100000 1000000
+
+每个 (规模, 节点类型) 在独立子进程中运行，RSS 互不干扰；
+结果按行输出 JSON，便于跨版本比较。
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+SCHEMA_PATH = os.path.join(ROOT_DIR, "schema.json")
+
+
+def build_tree_file(path: str, size: int, content=None):
+    """
+    直接写出含 size 条记忆的树文件，避免经由 add_memory 逐条保存。
+    content(i) 返回第 i 条记忆的文本，默认为编号文本。
+    """
+    from memory_tree import MemoryTree
+
+    tree = MemoryTree(SCHEMA_PATH, path)
+    categories = [c["node_id"] for c in tree.get_all_nodes_for_classification() if c["node_id"] != "root"]
+    data = {"nodes": {}, "root_id": "root"}
+    for node in tree.nodes.values():
+        record = node.model_dump()
+        record["children"] = {}
+        data["nodes"][node.id] = record
+    now = time.time()
+    for i in range(size):
+        parent_id = categories[i % len(categories)]
+        node_id = f"{parent_id}:mem{i}"
+        data["nodes"][node_id] = {
+            "id": node_id, "name": "记忆", "content": content(i) if content else f"第{i}条测试记忆：用户提到的事实 {i}",
+            "parent_id": parent_id, "children": {},
+            "created_at": now, "last_accessed": now, "access_count": i % 7,
+        }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_one(path: str, compact: bool) -> dict:
+    from memory_tree import MemoryTree
+
+    baseline = rss_mb()
+    start = time.perf_counter()
+    tree = MemoryTree(SCHEMA_PATH, path, compact_nodes=compact)
+    load_s = time.perf_counter() - start
+    loaded_rss = rss_mb()
+
+    start = time.perf_counter()
+    tree.save_to_file()
+    save_s = time.perf_counter() - start
+    return {
+        "nodes": len(tree.nodes),
+        "node_type": "compact" if compact else "pydantic",
+        "load_s": round(load_s, 3),
+        "save_s": round(save_s, 3),
+        "rss_mb": round(loaded_rss - baseline, 1),
+        "peak_rss_mb": round(rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--worker", nargs=2, metavar=("PATH", "NODE_TYPE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        path, node_type = args.worker
+        print(json.dumps(run_one(path, node_type == "compact")))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f"tree_{size}.json")
+            build_tree_file(path, size)
+            for node_type in ("pydantic", "compact"):
+                work = os.path.join(tmp, f"tree_{size}_{node_type}.json")
+                with open(path, "rb") as src, open(work, "wb") as dst:
+                    dst.write(src.read())
+                out = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--worker", work, node_type],
+                    check=True, capture_output=True, text=True,
+                )
+                result = json.loads(out.stdout)
+                result["memories"] = size
+                print(json.dumps(result, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
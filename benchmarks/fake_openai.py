@@ -0,0 +1,205 @@
+# benchmarks/fake_openai.py
+"""
+本地 OpenAI 兼容的假服务器，用于在不访问真实模型的情况下测试与压测。
+
+用法：
+    python benchmarks/fake_openai.py --port 8001 --latency 0.05
+    # 然后把 base_url 指向 http://127.0.0.1:8001/v1
+
+只实现 POST /v1/chat/completions（含 stream=True）。
+回答是确定性的：按提示中的特征文字识别是哪一类调用，返回合法的 JSON 决策；
+普通对话回显用户最后一句话。
+--fail-every N 时每 N 个请求返回一次 503，用于验证重试。
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_context import count_tokens  # noqa: E402
+from instrumentation import shared_prefix_tokens  # noqa: E402
+
+_INPUT_RE = re.compile(r'用户输入：\s*"(.*?)"', re.S)
+
+
+def _user_input(prompt: str) -> str:
+    match = _INPUT_RE.search(prompt)
+    return match.group(1) if match else prompt
+
+
+def _worth_remembering(text: str) -> bool:
+    """简单确定性规则：第一人称陈述值得记忆，问句不值得"""
+    return "我" in text and not re.search(r"[?？吗呢]\s*$", text)
+
+
+def _category_id(prompt: str) -> str:
+    """取分类列表中第一个非根分类，没有时挂到根节点；紧凑目录返回编号"""
+    ids = re.findall(r'"node_id":\s*"([^"]+)"', prompt)
+    ids = [i for i in ids if i != "root"]
+    if ids:
+        return ids[0]
+    if "可用的分类（编号" in prompt:
+        catalog = prompt.split("可用的分类（编号", 1)[1]
+        numbers = [n for n in re.findall(r"^\s*(\d+) ", catalog, re.M) if n != "0"]
+        return numbers[0] if numbers else "0"
+    return "root"
+
+
+def classify(prompt: str) -> str:
+    """按提示中的特征文字判断调用类型"""
+    for marker, kind in (("待处理条目", "batch"), ("记忆过滤与路由", "fused"), ("记忆过滤器", "remember"),
+                         ("智能记忆路由", "classify"), ("记忆检索导航", "branch"),
+                         ("记忆库", "search"), ("对话摘要助手", "summary")):
+        if marker in prompt:
+            return kind
+    return "chat"
+
+
+def answer(messages: List[Dict[str, str]]) -> str:
+    prompt = "\n".join(m.get("content") or "" for m in messages)
+    kind = classify(prompt)
+    if kind == "batch":
+        items = re.findall(r"^(\d+)\. (.*)$", prompt.split("待处理条目", 1)[1].split("可用的分类路径")[0], re.M)
+        category = _category_id(prompt)
+        return json.dumps({"items": [
+            {"index": int(i), "action": "attach", "target_id": category, "new_category": None,
+             "summary": text[:15]}
+            for i, text in items if _worth_remembering(text)
+        ]}, ensure_ascii=False)
+    if kind == "fused":
+        text = _user_input(prompt)
+        if not _worth_remembering(text):
+            return json.dumps({"should_remember": False, "action": None, "target_id": None,
+                               "new_category": None, "summary": None})
+        return json.dumps({"should_remember": True, "action": "attach",
+                           "target_id": _category_id(prompt), "new_category": None,
+                           "summary": text[:15]}, ensure_ascii=False)
+    if kind == "remember":
+        return json.dumps({"should_remember": _worth_remembering(_user_input(prompt))})
+    if kind == "classify":
+        return json.dumps({"action": "attach", "target_id": _category_id(prompt),
+                           "new_category": None, "summary": _user_input(prompt)[:15]},
+                          ensure_ascii=False)
+    if kind in ("branch", "search"):
+        return json.dumps({"selected": [1]})
+    if kind == "summary":
+        return "用户与助手进行了若干轮对话。"
+    last = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    return f"收到：{last[:50]}"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # 头和正文分两次写出，避免 Nagle + 延迟确认带来的 40ms 等待
+    latency = 0.0
+    fail_every = 0
+    _served = 0
+    calls = None  # start() 启动时记录每次调用的 {"kind", "prompt_tokens", "completion_tokens", "prefix_tokens"}
+    last_prompts = None  # 每类调用的上一次提示，模拟推理服务的前缀缓存
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        cls = type(self)
+        cls._served += 1
+        if self.fail_every and cls._served % self.fail_every == 0:
+            self._send_json(503, {"error": {"message": "overloaded"}})
+            return
+        messages = body.get("messages", [])
+        if self.latency:
+            time.sleep(self.latency)
+        text = answer(messages)
+        prompt = "\n".join(m.get("content") or "" for m in messages)
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(text)
+        if self.calls is not None:
+            kind = classify(prompt)
+            previous = self.last_prompts.get(kind, "")
+            self.last_prompts[kind] = prompt
+            self.calls.append({"kind": kind, "prompt_tokens": prompt_tokens,
+                               "completion_tokens": completion_tokens,
+                               "prefix_tokens": shared_prefix_tokens(previous, prompt)})
+        if body.get("stream"):
+            self._send_stream(body.get("model", "fake"), text)
+            return
+        self._send_json(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def _send_json(self, status: int, data: dict):
+        out = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _send_stream(self, model: str, text: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [text[i:i + 4] for i in range(0, len(text), 4)]
+        for piece in pieces:
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                     "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+
+def start(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, fail_every: int = 0):
+    """
+    在后台线程启动假服务器，返回 (server, base_url)。
+    port=0 时自动分配端口；server.calls 记录每次调用；用 server.shutdown() 停止。
+    """
+    handler = type("Handler", (FakeOpenAIHandler,),
+                   {"latency": latency, "fail_every": fail_every, "calls": [], "last_prompts": {}})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.calls = handler.calls
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="每次调用的模拟延迟（秒）")
+    parser.add_argument("--fail-every", type=int, default=0, help="每 N 个请求返回一次 503")
+    args = parser.parse_args()
+    handler = type("Handler", (FakeOpenAIHandler,),
+                   {"latency": args.latency, "fail_every": args.fail_every})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print(f"fake OpenAI server: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
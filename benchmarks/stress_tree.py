@@ -0,0 +1,129 @@
+# benchmarks/stress_tree.py
+"""
+多线程压力测试：thread_safe=True 的 MemoryTree 在线程池中并发读写。
+
+用法：
+    python benchmarks/stress_tree.py --threads 16 --ops 500 --storage journal
+
+每个线程混合执行：写入记忆、原子地“建分类 + 挂记忆”、关键词查询、读取扁平视图。
+结束后检查：
+- 写入的记忆一条不少、id 互不重复（同一毫秒的写入不会互相覆盖）
+- 每个新分类下都恰好有一条记忆（没有只建了分类的中间状态）
+- 从磁盘重新加载后内容摘要一致
+任何检查失败或线程抛出异常时以非零状态退出；结果输出一行 JSON。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from memory_tree import MemoryTree  # noqa: E402
+
+SCHEMA_PATH = os.path.join(ROOT_DIR, "schema.json")
+WORDS = ["篮球", "上海", "项目", "三体", "咖啡", "Python", "北京", "花生", "跑步", "猫"]
+
+
+def worker(tree: MemoryTree, categories: list, worker_id: int, ops: int, seed: int, reads: list):
+    rng = random.Random(seed + worker_id)
+    written, created = [], []
+    read_count = 0
+    for i in range(ops):
+        op = rng.random()
+        if op < 0.4:
+            content = f"w{worker_id}-{i} 我喜欢{rng.choice(WORDS)}"
+            node_id = tree.add_memory(content, rng.choice(categories))
+            written.append((node_id, content))
+        elif op < 0.5:
+            name = f"分类{worker_id}-{i}"
+            with tree.transaction():
+                category_id = tree.create_subcategory("root", name)
+                node_id = tree.add_memory(f"w{worker_id}-{i} 新分类下的记忆", category_id)
+            created.append(category_id)
+            written.append((node_id, f"w{worker_id}-{i} 新分类下的记忆"))
+        elif op < 0.8:
+            tree.find_best_node(rng.choice(WORDS))
+            read_count += 1
+        else:
+            view = tree.get_flat_memory_view()
+            # 读到的视图必须自洽：同一 id 不会出现两次
+            if len({entry["node_id"] for entry in view}) != len(view):
+                raise AssertionError("扁平视图中出现重复 id")
+            read_count += 1
+    reads.append(read_count)
+    return written, created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=500, help="每个线程的操作数")
+    parser.add_argument("--storage", default="journal", choices=("json", "journal", "sqlite", "sharded"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    errors = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "memory_tree.json")
+        tree = MemoryTree(SCHEMA_PATH, path, storage=args.storage, thread_safe=True)
+        reads: list = []
+        # 普通写入只挂到初始分类，新建的分类下应当只有建分类时挂的那一条
+        categories = [c["node_id"] for c in tree.get_all_nodes_for_classification()]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            futures = [pool.submit(worker, tree, categories, i, args.ops, args.seed, reads)
+                       for i in range(args.threads)]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append(f"线程异常：{e!r}")
+        elapsed = time.perf_counter() - start
+
+        written = [item for w, _ in results for item in w]
+        created = [category_id for _, ids in results for category_id in ids]
+        ids = [node_id for node_id, _ in written]
+        if len(set(ids)) != len(ids):
+            errors.append(f"记忆 id 重复：{len(ids) - len(set(ids))} 个")
+        for node_id, content in written:
+            node = tree.nodes.get(node_id)
+            if node is None or node.content != content:
+                errors.append(f"记忆丢失或被覆盖：{node_id}")
+                break
+        for category_id in created:
+            if len(tree.nodes[category_id].children) != 1:
+                errors.append(f"分类 {category_id} 下的记忆数不是 1")
+                break
+        flat_ids = {entry["node_id"] for entry in tree.get_flat_memory_view()}
+        if not set(ids) <= flat_ids:
+            errors.append("扁平视图缺少已写入的记忆")
+
+        digest = tree.memory_digest
+        tree.close()
+        reloaded = MemoryTree(SCHEMA_PATH, path, storage=args.storage)
+        if reloaded.memory_digest != digest:
+            errors.append("重新加载后内容摘要不一致")
+        reloaded.close()
+
+    print(json.dumps({
+        "threads": args.threads,
+        "storage": args.storage,
+        "writes": len(written),
+        "categories_created": len(created),
+        "reads": sum(reads),
+        "elapsed_s": round(elapsed, 3),
+        "ops_per_s": round((len(written) + sum(reads)) / elapsed, 1) if elapsed else None,
+        "errors": errors,
+    }, ensure_ascii=False))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
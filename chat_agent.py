@@ -1,46 +1,206 @@
 # chat_agent.py
+import asyncio
+import time
 import openai
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
 from memory_tree import MemoryTree
 from memory_agent import MemoryAgent
+from conversation_context import ConversationContext
+from instrumentation import instruments, prompt_text
+from llm_dispatcher import LLMDispatcher
 
 class ChatAgent:
-    def __init__(self, tree: MemoryTree, model="qwen3", base_url=None, api_key=None):
+    def __init__(self, tree: MemoryTree, model="qwen3", base_url=None, api_key=None,
+                 keep_turns: int = 6, max_context_tokens: int = 4000,
+                 client: Optional[openai.OpenAI] = None,
+                 async_client: Optional[openai.AsyncOpenAI] = None,
+                 dispatcher: Optional[LLMDispatcher] = None, **memory_options):
+        """
+        keep_turns: 原样保留的最近对话轮数，更早的轮次在后台合并为滚动摘要
+        max_context_tokens: 每次请求的上下文 token 上限
+        client / async_client / dispatcher: 同 MemoryAgent；回复与摘要和 MemoryAgent
+                               经由同一个 LLM 调度器（共享限流、并发上限与连接池）
+        memory_options 原样传给 MemoryAgent（如 fused=True、top_k=20）
+        """
         self.tree = tree
-        self.memory_agent = MemoryAgent(tree, model, base_url, api_key)
+        self.memory_agent = MemoryAgent(tree, model, base_url, api_key, client=client,
+                                        async_client=async_client, dispatcher=dispatcher,
+                                        **memory_options)
         self.model = model
-        self.client = openai.OpenAI(base_url=base_url, api_key=api_key)
-        self.messages = [{"role": "system", "content": (
+        self.dispatcher = self.memory_agent.dispatcher
+        self.client = self.dispatcher.client
+        self.context = ConversationContext(
             "你是智能助手，拥有永久记忆能力。\n"
             "1. 所有回答都应基于用户的长期记忆和当前对话上下文。\n"
             "2. 如果记忆中没有相关信息，请如实回答“我不记得”或“不知道”。\n"
-            "3. 不要编造信息。"
-        )}]
+            "3. 不要编造信息。",
+            summarize=self._summarize,
+            keep_turns=keep_turns,
+            max_tokens=max_context_tokens,
+        )
+        # 流式模式下记忆写入在后台单线程执行，保证写入顺序
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._pending_write: Optional[Future] = None
 
+    @instruments.traced("chat.turn")
     def chat(self, user_input: str) -> str:
         # === 第一步：决定是否存储新记忆 ===
-        if self.memory_agent.maybe_remember(user_input):
-            self.memory_agent.classify_and_store(user_input)
+        self.flush()
+        self._remember(user_input)
 
         # === 第二步：主动检索可能相关的记忆（预测式）===
         relevant_memory = self.memory_agent.search_memory(user_input)
-        
+
         # === 第三步：构造带记忆上下文的消息 ===
-        messages_for_reply = self.messages.copy()
-        if relevant_memory and relevant_memory != "无相关记忆。":
-            messages_for_reply.append({
-                "role": "system",
-                "content": f"相关记忆：\n{relevant_memory}"
-            })
-        messages_for_reply.append({"role": "user", "content": user_input})
+        messages_for_reply = self._build_messages(user_input, relevant_memory)
 
         # === 第四步：生成最终回答 ===
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages_for_reply
-        )
-        final_reply = response.choices[0].message.content or "好的。"
+        with instruments.span("chat.completion"):
+            start = time.perf_counter()
+            response = self.dispatcher.complete(self.model, messages_for_reply)
+            final_reply = response.choices[0].message.content or "好的。"
+            instruments.record_llm_call(prompt_text(messages_for_reply), final_reply,
+                                        time.perf_counter() - start, response.usage)
 
         # === 第五步：更新对话历史（不包含临时 system 记忆）===
-        self.messages.append({"role": "user", "content": user_input})
-        self.messages.append({"role": "assistant", "content": final_reply})
-        return final_reply
\ No newline at end of file
+        self._record_turn(user_input, final_reply)
+        return final_reply
+
+    def chat_stream(self, user_input: str) -> Iterator[str]:
+        """
+        流式回复：逐块 yield 模型输出。
+        记忆写入在后台线程进行，与生成回复重叠；流结束后才更新对话历史，
+        因此调用方需要把生成器消费完。
+        """
+        # 上一轮的后台写入先落地，保证本轮可检索到
+        turn_start = time.perf_counter()
+        self.flush()
+
+        relevant_memory = self.memory_agent.search_memory(user_input)
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memgrove-writer")
+        self._pending_write = self._writer.submit(self._remember, user_input)
+
+        messages_for_reply = self._build_messages(user_input, relevant_memory)
+        start = time.perf_counter()
+        stream = self.dispatcher.stream(self.model, messages_for_reply)
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        final_reply = "".join(parts)
+        # 流式回复跨越多次 yield，直接记录测得的耗时
+        instruments.record_llm_call(prompt_text(messages_for_reply), final_reply,
+                                    time.perf_counter() - start, stage="chat.completion")
+        instruments.observe("chat.completion", time.perf_counter() - start)
+        if not final_reply:
+            final_reply = "好的。"
+            yield final_reply
+
+        self._record_turn(user_input, final_reply)
+        instruments.observe("chat.turn", time.perf_counter() - turn_start)
+
+    def flush(self):
+        """等待后台记忆写入完成"""
+        if self._pending_write is not None:
+            future, self._pending_write = self._pending_write, None
+            future.result()
+
+    def _remember(self, user_input: str):
+        self.memory_agent.remember(user_input)
+
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        """当前保留的对话上下文（系统提示 + 摘要 + 最近轮次）"""
+        return self.context.messages
+
+    def _build_messages(self, user_input: str, relevant_memory: str) -> list:
+        if relevant_memory == "无相关记忆。":
+            relevant_memory = None
+        return self.context.build(user_input, relevant_memory)
+
+    def _record_turn(self, user_input: str, final_reply: str):
+        self.context.add_turn(user_input, final_reply)
+
+    @instruments.traced("chat.summarize")
+    def _summarize(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        """把较早的对话并入滚动摘要（在后台线程调用）"""
+        dialogue = "\n".join(
+            f"{'用户' if m['role'] == 'user' else '助手'}：{m['content']}" for m in messages
+        )
+        prompt = f"""
+你是一个对话摘要助手。请把“新增对话”合并进“已有摘要”，输出更新后的摘要。
+要求：保留事实、约定、未完成的问题，去掉寒暄；不超过 300 字；只输出摘要正文。
+
+已有摘要：
+{summary or "（无）"}
+
+新增对话：
+{dialogue}
+"""
+        start = time.perf_counter()
+        response = self.dispatcher.complete(self.model, [{"role": "user", "content": prompt}])
+        content = response.choices[0].message.content
+        instruments.record_llm_call(prompt, content or "", time.perf_counter() - start, response.usage)
+        return content or summary
+
+
+class AsyncChatAgent(ChatAgent):
+    """
+    基于 openai.AsyncOpenAI 的并发版本：
+    - 记忆检索与“是否记忆”判断同时进行
+    - 分类与写入在回复生成之后提交，不占用户等待时间
+    - 下一轮开始前先等待上一轮写入完成，保证本轮陈述的事实下一轮可被检索到
+    """
+
+    def __init__(self, tree: MemoryTree, model="qwen3", base_url=None, api_key=None,
+                 keep_turns: int = 6, max_context_tokens: int = 4000,
+                 client: Optional[openai.OpenAI] = None,
+                 async_client: Optional[openai.AsyncOpenAI] = None,
+                 dispatcher: Optional[LLMDispatcher] = None, **memory_options):
+        super().__init__(tree, model, base_url, api_key, keep_turns, max_context_tokens,
+                         client, async_client, dispatcher, **memory_options)
+        self._pending_store: Optional[asyncio.Task] = None
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        return self.dispatcher.async_client
+
+    @instruments.traced("chat.turn")
+    async def achat(self, user_input: str) -> str:
+        await self.aflush()
+
+        # === 第一步：并发执行“是否记忆”判断（合并模式下含分类）与记忆检索 ===
+        remember_task = asyncio.create_task(self.memory_agent.adecide(user_input))
+        try:
+            relevant_memory = await self.memory_agent.asearch_memory(user_input)
+
+            # === 第二步：生成最终回答 ===
+            messages_for_reply = self._build_messages(user_input, relevant_memory)
+            with instruments.span("chat.completion"):
+                start = time.perf_counter()
+                response = await self.dispatcher.acomplete(self.model, messages_for_reply)
+                final_reply = response.choices[0].message.content or "好的。"
+                instruments.record_llm_call(prompt_text(messages_for_reply), final_reply,
+                                            time.perf_counter() - start, response.usage)
+            self._record_turn(user_input, final_reply)
+            return final_reply
+        finally:
+            # === 第三步：回复之后再提交记忆写入 ===
+            self._pending_store = asyncio.create_task(self._commit_memory(remember_task, user_input))
+
+    async def _commit_memory(self, remember_task: asyncio.Task, user_input: str):
+        decision = await remember_task
+        if decision is not None:
+            await self.memory_agent.acommit(user_input, decision)
+
+    async def aflush(self):
+        """等待尚未完成的记忆写入"""
+        if self._pending_store is not None:
+            task, self._pending_store = self._pending_store, None
+            await task
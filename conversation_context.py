@@ -0,0 +1,136 @@
+# conversation_context.py
+import math
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # 未安装或无法加载编码表时退回估算
+    _ENCODING = None
+
+_CJK_RE = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+# 每条消息的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD = 4
+
+
+def count_tokens(text: str) -> int:
+    """
+    统计 token 数：装了 tiktoken 用 cl100k_base，
+    否则按“中日韩字符 1 字 1 token，其余 4 字符 1 token”估算。
+    """
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def message_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+class ConversationContext:
+    """
+    有 token 预算的对话上下文：
+    - 最近 keep_turns 轮原样保留
+    - 更早的轮次交给 summarize 在后台线程合并进滚动摘要
+    - build() 组装请求消息时保证总 token 数不超过 max_tokens，
+      超出时从最旧的原文轮次开始丢弃
+    summarize(旧摘要, 待合并消息) -> 新摘要；为 None 时旧轮次直接丢弃。
+    """
+
+    def __init__(self, system_prompt: str,
+                 summarize: Optional[Callable[[str, List[Dict[str, str]]], str]] = None,
+                 keep_turns: int = 6, max_tokens: int = 4000):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.summarize = summarize
+        self.keep_turns = keep_turns
+        self.max_tokens = max_tokens
+        self.summary = ""
+        self._turns: List[List[Dict[str, str]]] = []    # 原样保留的最近轮次
+        self._folding: List[List[Dict[str, str]]] = []  # 等待合并进摘要的轮次
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._future: Optional[Future] = None
+
+    def _summary_message(self) -> List[Dict[str, str]]:
+        if not self.summary:
+            return []
+        return [{"role": "system", "content": f"此前对话摘要：\n{self.summary}"}]
+
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        """当前保留的上下文：系统提示 + 摘要 + 尚未丢弃的原文轮次"""
+        with self._lock:
+            messages = [self.system_message] + self._summary_message()
+            for turn in self._folding + self._turns:
+                messages.extend(turn)
+            return messages
+
+    def add_turn(self, user_input: str, reply: str):
+        with self._lock:
+            self._turns.append([
+                {"role": "user", "content": user_input},
+                {"role": "assistant", "content": reply},
+            ])
+            if len(self._turns) <= self.keep_turns:
+                return
+            overflow = len(self._turns) - self.keep_turns
+            if self.summarize is not None:
+                self._folding.extend(self._turns[:overflow])
+                # 摘要持续失败时也不能无限堆积
+                del self._folding[:-self.keep_turns * 4]
+            del self._turns[:overflow]
+            if self.summarize is None or (self._future is not None and not self._future.done()):
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memgrove-summary")
+            self._future = self._executor.submit(self._fold)
+
+    def _fold(self):
+        """后台：把待合并轮次逐批并入摘要，直到没有新的待合并轮次"""
+        while True:
+            with self._lock:
+                batch = list(self._folding)
+                summary = self.summary
+            if not batch:
+                return
+            try:
+                new_summary = self.summarize(summary, [m for turn in batch for m in turn])
+            except Exception:
+                return  # 保留待合并轮次，下次溢出时重试
+            with self._lock:
+                self.summary = new_summary.strip()
+                merged = {id(turn) for turn in batch}
+                self._folding = [t for t in self._folding if id(t) not in merged]
+
+    def build(self, user_input: str, memory: Optional[str] = None) -> List[Dict[str, str]]:
+        """组装本轮请求：[系统提示, 摘要, 历史..., 相关记忆, 用户输入]，不超过 max_tokens"""
+        with self._lock:
+            head = [self.system_message] + self._summary_message()
+            turns = self._folding + self._turns
+        tail = []
+        if memory:
+            tail.append({"role": "system", "content": f"相关记忆：\n{memory}"})
+        tail.append({"role": "user", "content": user_input})
+
+        budget = self.max_tokens - message_tokens(head) - message_tokens(tail)
+        kept: List[List[Dict[str, str]]] = []
+        for turn in reversed(turns):
+            cost = message_tokens(turn)
+            if cost > budget:
+                break
+            kept.append(turn)
+            budget -= cost
+        history = [m for turn in reversed(kept) for m in turn]
+        return head + history + tail
+
+    def flush(self):
+        """等待后台摘要完成"""
+        if self._future is not None:
+            self._future.result()
@@ -1,21 +1,28 @@
 # frontend_agent.py
 
 import os
-from openai import OpenAI
+from typing import Optional
+
+from llm_dispatcher import LLMDispatcher, get_dispatcher
 from memory_tree_agent import MemoryTreeAgent
 
 
 class FrontendAgent:
-    def __init__(self, memory_agent: MemoryTreeAgent):
+    def __init__(self, memory_agent: MemoryTreeAgent, model: str = "gpt-3.5-turbo",
+                 dispatcher: Optional[LLMDispatcher] = None):
         self.memory = memory_agent
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("请设置环境变量 OPENAI_API_KEY")
-        self.client = OpenAI(api_key=api_key)
+        self.model = model
+        if dispatcher is None:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("请设置环境变量 OPENAI_API_KEY")
+            dispatcher = get_dispatcher(api_key=api_key)
+        self.dispatcher = dispatcher
+        self.client = dispatcher.client
 
-    def _parse_intent_with_llm(self, natural_language: str) -> dict:
+    def _parse_intents_with_llm(self, natural_language: str) -> list:
         """
-        使用 LLM 解析用户意图，返回结构化指令：
+        使用 LLM 解析用户意图，一次调用返回请求中的全部指令（按出现顺序），每条为：
         {
             "action": "store" | "recall",
             "path": str (optional),
@@ -27,8 +34,12 @@ class FrontendAgent:
             } (仅 recall 时存在)
         }
         """
-        prompt = f"""你是一个记忆系统代理。请将用户的自然语言请求转换为以下 JSON 格式：
+        prompt = f"""你是一个记忆系统代理。请将用户的自然语言请求转换为以下 JSON 格式。
+一句话里可能包含多个请求（如“查一下我的名字、城市和工作”），请逐个拆开，按出现顺序放入 intents：
+
+{{"intents": [指令1, 指令2, ...]}}
 
+每条指令：
 - 如果是存储请求（如“记住...”、“保存...”），输出：{{"action": "store", "path": "...", "value": "..."}}
 - 如果是任何类型的回忆请求（如“查询...”、“搜索...”、“找一下...”），输出：{{"action": "recall", "query_data": {{"type": "...", ...}}}}
 
@@ -40,56 +51,80 @@ class FrontendAgent:
 
 只输出 JSON，不要任何其他内容。"""
 
-        response = self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
+        response = self.dispatcher.complete(
+            self.model,
+            [
                 {"role": "system", "content": "你是一个精准的记忆操作代理，只输出指定 JSON。"},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.0,
-            max_tokens=250
+            max_tokens=600
         )
 
         try:
             import json
             result = json.loads(response.choices[0].message.content.strip())
-            return result
         except Exception as e:
             raise ValueError(f"LLM 返回格式错误: {e}")
+        # 兼容只返回单条指令的情况
+        intents = result.get("intents") if "intents" in result else [result]
+        if not isinstance(intents, list):
+            raise ValueError("LLM 返回格式错误: intents 不是列表")
+        return [intent for intent in intents if isinstance(intent, dict)]
 
     def query(self, natural_language: str) -> str:
+        """
+        执行请求中的全部指令，每条指令一段结果，按顺序换行拼接。
+        相邻的回忆指令合并为一次 recall_many；存储指令按原顺序执行，
+        之后的回忆能看到它写入的内容。
+        """
         try:
-            intent = self._parse_intent_with_llm(natural_language)
-            action = intent.get("action")
-
-            if action == "store":
-                path = intent.get("path", "").strip()
-                value = intent.get("value", "").strip()
-                if not path or not value:
-                    return "❌ LLM 解析失败：缺少 path 或 value"
-                self.memory.store(path, value)
-                return f"✅ 已记住：{path} = {value}"
-
-            elif action == "recall":
-                query_data = intent.get("query_data")
-                if not isinstance(query_data, dict):
-                    return "❌ LLM 解析失败：query_data 格式错误"
-                
-                # 将结构化查询数据传递给记忆代理进行统一回忆
-                results = self.memory.recall(query_data)
-                
-                if not results:
-                    return "❌ 未找到相关记忆"
-                
-                # 格式化回忆结果
-                if query_data.get("type") == "exact":
-                    return f"🔍 回忆结果：{results[0]['value']}"
-                else:  # keyword
-                    lines = [f"- {r['path']}: {r['value']}" for r in results]
-                    return "🔍 回忆结果：\n" + "\n".join(lines)
-
-            else:
+            intents = self._parse_intents_with_llm(natural_language)
+            if not intents:
                 return "🤖 无法识别的操作类型"
+            outputs = [None] * len(intents)
+            pending = []  # 待批量执行的 (位置, query_data)
+            for pos, intent in enumerate(intents):
+                action = intent.get("action")
+                if action == "recall":
+                    query_data = intent.get("query_data")
+                    if not isinstance(query_data, dict):
+                        outputs[pos] = "❌ LLM 解析失败：query_data 格式错误"
+                    elif query_data.get("type") not in ("exact", "keyword"):
+                        outputs[pos] = f"❌ 处理失败：不支持的回忆类型: {query_data.get('type')}"
+                    else:
+                        pending.append((pos, query_data))
+                    continue
+                self._run_recalls(pending, outputs)
+                pending = []
+                if action == "store":
+                    outputs[pos] = self._store(intent)
+                else:
+                    outputs[pos] = "🤖 无法识别的操作类型"
+            self._run_recalls(pending, outputs)
+            return "\n".join(outputs)
 
         except Exception as e:
-            return f"❌ 处理失败：{str(e)}"
\ No newline at end of file
+            return f"❌ 处理失败：{str(e)}"
+
+    def _store(self, intent: dict) -> str:
+        path = (intent.get("path") or "").strip()
+        value = (intent.get("value") or "").strip()
+        if not path or not value:
+            return "❌ LLM 解析失败：缺少 path 或 value"
+        self.memory.store(path, value)
+        return f"✅ 已记住：{path} = {value}"
+
+    def _run_recalls(self, pending: list, outputs: list):
+        if not pending:
+            return
+        # 将结构化查询数据批量传递给记忆代理，共用一次索引/数据库访问
+        results = self.memory.recall_many([query_data for _, query_data in pending])
+        for (pos, query_data), found in zip(pending, results):
+            if not found:
+                outputs[pos] = "❌ 未找到相关记忆"
+            elif query_data.get("type") == "exact":
+                outputs[pos] = f"🔍 回忆结果：{found[0]['value']}"
+            else:  # keyword
+                lines = [f"- {r['path']}: {r['value']}" for r in found]
+                outputs[pos] = "🔍 回忆结果：\n" + "\n".join(lines)
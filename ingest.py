@@ -0,0 +1,299 @@
+# ingest.py
+"""
+批量导入聊天记录与笔记。
+
+用法：
+    python ingest.py chat_log.jsonl notes.md --batch-size 20 --workers 4 --rate 2
+
+流程：逐行读取文件 -> 切分为条目 -> 本地预过滤 -> 每 batch_size 条一次 LLM 调用
+（同时判断是否值得记忆并分类）-> 每个分块在一个事务中写入记忆树。
+多个 worker 并发调用 LLM，由令牌桶限制请求速率；写入在线程池中执行，不阻塞事件循环。
+每完成一个分块就更新检查点文件，中断后用同样的参数重新运行会跳过已完成的分块。
+分类结果在写入前先记入检查点：写入途中或写入后、标记完成前中断，重新运行时
+按记下的结果重放，已写入的记忆不会重复导入（也不会再调用一次 LLM）。
+
+支持的输入：
+- .jsonl：每行一个对象，取 content/text 字段；带 role 字段时只导入 role=user 的消息
+- 其他文本文件：每行一条；“用户：”/“user:” 前缀会去掉，“助手：”/“assistant:” 行跳过
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from instrumentation import instruments
+from memory_agent import MemoryAgent
+from memory_journal import atomic_write_json
+from memory_tree import MemoryTree
+from rate_limit import TokenBucket
+
+logger = logging.getLogger("memgrove.ingest")
+
+_SPEAKER_RE = re.compile(r"^\s*(用户|我|user|human)\s*[:：]\s*", re.IGNORECASE)
+_ASSISTANT_RE = re.compile(r"^\s*(助手|assistant|ai|bot)\s*[:：]", re.IGNORECASE)
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？!?；;.])\s*")
+
+
+def _split_long(text: str, max_chars: int) -> List[str]:
+    """超长段落按句末标点切开，再合并到不超过 max_chars 的片段"""
+    if len(text) <= max_chars:
+        return [text]
+    pieces, current = [], ""
+    for sentence in _SENTENCE_END_RE.split(text):
+        while len(sentence) > max_chars:
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if current and len(current) + len(sentence) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += sentence
+    if current:
+        pieces.append(current)
+    return [p.strip() for p in pieces if p.strip()]
+
+
+def read_items(path: str, max_chars: int = 300) -> Iterator[str]:
+    """流式读取一个文件中的待导入条目"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(record, dict) or record.get("role", "user") != "user":
+                    continue
+                text = str(record.get("content") or record.get("text") or "").strip()
+            else:
+                if _ASSISTANT_RE.match(line):
+                    continue
+                text = _SPEAKER_RE.sub("", line).strip()
+            if text:
+                yield from _split_long(text, max_chars)
+
+
+def read_chunks(path: str, batch_size: int, max_chars: int) -> Iterator[List[str]]:
+    chunk: List[str] = []
+    for item in read_items(path, max_chars):
+        chunk.append(item)
+        if len(chunk) == batch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BulkIngestor:
+    """
+    批量导入器：复用 MemoryAgent 的 LLM 客户端、本地预过滤器与分类写入逻辑。
+    rate: 每秒最多发起的 LLM 请求数（None 不限流）
+    checkpoint: 检查点文件路径（None 不支持断点续传）
+    tree 需以 thread_safe=True 创建：分块在线程池中写入，同时其他 worker 在读取分类。
+    """
+
+    def __init__(self, tree: MemoryTree, agent: MemoryAgent, batch_size: int = 20,
+                 workers: int = 4, rate: Optional[float] = None,
+                 checkpoint: Optional[str] = None, max_chars: int = 300):
+        if not tree.thread_safe:
+            raise ValueError("BulkIngestor 需要 thread_safe=True 的 MemoryTree")
+        self.tree = tree
+        self.agent = agent
+        self.batch_size = batch_size
+        self.workers = workers
+        self.limiter = TokenBucket(rate) if rate else None
+        self.checkpoint = checkpoint
+        self.max_chars = max_chars
+        self.stats = {"chunks": 0, "chunks_skipped": 0, "chunks_failed": 0, "items": 0,
+                      "prefiltered": 0, "sent_to_llm": 0, "remembered": 0, "llm_calls": 0,
+                      "failed_chunks": []}  # 失败分块："文件路径#分块编号"
+        self._state = self._load_checkpoint()
+
+    # ===== 检查点 =====
+
+    def _params_key(self) -> str:
+        # 分块方式变化后分块编号不再对应，旧检查点作废
+        return f"batch_size={self.batch_size};max_chars={self.max_chars}"
+
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("params") == self._params_key():
+                state.setdefault("pending", {})
+                return state
+        # pending：已分类但尚未确认写入的分块 -> 分类结果，重新运行时重放
+        return {"params": self._params_key(), "files": {}, "pending": {}}
+
+    @staticmethod
+    def _file_key(path: str) -> str:
+        stat = os.stat(path)
+        return hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+                            .encode("utf-8")).hexdigest()
+
+    def _save_checkpoint(self):
+        if self.checkpoint:
+            atomic_write_json(self.checkpoint, self._state, indent=None)
+
+    def _mark_pending(self, file_key: str, index: int, decisions: List[Dict[str, Any]]):
+        self._state["pending"][f"{file_key}:{index}"] = decisions
+        self._save_checkpoint()
+
+    def _mark_done(self, file_key: str, index: int):
+        done = self._state["files"].setdefault(file_key, [])
+        done.append(index)
+        self._state["pending"].pop(f"{file_key}:{index}", None)
+        self._save_checkpoint()
+
+    # ===== 批量判断与分类 =====
+
+    async def _classify_chunk(self, items: List[str]) -> List[Dict[str, Any]]:
+        candidates = [item for item in items
+                      if self.agent.prefilter is None or not self.agent.prefilter.should_skip(item)]
+        self.stats["prefiltered"] += len(items) - len(candidates)
+        if not candidates:
+            return []
+        if self.limiter is not None:
+            await self.limiter.aacquire()
+        self.stats["sent_to_llm"] += len(candidates)
+        self.stats["llm_calls"] += 1
+        return await self.agent.aclassify_batch(candidates)
+
+    def _target_parent(self, decision: Dict[str, Any]) -> str:
+        """与 MemoryAgent.apply_classification 相同的落点"""
+        if decision["action"] == "create":
+            return f"root:{decision['new_category']}"
+        target_id = decision.get("target_id") or "root"
+        return target_id if target_id in self.tree.nodes else "root"
+
+    def _stored_count(self, parent_id: str, summary: str) -> int:
+        self.tree.materialize(parent_id)
+        parent = self.tree.nodes.get(parent_id)
+        if parent is None:
+            return 0
+        return sum(1 for child in parent.children.values()
+                   if child.name == "记忆" and child.content == summary)
+
+    def _commit_chunk(self, decisions: List[Dict[str, Any]], replay: bool = False) -> int:
+        """
+        在线程池中执行。整个分块一个事务：只写一次盘，其他线程看不到半个分块。
+        replay 时跳过已经写入的记忆（同一分类下内容相同），返回本次写入的条数。
+        """
+        stored = 0
+        with self.tree.transaction():
+            seen = Counter()
+            for decision in decisions:
+                if replay:
+                    key = (self._target_parent(decision), decision["summary"])
+                    seen[key] += 1
+                    if self._stored_count(*key) >= seen[key]:
+                        continue
+                self.agent.apply_classification(decision)
+                stored += 1
+        return stored
+
+    # ===== 调度 =====
+
+    def _pending_chunks(self, paths: List[str]) -> Iterator[Tuple[str, str, int, List[str]]]:
+        for path in paths:
+            file_key = self._file_key(path)
+            done = set(self._state["files"].get(file_key, []))
+            for index, chunk in enumerate(read_chunks(path, self.batch_size, self.max_chars)):
+                if index in done:
+                    self.stats["chunks_skipped"] += 1
+                    continue
+                yield path, file_key, index, chunk
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            job = await queue.get()
+            if job is None:
+                return
+            path, file_key, index, chunk = job
+            try:
+                with instruments.span("ingest.chunk"):
+                    decisions = self._state["pending"].get(f"{file_key}:{index}")
+                    replay = decisions is not None
+                    if not replay:
+                        decisions = await self._classify_chunk(chunk)
+                        self._mark_pending(file_key, index, decisions)
+                    stored = await asyncio.to_thread(self._commit_chunk, decisions, replay)
+                self._mark_done(file_key, index)
+                self.stats["remembered"] += stored
+                self.stats["chunks"] += 1
+                self.stats["items"] += len(chunk)
+            except Exception:
+                # 该分块不标记完成，下次运行时重试（已分类的按记下的结果重放）
+                logger.exception("导入分块失败：%s#%d", path, index)
+                self.stats["chunks_failed"] += 1
+                self.stats["failed_chunks"].append(f"{path}#{index}")
+
+    async def run(self, paths: List[str]) -> Dict[str, Any]:
+        # 有界队列：文件按需读取，不会一次性读入内存
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        for job in self._pending_chunks(paths):
+            await queue.put(job)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        return self.stats
+
+    def ingest(self, paths: List[str]) -> Dict[str, Any]:
+        return asyncio.run(self.run(paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--batch-size", type=int, default=20, help="每次 LLM 调用处理的条目数")
+    parser.add_argument("--workers", type=int, default=4, help="并发的 LLM 请求数")
+    parser.add_argument("--rate", type=float, default=None, help="每秒最多发起的 LLM 请求数")
+    parser.add_argument("--max-chars", type=int, default=300, help="单个条目的最大长度")
+    parser.add_argument("--checkpoint", default="ingest.checkpoint.json")
+    parser.add_argument("--schema", default="schema.json")
+    parser.add_argument("--tree", default="memory_tree.json")
+    parser.add_argument("--storage", default="journal", choices=("json", "journal", "sqlite", "sharded"))
+    parser.add_argument("--dedup-threshold", type=float, default=None,
+                        help="写入时合并同一分类下的近似重复记忆（如 0.8）")
+    parser.add_argument("--prompt-layout", default="default", choices=("default", "prefix"),
+                        help="prefix：分类列表在前、待处理条目在后，便于推理服务复用前缀缓存")
+    parser.add_argument("--catalog", default="json", choices=("json", "compact"),
+                        help="compact：分类以缩进的 \"编号 分类名\" 目录交给 LLM，提示更短")
+    parser.add_argument("--catalog-top-n", type=int, default=None,
+                        help="分类数超过该值时先在本地裁剪到最可能的 N 个")
+    parser.add_argument("--model", default="qwen3-max")
+    parser.add_argument("--base-url", default="https://dashscope.aliyuncs.com/compatible-mode/v1")
+    parser.add_argument("--api-key", default=os.getenv("DASHSCOPE_API_KEY") or os.getenv("OPENAI_API_KEY"))
+    args = parser.parse_args()
+    if not args.api_key:
+        raise ValueError("请设置 DASHSCOPE_API_KEY（或 OPENAI_API_KEY）环境变量，或传入 --api-key")
+
+    tree = MemoryTree(args.schema, args.tree, storage=args.storage, dedup_threshold=args.dedup_threshold,
+                      thread_safe=True)
+    agent = MemoryAgent(tree, args.model, args.base_url, args.api_key, index_type=None,
+                        prompt_layout=args.prompt_layout, catalog=args.catalog,
+                        catalog_top_n=args.catalog_top_n)
+    ingestor = BulkIngestor(tree, agent, batch_size=args.batch_size, workers=args.workers,
+                            rate=args.rate, checkpoint=args.checkpoint, max_chars=args.max_chars)
+    start = time.perf_counter()
+    try:
+        stats = ingestor.ingest(args.files)
+    finally:
+        tree.close()
+    stats["elapsed_s"] = round(time.perf_counter() - start, 2)
+    if args.dedup_threshold is not None:
+        stats["dedup"] = tree.dedup_stats
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
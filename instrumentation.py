@@ -0,0 +1,316 @@
+# instrumentation.py
+"""
+各阶段耗时、LLM token 用量与记忆树规模的埋点。
+
+默认关闭：span() 返回共享的空上下文，record_llm_call()/gauge() 直接返回，几乎没有开销。
+启用方式：
+    from instrumentation import instruments, JsonLinesSink, PrometheusSink
+    prom = PrometheusSink()
+    instruments.enable(JsonLinesSink("metrics.jsonl"), prom)
+    prom.serve(port=9100)   # GET /metrics 返回 Prometheus 文本格式
+
+事件为 dict：
+    {"type": "span", "name": "memory.search_memory", "duration_ms": 12.3, "error": False, ...}
+    {"type": "llm", "stage": "memory.search_memory", "prompt_tokens": 480, "completion_tokens": 8,
+     "prompt_bytes": 1520, "completion_bytes": 16, "prefix_tokens": 450, "duration_ms": 230.1}
+    {"type": "gauge", "name": "tree.nodes", "value": 1017}
+其中 prefix_tokens 为本次提示与同一阶段上一次提示相同前缀的 token 数，
+即支持前缀缓存的推理服务（vLLM / Ollama 等）理论上可以复用的部分。
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+from conversation_context import count_tokens
+
+# 当前所在的阶段（最内层 span 名），LLM 调用据此归属到阶段；协程与线程各自独立
+_current_stage: contextvars.ContextVar = contextvars.ContextVar("memgrove_stage", default="")
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def shared_prefix_tokens(previous: str, prompt: str) -> int:
+    """prompt 与 previous 相同前缀部分的 token 数"""
+    return count_tokens(os.path.commonprefix([previous, prompt])) if previous else 0
+
+
+class _Span:
+    __slots__ = ("owner", "name", "labels", "start", "token")
+
+    def __init__(self, owner: "Instrumentation", name: str, labels: Dict[str, Any]):
+        self.owner = owner
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.token = _current_stage.set(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _current_stage.reset(self.token)
+        event = {"type": "span", "name": self.name, "duration_ms": round(duration * 1000, 3),
+                 "error": exc_type is not None, "parent": _current_stage.get()}
+        event.update(self.labels)
+        self.owner.emit(event)
+        return False
+
+
+class Instrumentation:
+    """埋点入口：启用后把事件分发给所有 sink"""
+
+    def __init__(self):
+        self.enabled = False
+        self.sinks: List[Any] = []
+        self._last_prompts: Dict[str, str] = {}  # 阶段 -> 上一次的提示，用于统计前缀复用
+        self._lock = threading.Lock()
+
+    def enable(self, *sinks):
+        self.sinks.extend(sinks)
+        self.enabled = bool(self.sinks)
+
+    def disable(self):
+        self.enabled = False
+        self._last_prompts = {}
+        for sink in self.sinks:
+            close = getattr(sink, "close", None)
+            if close is not None:
+                close()
+        self.sinks = []
+
+    def span(self, name: str, **labels):
+        """with instruments.span("tree.save"): ... 记录耗时，嵌套时记录父阶段"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, labels)
+
+    def traced(self, name: str):
+        """span 的装饰器形式，支持普通函数与协程函数；关闭时只多一次属性判断"""
+        def decorate(fn):
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await fn(*args, **kwargs)
+                    with _Span(self, name, {}):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Span(self, name, {}):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def observe(self, name: str, duration: float, **labels):
+        """直接记录一段已测得的耗时（如跨越多次 yield 的流式回复）"""
+        if not self.enabled:
+            return
+        event = {"type": "span", "name": name, "duration_ms": round(duration * 1000, 3),
+                 "error": False, "parent": _current_stage.get()}
+        event.update(labels)
+        self.emit(event)
+
+    def record_llm_call(self, prompt: str, completion: str, duration: float,
+                        usage: Any = None, stage: Optional[str] = None):
+        """记录一次 LLM 调用；usage 为响应中的 usage（没有时本地估算 token 数）"""
+        if not self.enabled:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        stage = stage or _current_stage.get() or "unknown"
+        with self._lock:
+            previous = self._last_prompts.get(stage, "")
+            self._last_prompts[stage] = prompt
+        self.emit({
+            "type": "llm",
+            "stage": stage,
+            "prompt_tokens": prompt_tokens if prompt_tokens is not None else count_tokens(prompt),
+            "completion_tokens": (completion_tokens if completion_tokens is not None
+                                  else count_tokens(completion)),
+            "prompt_bytes": len(prompt.encode("utf-8")),
+            "completion_bytes": len(completion.encode("utf-8")),
+            "prefix_tokens": shared_prefix_tokens(previous, prompt),
+            "duration_ms": round(duration * 1000, 3),
+        })
+
+    def gauge(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        event = {"type": "gauge", "name": name, "value": value}
+        event.update(labels)
+        self.emit(event)
+
+    def emit(self, event: Dict[str, Any]):
+        event["ts"] = time.time()
+        for sink in self.sinks:
+            try:
+                sink.emit(event)
+            except Exception:
+                pass  # 埋点失败不能影响业务
+
+
+# 全局实例，各模块共用
+instruments = Instrumentation()
+
+
+def prompt_text(messages: List[Dict[str, str]]) -> str:
+    """把 chat 消息列表拼成一段文本，用于统计提示长度"""
+    return "\n".join(m.get("content") or "" for m in messages)
+
+
+class LoggingSink:
+    """每个事件输出一条日志（JSON 格式）"""
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger("memgrove.metrics")
+        self.level = level
+
+    def emit(self, event: Dict[str, Any]):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, json.dumps(event, ensure_ascii=False))
+
+
+class JsonLinesSink:
+    """事件逐行追加到 JSON lines 文件"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def emit(self, event: Dict[str, Any]):
+        line = json.dumps(event, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class PrometheusSink:
+    """
+    在内存中聚合为 Prometheus 指标：
+    - memgrove_span_seconds（summary：count/sum，按 span 名）
+    - memgrove_llm_calls_total / _prompt_tokens_total / _completion_tokens_total /
+      _prompt_bytes_total / _completion_bytes_total / _prefix_tokens_total（按阶段）
+    - memgrove_<gauge 名>（最新值）
+    render() 返回文本格式，serve() 启动 /metrics 端点。
+    """
+
+    _LLM_FIELDS = ("prompt_tokens", "completion_tokens", "prompt_bytes", "completion_bytes",
+                   "prefix_tokens")
+
+    def __init__(self, prefix: str = "memgrove"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._spans: Dict[str, List[float]] = {}    # name -> [count, sum_seconds]
+        self._llm: Dict[str, Dict[str, float]] = {}  # stage -> 计数
+        self._gauges: Dict[tuple, float] = {}       # (name, labels) -> value
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def emit(self, event: Dict[str, Any]):
+        with self._lock:
+            kind = event["type"]
+            if kind == "span":
+                stat = self._spans.setdefault(event["name"], [0, 0.0])
+                stat[0] += 1
+                stat[1] += event["duration_ms"] / 1000
+            elif kind == "llm":
+                stat = self._llm.setdefault(event["stage"], dict.fromkeys(("calls",) + self._LLM_FIELDS, 0))
+                stat["calls"] += 1
+                for field in self._LLM_FIELDS:
+                    stat[field] += event[field]
+            elif kind == "gauge":
+                labels = tuple(sorted((k, str(v)) for k, v in event.items()
+                                      if k not in ("type", "name", "value", "ts")))
+                self._gauges[(event["name"], labels)] = event["value"]
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        # 文本格式要求标签值中的反斜杠、双引号与换行转义
+        body = ",".join(
+            f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for k, v in pairs)
+        return "{" + body + "}"
+
+    def _metric(self, name: str) -> str:
+        return f"{self.prefix}_{name.replace('.', '_').replace('-', '_')}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            span = self._metric("span_seconds")
+            lines += [f"# HELP {span} 各阶段耗时", f"# TYPE {span} summary"]
+            for name, (count, total) in sorted(self._spans.items()):
+                labels = self._labels([("span", name)])
+                lines.append(f"{span}_count{labels} {count}")
+                lines.append(f"{span}_sum{labels} {total:.6f}")
+            for field in ("calls",) + self._LLM_FIELDS:
+                metric = self._metric(f"llm_{field}_total")
+                lines.append(f"# TYPE {metric} counter")
+                for stage, stat in sorted(self._llm.items()):
+                    lines.append(f"{metric}{self._labels([('stage', stage)])} {stat[field]}")
+            seen = set()
+            for (name, labels), value in sorted(self._gauges.items()):
+                metric = self._metric(name)
+                if metric not in seen:
+                    seen.add(metric)
+                    lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9100) -> ThreadingHTTPServer:
+        """在后台线程提供 GET /metrics"""
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,120 @@
+# llm_cache.py
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT_RE = re.compile(r"[\s.,!?~。，！？～…]+$")
+
+
+def normalize_input(text: str) -> str:
+    """
+    归一化用户输入，让近似相同的问题命中同一条缓存：
+    全角转半角、小写、合并空白、去掉句末标点。
+    """
+    text = unicodedata.normalize("NFKC", text).lower().strip()
+    text = _SPACE_RE.sub(" ", text)
+    return _TRAILING_PUNCT_RE.sub("", text)
+
+
+def make_key(*parts: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class LLMCache:
+    """
+    LLM 决策缓存：内存 LRU + TTL，可选 SQLite 持久化以便重启后继续命中。
+    键由调用方用 make_key 组合（归一化输入、模型、提示模板、记忆树摘要等），
+    记忆树变化后摘要不同，旧条目自然不会再命中，随 LRU/TTL 淘汰。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 3600.0,
+                 path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._db.execute("DELETE FROM llm_cache WHERE expires_at IS NOT NULL AND expires_at < ?",
+                             (time.time(),))
+            self._db.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = (row[1], json.loads(row[0]))
+                    self._remember(key, entry)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < now:
+                self._drop(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def set(self, key: str, value: Any):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._remember(key, (expires_at, value))
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), expires_at),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _drop(self, key: str):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+                self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,298 @@
+# llm_dispatcher.py
+"""
+所有代理共用的 LLM 调用入口。
+
+    dispatcher = get_dispatcher(base_url, api_key, rate=5, max_concurrency=8)
+    resp = dispatcher.complete(model, messages, response_format={"type": "json_object"})
+    resp = await dispatcher.acomplete(model, messages)
+
+- 同一个 endpoint（base_url + api_key）只建一组 OpenAI 客户端，复用连接池与 keep-alive
+- 每个 endpoint 一个令牌桶（rate 请求/秒）和并发上限（max_concurrency）；
+  并发上限由同步调用（任意线程）与异步调用（任意事件循环）共同计算
+- 连接错误、超时、429 与 5xx 按指数退避 + 随机抖动重试，最多 max_retries 次；每次调用有 timeout。
+  每次尝试（含重试）都重新取令牌，退避等待期间不占并发名额
+- 同时在途的相同请求（模型、消息与参数都相同）只发一次，结果共享
+- 排队耗时（等令牌 + 等并发名额）计入 stats，并以 "llm.queue" 阶段上报埋点
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional
+
+import openai
+
+from instrumentation import instruments
+from rate_limit import TokenBucket
+
+_RETRYABLE = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+class _Slots:
+    """
+    线程与事件循环共用的并发名额：同步调用方阻塞等待，异步调用方挂起等待，
+    合计不超过 limit，按先来后到分配。
+    """
+
+    def __init__(self, limit: int):
+        self._free = limit
+        self._lock = threading.Lock()
+        self._waiters = deque()  # threading.Event（同步）或 (loop, future)（异步）
+
+    def acquire(self):
+        with self._lock:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()  # 释放方直接把名额转交过来
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = waiter in self._waiters
+                if queued:
+                    self._waiters.remove(waiter)
+            if not queued and waiter[1].done() and not waiter[1].cancelled():
+                self.release()  # 名额已转交过来，归还
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._grant, future)
+                    return
+                except RuntimeError:
+                    continue  # 事件循环已关闭
+            self._free += 1
+
+    def _grant(self, future: "asyncio.Future"):
+        if future.cancelled():
+            self.release()  # 等待方在转交途中被取消
+        else:
+            future.set_result(None)
+
+
+class LLMDispatcher:
+    """
+    一个 endpoint 的调度器。client / async_client 可传入已有客户端（如测试用的假服务器），
+    为 None 时按 base_url / api_key 创建；客户端都关闭 SDK 内置重试（传入的客户端用
+    with_options(max_retries=0) 派生一份，共用连接池），由调度器统一重试。
+    异步客户端的连接池绑定创建它的事件循环，自建的异步客户端因此每个事件循环各一个
+    （同一进程内多次 asyncio.run 互不影响）；传入的 async_client 原样使用，由调用方保证只在一个循环中使用。
+    """
+
+    def __init__(self, base_url: Optional[str] = None, api_key: Optional[str] = None,
+                 rate: Optional[float] = None, burst: Optional[float] = None,
+                 max_concurrency: int = 16, max_retries: int = 3, timeout: float = 60.0,
+                 backoff: float = 0.5, max_backoff: float = 8.0,
+                 client: Optional[openai.OpenAI] = None,
+                 async_client: Optional[openai.AsyncOpenAI] = None):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency 至少为 1")
+        self.client = (client.with_options(max_retries=0) if client is not None
+                       else openai.OpenAI(base_url=base_url, api_key=api_key, max_retries=0))
+        self.base_url = base_url
+        self.api_key = api_key
+        self._async_client = async_client.with_options(max_retries=0) if async_client is not None else None
+        self._async_clients: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._slots = _Slots(max_concurrency)
+        self._inflight: Dict[str, Future] = {}
+        self._ainflight: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0, "retries": 0, "failures": 0,
+                      "queue_wait_s": 0.0, "queue_wait_max_s": 0.0}
+
+    # ===== 公共入口 =====
+
+    def complete(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Any:
+        """同步的 chat.completions.create；相同的在途请求共享同一个结果"""
+        key = self._request_key(model, messages, kwargs)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.stats["coalesced"] += 1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(self._call(model, messages, kwargs))
+        except BaseException as exc:
+            future.set_exception(exc)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        return future.result()
+
+    async def acomplete(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Any:
+        """complete 的异步版本"""
+        key = self._request_key(model, messages, kwargs)
+        loop = asyncio.get_running_loop()
+        inflight = self._ainflight.setdefault(loop, {})
+        task = inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            # 请求在独立的任务中执行：发起者被取消时不影响其他等待同一结果的调用方
+            task = inflight[key] = loop.create_task(self._acall(model, messages, kwargs))
+            task.add_done_callback(lambda done: self._afinish(inflight, key, done))
+        return await asyncio.shield(task)
+
+    def stream(self, model: str, messages: List[Dict[str, str]], **kwargs) -> Iterator[Any]:
+        """流式调用：不合并；只在收到第一个分块之前重试；流结束前一直占用并发名额"""
+        stream = self._with_retries(
+            lambda: self.client.chat.completions.create(
+                model=model, messages=messages, stream=True, timeout=self.timeout, **kwargs),
+            keep_slot=True)
+        try:
+            yield from stream
+        finally:
+            self._slots.release()
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        """当前事件循环的异步客户端（需在协程中访问）；循环被回收后其客户端随之释放"""
+        if self._async_client is not None:
+            return self._async_client
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                for closed in [other for other in self._async_clients if other.is_closed()]:
+                    del self._async_clients[closed]
+                client = self._async_clients[loop] = openai.AsyncOpenAI(
+                    base_url=self.base_url, api_key=self.api_key, max_retries=0)
+            return client
+
+    # ===== 内部 =====
+
+    @staticmethod
+    def _afinish(inflight: Dict[str, "asyncio.Task"], key: str, task: "asyncio.Task"):
+        if inflight.get(key) is task:
+            del inflight[key]
+        if not task.cancelled():
+            task.exception()  # 所有调用方都已取消时，避免 "exception was never retrieved" 警告
+
+    @staticmethod
+    def _request_key(model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> str:
+        payload = json.dumps([model, messages, kwargs], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _record_wait(self, wait: float):
+        with self._lock:
+            self.stats["queue_wait_s"] += wait
+            self.stats["queue_wait_max_s"] = max(self.stats["queue_wait_max_s"], wait)
+        instruments.observe("llm.queue", wait)
+
+    def _wait_turn(self):
+        """等令牌与并发名额；返回后调用方持有一个名额。每次尝试（含重试）各调用一次"""
+        start = time.perf_counter()
+        if self.limiter is not None:
+            self.limiter.acquire()
+        self._slots.acquire()
+        self._record_wait(time.perf_counter() - start)
+
+    def _delay(self, attempt: int) -> float:
+        # 全抖动：在 [0, 上限] 内随机，避免大量客户端同时重试
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _with_retries(self, fn, keep_slot: bool = False):
+        """
+        每次尝试前等令牌与名额，失败后先归还名额再退避。
+        keep_slot: 成功时不归还名额，由调用方在用完结果（如读完流）后释放
+        """
+        for attempt in range(self.max_retries + 1):
+            self._wait_turn()
+            try:
+                result = fn()
+            except _RETRYABLE:
+                self._slots.release()
+                if attempt == self.max_retries:
+                    with self._lock:
+                        self.stats["failures"] += 1
+                    raise
+                with self._lock:
+                    self.stats["retries"] += 1
+                time.sleep(self._delay(attempt))
+                continue
+            except BaseException:
+                self._slots.release()
+                raise
+            with self._lock:
+                self.stats["calls"] += 1
+            if not keep_slot:
+                self._slots.release()
+            return result
+
+    def _call(self, model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> Any:
+        return self._with_retries(lambda: self.client.chat.completions.create(
+            model=model, messages=messages, timeout=self.timeout, **kwargs))
+
+    async def _acall(self, model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> Any:
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            if self.limiter is not None:
+                await self.limiter.aacquire()
+            await self._slots.aacquire()
+            self._record_wait(time.perf_counter() - start)
+            try:
+                result = await self.async_client.chat.completions.create(
+                    model=model, messages=messages, timeout=self.timeout, **kwargs)
+            except _RETRYABLE:
+                if attempt == self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+                self.stats["retries"] += 1
+            else:
+                self.stats["calls"] += 1
+                return result
+            finally:
+                self._slots.release()
+            await asyncio.sleep(self._delay(attempt))
+
+
+_registry: Dict[tuple, LLMDispatcher] = {}
+_registry_lock = threading.Lock()
+
+
+def get_dispatcher(base_url: Optional[str] = None, api_key: Optional[str] = None,
+                   **options) -> LLMDispatcher:
+    """
+    返回该 endpoint 的共享调度器（首次调用时按 options 创建，之后的 options 被忽略），
+    同一进程内所有代理经由同一个连接池、令牌桶与并发上限访问同一个 endpoint。
+    """
+    key = (base_url, api_key)
+    with _registry_lock:
+        dispatcher = _registry.get(key)
+        if dispatcher is None:
+            dispatcher = _registry[key] = LLMDispatcher(base_url, api_key, **options)
+        return dispatcher
@@ -26,10 +26,15 @@ print("输入 'tree' 查看记忆树，'exit' 退出。")
 while True:
     user = input("\n你: ").strip()
     if user == "exit":
+        chat.flush()  # 等待后台记忆写入
+        tree.close()
         break
     if user == "tree":
+        chat.flush()  # 上一轮的记忆写入完成后再展示
         print(json.dumps(tree.get_full_tree(), ensure_ascii=False, indent=2))
         continue
     
-    reply = chat.chat(user)
-    print(f"助手: {reply}")
+    print("助手: ", end="", flush=True)
+    for token in chat.chat_stream(user):
+        print(token, end="", flush=True)
+    print()
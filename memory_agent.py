@@ -1,20 +1,312 @@
 # memory_agent.py
+import asyncio
 import openai
 import json
+import hashlib
+import time
+from typing import Optional, List, Dict, Any, Callable, Tuple
 from memory_tree import MemoryTree
+from memory_index import build_index
+from text_index import InvertedIndex
+from memory_filter import LocalMemoryFilter
+from memory_tiers import MemoryTiers
+from llm_cache import LLMCache, make_key, normalize_input
+from instrumentation import instruments
+from llm_dispatcher import LLMDispatcher, get_dispatcher
 
 class MemoryAgent:
-    def __init__(self, tree: MemoryTree, model="qwen3", base_url=None, api_key=None):
+    _SEARCH_CACHE_FORMAT = 2  # 检索缓存条目格式的版本，改变格式时 +1
+
+    def __init__(self, tree: MemoryTree, model="qwen3", base_url=None, api_key=None,
+                 index_type: Optional[str] = "ngram", top_k: int = 20,
+                 skip_llm_threshold: Optional[float] = None,
+                 fused: bool = False, prefilter: bool = True,
+                 cache: Optional[LLMCache] = None,
+                 search_mode: str = "flat", beam_width: int = 2,
+                 branch_selector: str = "local", tiering: bool = False,
+                 prompt_layout: str = "default",
+                 catalog: str = "json", catalog_top_n: Optional[int] = None,
+                 client: Optional[openai.OpenAI] = None,
+                 async_client: Optional[openai.AsyncOpenAI] = None,
+                 dispatcher: Optional[LLMDispatcher] = None):
+        """
+        index_type: 本地检索索引类型（"ngram" | "embedding" | None），
+                    记忆数超过 top_k 时只把得分最高的 top_k 条交给 LLM 精排
+        skip_llm_threshold: 最高得分不低于该值时直接返回本地结果，不调用 LLM
+        fused: 用一次 LLM 调用同时完成“是否记忆”判断与分类
+        prefilter: 在 LLM 之前用本地规则 + 词袋模型拦截明显无需记忆的输入
+        cache: LLM 决策缓存，键包含归一化输入、模型、提示模板与记忆树摘要
+        search_mode: "flat" 把（粗筛后的）全部记忆交给 LLM；
+                     "tree" 从根逐层下钻，每层只保留 beam_width 个最相关分类，
+                     只展开选中的子树，找不到相关分支时退回 flat
+        branch_selector: tree 模式下每层如何选分支：
+                     "local" 用关键词命中得分（沿父链向上传播），不调用 LLM；
+                     "llm" 每层用一次小 LLM 调用，只列出该层的子分类
+        tiering: 按访问频率与最近访问时间分层检索（见 memory_tiers.MemoryTiers，
+                 可通过 self.tiers 调整参数）：hot 记忆每轮直接注入，
+                 LLM 先只看 warm 层候选，没有命中再看 cold 层
+        prompt_layout: "default" 本轮输入在前、分类/记忆列表在后；
+                 "prefix" 把说明、列表与输出格式放在前面、本轮输入放在最后，
+                 本地推理服务（vLLM / Ollama 等）可复用相同前缀的 KV 缓存，
+                 复用潜力见埋点中 LLM 调用的 prefix_tokens
+        catalog: 分类提示中分类列表的格式："json" 为带路径的 JSON 列表；
+                 "compact" 为按层级缩进的 "编号 分类名" 目录（随记忆树缓存），
+                 LLM 返回编号，写入前换回 node_id
+        catalog_top_n: 分类数超过该值时先按本地关键词得分只保留最可能的 top_n 个分类
+                 （连同祖先与根）交给 LLM；None 时总是列出全部分类
+        client / async_client: 传入已有的客户端，为其单独建一个调度器
+        dispatcher: LLM 调度器（限流、重试、合并相同请求）；
+                    都不传时使用该 endpoint 在进程内共享的调度器（见 llm_dispatcher）
+        """
         self.tree = tree
         self.model = model
-        self.client = openai.OpenAI(base_url=base_url, api_key=api_key)
+        if dispatcher is None:
+            if client is None and async_client is None:
+                dispatcher = get_dispatcher(base_url, api_key)
+            else:
+                dispatcher = LLMDispatcher(base_url, api_key, client=client, async_client=async_client)
+        self.dispatcher = dispatcher
+        self.client = dispatcher.client
+        self.top_k = top_k
+        self.skip_llm_threshold = skip_llm_threshold
+        self.index = build_index(tree, index_type)
+        self.fused = fused
+        self.prefilter = LocalMemoryFilter() if prefilter else None
+        self.stats = {
+            "llm_calls": 0,
+            "llm_calls_avoided": 0,   # 预过滤拦截 + 合并调用省下的 LLM 调用
+            "prefilter_skips": 0,
+            "fused_decisions": 0,
+            "tree_searches": 0,
+            "tree_fallbacks": 0,      # 下钻没有找到相关分支、退回扁平检索的次数
+        }
+        if search_mode not in ("flat", "tree"):
+            raise ValueError(f"未知的 search_mode：{search_mode}")
+        if branch_selector not in ("local", "llm"):
+            raise ValueError(f"未知的 branch_selector：{branch_selector}")
+        if prompt_layout not in ("default", "prefix"):
+            raise ValueError(f"未知的 prompt_layout：{prompt_layout}")
+        if catalog not in ("json", "compact"):
+            raise ValueError(f"未知的 catalog：{catalog}")
+        if catalog_top_n is not None and catalog_top_n < 1:
+            raise ValueError("catalog_top_n 至少为 1")
+        self.prompt_layout = prompt_layout
+        self.catalog = catalog
+        self.catalog_top_n = catalog_top_n
+        self.search_mode = search_mode
+        self.beam_width = beam_width
+        self.branch_selector = branch_selector
+        self.cache = cache
+        self.tiers = MemoryTiers(tree) if tiering else None
+        # 提示模板指纹：模板文本改动后旧缓存自动失效
+        self._template_hashes = {
+            kind: hashlib.sha1(repr(fn.__code__.co_consts).encode("utf-8")).hexdigest()
+            for kind, fn in (("remember", MemoryAgent._remember_prompt),
+                             ("fused", MemoryAgent._fused_prompt),
+                             ("search", MemoryAgent._search_prompt),
+                             ("branch", MemoryAgent._branch_prompt))
+        }
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        """当前事件循环的异步客户端（见 LLMDispatcher.async_client）"""
+        return self.dispatcher.async_client
+
+    def _complete_json(self, prompt: str) -> Dict[str, Any]:
+        self.stats["llm_calls"] += 1
+        start = time.perf_counter()
+        resp = self.dispatcher.complete(
+            self.model, [{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"}
+        )
+        content = resp.choices[0].message.content
+        instruments.record_llm_call(prompt, content or "", time.perf_counter() - start, resp.usage)
+        return json.loads(content)
+
+    async def _acomplete_json(self, prompt: str) -> Dict[str, Any]:
+        self.stats["llm_calls"] += 1
+        start = time.perf_counter()
+        resp = await self.dispatcher.acomplete(
+            self.model, [{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"}
+        )
+        content = resp.choices[0].message.content
+        instruments.record_llm_call(prompt, content or "", time.perf_counter() - start, resp.usage)
+        return json.loads(content)
+
+    def _cache_key(self, kind: str, user_input: str, scope: Any = None) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return make_key(kind, normalize_input(user_input), self.model,
+                        self._template_hashes[kind], scope)
+
+    def _cached(self, key: Optional[str], fetch: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """带缓存的调用；fetch 失败时不写缓存"""
+        if key is not None:
+            hit = self.cache.get(key)
+            if hit is not None:
+                return hit
+        result = fetch()
+        if key is not None:
+            self.cache.set(key, result)
+        return result
+
+    async def _acached(self, key: Optional[str], fetch: Callable[[], Any]) -> Dict[str, Any]:
+        if key is not None:
+            hit = self.cache.get(key)
+            if hit is not None:
+                return hit
+        result = await fetch()
+        if key is not None:
+            self.cache.set(key, result)
+        return result
 
+    def _cached_json(self, key: Optional[str], build_prompt: Callable[[], str]) -> Dict[str, Any]:
+        return self._cached(key, lambda: self._complete_json(build_prompt()))
+
+    async def _acached_json(self, key: Optional[str], build_prompt: Callable[[], str]) -> Dict[str, Any]:
+        return await self._acached(key, lambda: self._acomplete_json(build_prompt()))
+
+    def _classify_json(self, build_prompt: Callable, user_input: str) -> Dict[str, Any]:
+        """按当前分类目录构造分类提示并调用 LLM，返回的 target_id 已换回 node_id"""
+        catalog = self._catalog(user_input)
+        return self._resolve_target(self._complete_json(build_prompt(user_input, catalog)), catalog[1])
+
+    async def _aclassify_json(self, build_prompt: Callable, user_input: str) -> Dict[str, Any]:
+        catalog = self._catalog(user_input)
+        return self._resolve_target(await self._acomplete_json(build_prompt(user_input, catalog)),
+                                    catalog[1])
+
+    def remember(self, user_input: str) -> Optional[str]:
+        """
+        记忆写入入口：预过滤 -> 判断（合并模式下同时分类）-> 存储。
+        不需要记忆时返回 None。
+        """
+        decision = self.decide(user_input)
+        if decision is None:
+            return None
+        return self.commit(user_input, decision)
+
+    async def aremember(self, user_input: str) -> Optional[str]:
+        """remember 的异步版本"""
+        decision = await self.adecide(user_input)
+        if decision is None:
+            return None
+        return await self.acommit(user_input, decision)
+
+    @instruments.traced("memory.decide")
+    def decide(self, user_input: str) -> Optional[Dict[str, Any]]:
+        """
+        返回 None 表示不记忆；合并模式下返回的决策已包含分类结果，
+        可直接交给 commit 写入。
+        """
+        if self._prefiltered(user_input):
+            return None
+        if not self.fused:
+            should = self.maybe_remember(user_input)
+            self._learn(user_input, should)
+            return {"should_remember": True} if should else None
+        try:
+            # 缓存的是换回 node_id 之后的决策，与目录编号无关
+            decision = self._cached(
+                self._cache_key("fused", user_input, self.tree.category_digest),
+                lambda: self._classify_json(self._fused_prompt, user_input))
+        except Exception:
+            return None
+        return self._check_fused(user_input, decision)
+
+    @instruments.traced("memory.decide")
+    async def adecide(self, user_input: str) -> Optional[Dict[str, Any]]:
+        """decide 的异步版本"""
+        if self._prefiltered(user_input):
+            return None
+        if not self.fused:
+            should = await self.amaybe_remember(user_input)
+            self._learn(user_input, should)
+            return {"should_remember": True} if should else None
+        try:
+            decision = await self._acached(
+                self._cache_key("fused", user_input, self.tree.category_digest),
+                lambda: self._aclassify_json(self._fused_prompt, user_input))
+        except Exception:
+            return None
+        return self._check_fused(user_input, decision)
+
+    @instruments.traced("memory.commit")
+    def commit(self, user_input: str, decision: Dict[str, Any]) -> str:
+        """写入 decide 返回的决策；非合并模式下此时才调用分类"""
+        if "action" not in decision:
+            return self.classify_and_store(user_input)
+        try:
+            return self.apply_classification(decision)
+        except Exception:
+            return self._store_raw(user_input)
+
+    @instruments.traced("memory.commit")
+    async def acommit(self, user_input: str, decision: Dict[str, Any]) -> str:
+        """commit 的异步版本：写树在线程池中执行，不阻塞事件循环"""
+        if "action" not in decision:
+            return await self.aclassify_and_store(user_input)
+        try:
+            return await asyncio.to_thread(self.apply_classification, decision)
+        except Exception:
+            return await asyncio.to_thread(self._store_raw, user_input)
+
+    def _prefiltered(self, user_input: str) -> bool:
+        if self.prefilter is not None and self.prefilter.should_skip(user_input):
+            self.stats["prefilter_skips"] += 1
+            self.stats["llm_calls_avoided"] += 1
+            return True
+        return False
+
+    def _learn(self, user_input: str, should_remember: bool):
+        # 用 LLM 的判断在线更新本地模型
+        if self.prefilter is not None:
+            self.prefilter.learn(user_input, should_remember)
+
+    def _check_fused(self, user_input: str, decision: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        should = bool(decision.get("should_remember", False))
+        self._learn(user_input, should)
+        if not should:
+            return None
+        self.stats["fused_decisions"] += 1
+        self.stats["llm_calls_avoided"] += 1  # 省掉单独的分类调用
+        return decision
+
+    @instruments.traced("memory.maybe_remember")
     def maybe_remember(self, user_input: str) -> bool:
         """
         让 LLM 判断：这条用户输入是否包含值得长期记忆的信息？
         返回 True 表示应该记忆，False 表示忽略。
         """
-        prompt = f"""
+        try:
+            decision = self._cached_json(self._cache_key("remember", user_input),
+                                         lambda: self._remember_prompt(user_input))
+            return bool(decision.get("should_remember", False))
+        except Exception:
+            return False
+
+    @instruments.traced("memory.maybe_remember")
+    async def amaybe_remember(self, user_input: str) -> bool:
+        """maybe_remember 的异步版本"""
+        try:
+            decision = await self._acached_json(self._cache_key("remember", user_input),
+                                                lambda: self._remember_prompt(user_input))
+            return bool(decision.get("should_remember", False))
+        except Exception:
+            return False
+
+    def _layout(self, intro: str, query: str, listing: str, tail: str) -> str:
+        """
+        拼装提示：intro 为说明，query 为本轮输入，listing 为分类或记忆列表，tail 为输出格式。
+        prefix 布局下只有 query 每轮变化，其余部分在相邻两次调用之间保持为相同的前缀。
+        """
+        if self.prompt_layout == "prefix":
+            return intro + listing + tail + query
+        return intro + query + listing + tail
+
+    def _remember_prompt(self, user_input: str) -> str:
+        return self._layout("""
 你是一个记忆过滤器。请判断以下用户输入是否包含**值得存入长期记忆**的信息。
 
 值得记忆的信息包括：
@@ -27,116 +319,549 @@ class MemoryAgent:
 - 问候语（“你好”、“谢谢”）
 - 临时性对话（“在吗？”、“帮我查一下”）
 - 模糊或无实质信息的句子
-
+""", f"""
 用户输入：
 "{user_input}"
-
+""", "", """
 请严格返回 JSON：
-{{"should_remember": true | false}}
-"""
+{"should_remember": true | false}
+""")
 
+    @instruments.traced("memory.classify_and_store")
+    def classify_and_store(self, user_input: str) -> str:
+        """仅在 should_remember=True 时调用"""
         try:
-            resp = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"}
-            )
-            decision = json.loads(resp.choices[0].message.content)
-            return bool(decision.get("should_remember", False))
+            decision = self._classify_json(self._classify_prompt, user_input)
+            return self.apply_classification(decision)
         except Exception:
-            return False
+            return self._store_raw(user_input)
 
-    def classify_and_store(self, user_input: str) -> str:
-        """仅在 should_remember=True 时调用"""
-        all_categories = self.tree.get_all_nodes_for_classification()
-        
-        prompt = f"""
-你是一个智能记忆路由系统。用户输入了一段**值得记忆**的信息，请决定如何存储。
+    @instruments.traced("memory.classify_and_store")
+    async def aclassify_and_store(self, user_input: str) -> str:
+        """classify_and_store 的异步版本：LLM 调用是异步的，写树在线程池中执行"""
+        try:
+            decision = await self._aclassify_json(self._classify_prompt, user_input)
+            return await asyncio.to_thread(self.apply_classification, decision)
+        except Exception:
+            return await asyncio.to_thread(self._store_raw, user_input)
 
-用户输入：
-"{user_input}"
+    async def aclassify_batch(self, items: List[str]) -> List[Dict[str, Any]]:
+        """
+        一次 LLM 调用判断多条陈述是否值得记忆并分类（批量导入用）。
+        返回值得记忆的条目的分类决定，index 为条目在 items 中从 1 开始的编号；
+        字段已校验并规整，可直接交给 apply_classification，写入时不会因字段类型出错。
+        """
+        # 裁剪分类时按整批条目的内容打分
+        catalog = self._catalog("\n".join(items))
+        result = await self._acomplete_json(self._batch_prompt(items, catalog))
+        entries = result.get("items", []) if isinstance(result, dict) else []
+        decisions = []
+        for entry in entries if isinstance(entries, list) else []:
+            decision = self._batch_decision(entry, items, catalog[1])
+            if decision is not None:
+                decisions.append(decision)
+        return decisions
 
+    def _batch_prompt(self, items: List[str], catalog: Tuple[str, Optional[List[str]]]) -> str:
+        listing, ids = catalog
+        numbered = "\n".join(f"{i + 1}. {item}" for i, item in enumerate(items))
+        return self._layout("""
+你是一个记忆过滤与路由系统。下面是从聊天记录或笔记中导入的多条用户陈述，
+请逐条判断是否包含**值得存入长期记忆**的信息（个人信息、重要经历、偏好习惯、具体事实或计划），
+问候、临时性对话、模糊或无实质信息的内容不记忆；值得记忆的再决定如何存储。
+""", f"""
+待处理条目（编号. 内容）：
+{numbered}
+""", listing, f"""
+请严格返回 JSON，只需列出值得记忆的条目：
+{{
+  "items": [
+    {{
+      "index": 1,
+      "action": "attach" | "create",
+      "target_id": "{self._target_hint(ids)}",
+      "new_category": "新分类名 或 null",
+      "summary": "记忆摘要（<15字）"
+    }}
+  ]
+}}
+""")
+
+    def _batch_decision(self, entry: Any, items: List[str],
+                        ids: Optional[List[str]]) -> Optional[Dict[str, Any]]:
+        """把 LLM 返回的一条结果整理成合法的分类决定，无法使用时返回 None"""
+        if not isinstance(entry, dict):
+            return None
+        index = entry.get("index")
+        if not isinstance(index, int) or isinstance(index, bool) or not 1 <= index <= len(items):
+            return None
+        self._resolve_target(entry, ids)
+        target_id = entry.get("target_id")
+        new_category = entry.get("new_category")
+        summary = entry.get("summary")
+        if not isinstance(new_category, str) or not new_category.strip() or ":" in new_category:
+            new_category = None
+        if not isinstance(summary, str) or not summary.strip():
+            summary = items[index - 1][:50]
+        return {
+            "index": index,
+            "action": "create" if entry.get("action") == "create" and new_category else "attach",
+            "target_id": target_id if isinstance(target_id, str) else None,
+            "new_category": new_category.strip() if new_category else None,
+            "summary": summary,
+        }
+
+    def _catalog(self, text: Optional[str]) -> Tuple[str, Optional[List[str]]]:
+        """
+        分类提示中的分类列表部分，以及编号 -> node_id 表（json 格式下为 None，LLM 直接返回 node_id）。
+        text 为本次待分类的内容，用于本地裁剪；为 None 时不裁剪。
+        """
+        keep = self._plausible_categories(text) if text is not None else None
+        if self.catalog == "compact":
+            catalog, ids = self.tree.get_category_catalog(keep)
+            return f"""
+可用的分类（编号 分类名，缩进表示层级，0 为根）：
+{catalog}
+""", ids
+        all_categories = self.tree.get_all_nodes_for_classification()
+        if keep is not None:
+            keep = set(keep)
+            all_categories = [c for c in all_categories if c["node_id"] in keep]
+        return f"""
 可用的分类路径：
 {json.dumps(all_categories, ensure_ascii=False, indent=2)}
+""", None
 
+    def _plausible_categories(self, text: str) -> Optional[List[str]]:
+        """
+        分类数超过 catalog_top_n 时，按关键词命中得分（沿父链向上传播）取前 top_n 个分类，
+        命中不足时按目录顺序补足；根总是保留。不需要裁剪时返回 None。
+        """
+        if self.catalog_top_n is None:
+            return None
+        categories = self.tree.get_all_nodes_for_classification()
+        if len(categories) <= self.catalog_top_n + 1:
+            return None
+        scores = self.tree.branch_scores(text)
+        ids = [c["node_id"] for c in categories if c["node_id"] != "root"]
+        chosen = sorted((i for i in ids if scores.get(i, 0.0) > 0), key=lambda i: -scores[i])
+        chosen = chosen[:self.catalog_top_n]
+        if len(chosen) < self.catalog_top_n:
+            picked = set(chosen)
+            chosen += [i for i in ids if i not in picked][:self.catalog_top_n - len(chosen)]
+        return ["root"] + chosen
+
+    def _resolve_target(self, decision: Dict[str, Any], ids: Optional[List[str]]) -> Dict[str, Any]:
+        """
+        紧凑目录下 LLM 返回的是分类编号：用构造提示时的编号表换回 node_id，越界的编号视为 null。
+        等待 LLM 期间分类视图可能已重建（catalog_version 变化、分类被合并删除），
+        换回的分类不在树中时同样视为 null。
+        """
+        target = decision.get("target_id")
+        if ids is not None and isinstance(target, (int, str)) and not isinstance(target, bool) \
+                and str(target).strip().isdigit():
+            index = int(str(target).strip())
+            node_id = ids[index] if index < len(ids) else None
+            decision["target_id"] = node_id if node_id in self.tree.nodes else None
+        return decision
+
+    def _target_hint(self, ids: Optional[List[str]]) -> str:
+        return "分类编号 或 null" if ids is not None else "node_id 或 null"
+
+    def _classify_prompt(self, user_input: str, catalog: Tuple[str, Optional[List[str]]]) -> str:
+        listing, ids = catalog
+
+        return self._layout("""
+你是一个智能记忆路由系统。用户输入了一段**值得记忆**的信息，请决定如何存储。
+""", f"""
+用户输入：
+"{user_input}"
+""", listing, f"""
 请返回 JSON：
 {{
   "action": "attach" | "create",
-  "target_id": "node_id 或 null",
+  "target_id": "{self._target_hint(ids)}",
   "new_category": "新分类名 或 null",
   "summary": "记忆摘要（<15字）"
 }}
-"""
+""")
 
-        try:
-            resp = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"}
-            )
-            decision = json.loads(resp.choices[0].message.content)
+    def _fused_prompt(self, user_input: str, catalog: Tuple[str, Optional[List[str]]]) -> str:
+        listing, ids = catalog
 
+        return self._layout("""
+你是一个记忆过滤与路由系统。请先判断用户输入是否包含**值得存入长期记忆**的信息，
+如果值得，再决定如何存储。
+
+值得记忆的信息包括：
+- 个人信息（姓名、年龄、住址、联系方式等）
+- 重要经历（项目、旅行、学习、工作等）
+- 偏好与习惯（喜欢的食物、运动、书籍等）
+- 具体事实或计划（“我下周去上海”、“我买了 MacBook”）
+
+不值得记忆的内容：
+- 问候语（“你好”、“谢谢”）
+- 临时性对话（“在吗？”、“帮我查一下”）
+- 模糊或无实质信息的句子
+""", f"""
+用户输入：
+"{user_input}"
+""", listing, f"""
+请严格返回 JSON：
+{{
+  "should_remember": true | false,
+  "action": "attach" | "create" | null,
+  "target_id": "{self._target_hint(ids)}",
+  "new_category": "新分类名 或 null",
+  "summary": "记忆摘要（<15字） 或 null"
+}}
+""")
+
+    def apply_classification(self, decision: Dict[str, Any]) -> str:
+        """
+        按分类决定写入一条记忆（action / target_id / new_category / summary）。
+        建分类与挂记忆作为一个整体提交，并发写入时不会看到只建了分类的中间状态
+        """
+        with self.tree.transaction():
             if decision["action"] == "create" and decision.get("new_category"):
                 parent_id = "root"
                 new_id = self.tree.create_subcategory(parent_id, decision["new_category"])
-                final_id = self.tree.add_memory(decision["summary"], new_id)
+                if new_id not in self.tree.nodes:
+                    # 分类已存在（可能刚被其他线程创建）：直接挂到该分类下
+                    new_id = f"{parent_id}:{decision['new_category']}"
+                self._store(decision["summary"], new_id)
             else:
                 target_id = decision.get("target_id") or "root"
                 if target_id not in self.tree.nodes:
                     target_id = "root"
-                final_id = self.tree.add_memory(decision["summary"], target_id)
+                self._store(decision["summary"], target_id)
+        return f"记忆已存：{decision['summary']}"
 
-            self.tree.nodes[final_id].touch()
-            return f"记忆已存：{decision['summary']}"
-        except Exception:
-            final_id = self.tree.add_memory(f"[原始] {user_input}", "root")
-            self.tree.nodes[final_id].touch()
-            return f"记忆已存（默认）：{user_input[:20]}..."
+    def _store_raw(self, user_input: str) -> str:
+        self._store(f"[原始] {user_input}", "root")
+        return f"记忆已存（默认）：{user_input[:20]}..."
 
+    def _store(self, content: str, parent_id: str) -> str:
+        """写入一条记忆并记一次访问；去重合并到已有记忆时 add_memory 已经记过，不再重复计数"""
+        with self.tree.transaction():
+            merged = self.tree.dedup_stats["merged_on_insert"]
+            final_id = self.tree.add_memory(content, parent_id)
+            if self.tree.dedup_stats["merged_on_insert"] == merged:
+                self.tree.nodes[final_id].touch()
+        return final_id
+
+    @instruments.traced("memory.search_memory")
     def search_memory(self, query: str) -> str:
         """
         使用 LLM 从扁平化的记忆视图中检索最相关内容。
+        启用分层时 hot 记忆直接注入，候选先在 warm 层选择，没有命中才看 cold 层。
+        检索期间固定已加载的分片，避免收集到的命中在取内容前被卸载。
+        """
+        with self.tree.pin_shards():
+            return self._search_memory(query)
+
+    def _search_memory(self, query: str) -> str:
+        key = self._search_cache_key(query)
+        if key is not None:
+            hit = self.cache.get(key)
+            if hit is not None:
+                return self._cached_answer(hit)
+
+        if self.search_mode == "tree":
+            flat_memories, answer = self._tree_candidates(query)
+        else:
+            flat_memories, answer = self._search_candidates(query)
+        if answer is not None:
+            return self._answer(flat_memories, answer)
+
+        selected = []
+        for group in self._tier_groups(flat_memories):
+            try:
+                result = self._complete_json(self._search_prompt(query, group))
+            except Exception:
+                return self._with_hot([], "无相关记忆。")
+            selected = self._selected_entries(result, group)
+            if selected:
+                break
+        return self._answer(selected, self._format_entries(selected), key)
+
+    @instruments.traced("memory.search_memory")
+    async def asearch_memory(self, query: str) -> str:
+        """search_memory 的异步版本"""
+        with self.tree.pin_shards():
+            return await self._asearch_memory(query)
+
+    async def _asearch_memory(self, query: str) -> str:
+        key = self._search_cache_key(query)
+        if key is not None:
+            hit = self.cache.get(key)
+            if hit is not None:
+                return self._cached_answer(hit)
+
+        if self.search_mode == "tree":
+            flat_memories, answer = await self._atree_candidates(query)
+        else:
+            flat_memories, answer = self._search_candidates(query)
+        if answer is not None:
+            return self._answer(flat_memories, answer)
+
+        selected = []
+        for group in self._tier_groups(flat_memories):
+            try:
+                result = await self._acomplete_json(self._search_prompt(query, group))
+            except Exception:
+                return self._with_hot([], "无相关记忆。")
+            selected = self._selected_entries(result, group)
+            if selected:
+                break
+        return self._answer(selected, self._format_entries(selected), key)
+
+    def _tier_groups(self, flat_memories: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+        """交给 LLM 的候选分组：不分层时只有一组；分层时依次为 warm、cold（hot 已直接注入）"""
+        if self.tiers is None:
+            return [flat_memories]
+        return self.tiers.split(flat_memories)
+
+    def _answer(self, selected: List[Dict[str, str]], text: str, key: Optional[str] = None) -> str:
+        """记录命中记忆的访问，写缓存，并在启用分层时加上 hot 记忆"""
+        node_ids = [entry["node_id"] for entry in selected]
+        if node_ids:
+            self.tree.touch(node_ids)
+        if key is not None:
+            self.cache.set(key, {"node_ids": node_ids, "answer": text})
+        return self._with_hot(node_ids, text)
+
+    def _cached_answer(self, hit: Dict[str, Any]) -> str:
+        if hit["node_ids"]:
+            self.tree.touch(hit["node_ids"])
+        return self._with_hot(hit["node_ids"], hit["answer"])
+
+    def _with_hot(self, node_ids: List[str], text: str) -> str:
+        if self.tiers is None:
+            return text
+        selected = set(node_ids)
+        hot = [entry for entry in self.tiers.hot_entries() if entry["node_id"] not in selected]
+        if not hot:
+            return text
+        hot_text = self._format_entries(hot)
+        return hot_text if text == "无相关记忆。" else hot_text + "\n" + text
+
+    def _search_cache_key(self, query: str) -> Optional[str]:
+        # 检索结果只依赖记忆内容与粗筛参数，分类变化不影响；
+        # 条目格式为 {"answer", "node_ids"}，版本号变化后旧格式的条目自然失效
+        scope = (self._SEARCH_CACHE_FORMAT, self.tree.memory_digest, self.top_k, self.skip_llm_threshold)
+        if self.search_mode == "tree":
+            # 下钻路径依赖分类结构
+            scope += (self.tree.category_digest, self.beam_width, self.branch_selector)
+        if self.tiers is not None:
+            scope += (self.tiers.digest,)
+        return self._cache_key("search", query, scope)
+
+    def _search_candidates(self, query: str):
+        """
+        返回 (候选记忆, 直接答案)。
+        直接答案不为 None 时无需调用 LLM（无记忆或本地高置信命中）。
         """
         flat_memories = self.tree.get_flat_memory_view()
         
         if not flat_memories:
-            return "无相关记忆。"
+            return flat_memories, "无相关记忆。"
+
+        # 记忆较多时先用本地索引粗筛，只把候选交给 LLM
+        if self.index is not None and (len(flat_memories) > self.top_k
+                                       or self.skip_llm_threshold is not None):
+            with self.tree.lock.read():  # 索引随写入增量更新，查询时不能与写入交错
+                hits = self.index.search(query, self.top_k)
+            if self.skip_llm_threshold is not None and hits \
+                    and hits[0][1] >= self.skip_llm_threshold:
+                confident = self.tree.get_memory_entries(
+                    node_id for node_id, score in hits[:2] if score >= self.skip_llm_threshold)
+                return confident, self._format_entries(confident)
+            if len(flat_memories) > self.top_k:
+                # 保持记忆库原有顺序
+                flat_memories = self.tree.get_memory_entries(node_id for node_id, _ in hits)
+                if not flat_memories:
+                    return flat_memories, "无相关记忆。"
+        return flat_memories, None
+
+    def _tree_candidates(self, query: str):
+        """tree 模式的 _search_candidates：逐层下钻，只展开选中的子树"""
+        if not self.tree.memory_count:
+            return [], "无相关记忆。"
+        self.stats["tree_searches"] += 1
+        # llm 选择分支时不需要全树得分（懒加载模式下也就不会加载全部分片）
+        scores = self.tree.branch_scores(query) if self.branch_selector == "local" else None
+        walk = self._tree_walk()
+        try:
+            categories = next(walk)
+            while True:
+                if self.branch_selector == "llm":
+                    chosen = self._choose_branches(query, categories)
+                else:
+                    chosen = self._rank_branches(categories, scores)
+                categories = walk.send(chosen)
+        except StopIteration as stop:
+            memory_ids = stop.value
+        except Exception:
+            memory_ids = None
+        return self._tree_result(query, memory_ids, scores)
+
+    async def _atree_candidates(self, query: str):
+        """_tree_candidates 的异步版本（branch_selector="llm" 时每层的选择是异步调用）"""
+        if not self.tree.memory_count:
+            return [], "无相关记忆。"
+        self.stats["tree_searches"] += 1
+        # llm 选择分支时不需要全树得分（懒加载模式下也就不会加载全部分片）
+        scores = self.tree.branch_scores(query) if self.branch_selector == "local" else None
+        walk = self._tree_walk()
+        try:
+            categories = next(walk)
+            while True:
+                if self.branch_selector == "llm":
+                    chosen = await self._achoose_branches(query, categories)
+                else:
+                    chosen = self._rank_branches(categories, scores)
+                categories = walk.send(chosen)
+        except StopIteration as stop:
+            memory_ids = stop.value
+        except Exception:
+            memory_ids = None
+        return self._tree_result(query, memory_ids, scores)
+
+    def _tree_walk(self):
+        """
+        从根逐层下钻的生成器：yield 本层的候选分类，调用方 send 回选中的分类。
+        沿途收集所经分类下的记忆；某层没有选中任何分类时展开上一层所选分类的整棵子树。
+        返回记忆节点 id 列表；第一层就没有相关分类时返回 None（退回扁平检索）。
+        """
+        frontier = [self.tree.root]
+        memory_ids: List[str] = []
+        depth = 0
+        while True:
+            categories = []
+            for node in frontier:
+                self.tree.materialize(node.id)
+                for child in node.children.values():
+                    if child.name == "记忆":
+                        memory_ids.append(child.id)
+                    else:
+                        categories.append(child)
+            if not categories:
+                return memory_ids
+            chosen = yield categories
+            if not chosen:
+                if depth == 0:
+                    return None
+                # 命中的是所选分类本身（而非某个子分类），整棵子树都相关
+                stack = list(categories)
+                while stack:
+                    node = stack.pop()
+                    self.tree.materialize(node.id)
+                    for child in node.children.values():
+                        if child.name == "记忆":
+                            memory_ids.append(child.id)
+                        else:
+                            stack.append(child)
+                return memory_ids
+            frontier = chosen
+            depth += 1
+
+    def _rank_branches(self, categories: list, scores: Dict[str, float]) -> list:
+        ranked = sorted((c for c in categories if scores.get(c.id, 0.0) > 0),
+                        key=lambda c: -scores[c.id])
+        return ranked[:self.beam_width]
+
+    def _choose_branches(self, query: str, categories: list) -> list:
+        key = self._cache_key("branch", query, (self.tree.category_digest, self.beam_width,
+                                                [c.id for c in categories]))
+        result = self._cached_json(key, lambda: self._branch_prompt(query, categories))
+        return self._selected_branches(result, categories)
+
+    async def _achoose_branches(self, query: str, categories: list) -> list:
+        key = self._cache_key("branch", query, (self.tree.category_digest, self.beam_width,
+                                                [c.id for c in categories]))
+        result = await self._acached_json(key, lambda: self._branch_prompt(query, categories))
+        return self._selected_branches(result, categories)
+
+    def _branch_prompt(self, query: str, categories: list) -> str:
+        options = "\n".join(
+            f"{i+1}. {self.tree.get_memory_path(c.id)}" for i, c in enumerate(categories)
+        )
+        return self._layout(f"""
+你是一个记忆检索导航助手。用户的问题可能与下列哪些分类中的记忆有关？最多选择 {self.beam_width} 个。
+""", f"""
+用户问题：
+"{query}"
+""", f"""
+分类（编号. 路径）：
+{options}
+""", """
+请返回 JSON：
+{"selected": [1, 2]}  // 选中的编号列表，从1开始，按相关度排序
+如果都无关，返回：{"selected": []}
+""")
 
-        # 构造紧凑的 key-value 列表
+    def _selected_branches(self, result: Dict[str, Any], categories: list) -> list:
+        chosen = []
+        for idx in result.get("selected", []):
+            if isinstance(idx, int) and 1 <= idx <= len(categories) \
+                    and categories[idx - 1] not in chosen:
+                chosen.append(categories[idx - 1])
+        return chosen[:self.beam_width]
+
+    def _tree_result(self, query: str, memory_ids: Optional[List[str]],
+                     scores: Optional[Dict[str, float]]):
+        if memory_ids and len(memory_ids) > self.top_k:
+            # 选中的子树仍然很大：按关键词得分保留 top_k
+            if scores is None:
+                scores = self._subtree_scores(query, memory_ids)
+            memory_ids = sorted(memory_ids, key=lambda i: -scores.get(i, 0.0))[:self.top_k]
+        entries = self.tree.get_memory_entries(memory_ids) if memory_ids else []
+        if not entries:
+            self.stats["tree_fallbacks"] += 1
+            return self._search_candidates(query)
+        return entries, None
+
+    def _subtree_scores(self, query: str, memory_ids: List[str]) -> Dict[str, float]:
+        """只对选中子树内的记忆做 BM25 打分"""
+        index = InvertedIndex()
+        for node_id in memory_ids:
+            node = self.tree.nodes.get(node_id)
+            if node is not None:
+                index.add(node_id, node.content)
+        return dict(index.search(query))
+
+    def _search_prompt(self, query: str, flat_memories: List[Dict[str, str]]) -> str:
+        # 构造紧凑的 key-value 列表（记忆按写入顺序排列，新记忆只追加在末尾）
         memories_text = "\n".join([
             f"{i+1}. [{entry['path']}] {entry['content']}"
             for i, entry in enumerate(flat_memories)
         ])
 
-        prompt = f"""
+        return self._layout("""
 你是一个智能记忆助手。请根据用户的问题，从以下记忆库中选择**最相关的1-2条**信息。
-
+""", f"""
 用户问题：
 "{query}"
-
+""", f"""
 记忆库（编号. [路径] 内容）：
 {memories_text}
-
+""", """
 请返回 JSON：
-{{"selected": [1, 3]}}  // 选中的编号列表，从1开始
-如果无相关记忆，返回：{{"selected": []}}
-"""
+{"selected": [1, 3]}  // 选中的编号列表，从1开始
+如果无相关记忆，返回：{"selected": []}
+""")
 
-        try:
-            resp = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"}
-            )
-            result = json.loads(resp.choices[0].message.content)
-            indices = result.get("selected", [])
-            
-            snippets = []
-            for idx in indices:
-                if 1 <= idx <= len(flat_memories):
-                    entry = flat_memories[idx - 1]
-                    snippets.append(f"{entry['path']}: {entry['content']}")
-            
-            return "\n".join(snippets) if snippets else "无相关记忆。"
-        except Exception:
-            return "无相关记忆。"
\ No newline at end of file
+    @staticmethod
+    def _selected_entries(result: Dict[str, Any], flat_memories: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        selected = []
+        for idx in result.get("selected", []):
+            if isinstance(idx, int) and 1 <= idx <= len(flat_memories) \
+                    and flat_memories[idx - 1] not in selected:
+                selected.append(flat_memories[idx - 1])
+        return selected
+
+    @staticmethod
+    def _format_entries(entries: List[Dict[str, str]]) -> str:
+        snippets = [f"{entry['path']}: {entry['content']}" for entry in entries]
+        return "\n".join(snippets) if snippets else "无相关记忆。"
@@ -0,0 +1,115 @@
+# memory_dedup.py
+import zlib
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+
+from llm_cache import normalize_input
+
+_PRIME = 4294967291  # 小于 2^32 的最大素数，签名可以用 uint32 存放
+_MAX_HASH = np.uint64(_PRIME)
+
+
+def shingles(text: str) -> FrozenSet[str]:
+    """归一化后取字符二元组；中文短句也能得到足够的特征"""
+    text = normalize_input(text).replace(" ", "")
+    if len(text) < 2:
+        return frozenset([text]) if text else frozenset()
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHashLSH:
+    """
+    MinHash + LSH 近似去重索引，只在同一分类（parent_id）内查找。
+    num_perm 个哈希函数分成 bands 段，任一段完全相同即为候选，
+    再用字符二元组的精确 Jaccard 相似度确认，避免误合并。
+    索引只保存分桶，不保存签名或特征，确认时从记忆内容现算。
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 32, bands: int = 8, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm 必须能被 bands 整除")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.RandomState(seed)
+        # a < 2^31、特征哈希取 31 位，乘积不会溢出 uint64
+        self._a = rng.randint(1, 2 ** 31 - 1, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, 2 ** 31 - 1, size=num_perm).astype(np.uint64)
+        self._buckets: Dict[int, List[str]] = {}
+
+    def signature(self, features: FrozenSet[str]) -> np.ndarray:
+        if not features:
+            return np.full(len(self._a), _MAX_HASH, dtype=np.uint64)
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) & 0x7FFFFFFF for f in features),
+                             dtype=np.uint64, count=len(features))
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _MAX_HASH).min(axis=1)
+
+    def _bucket_keys(self, parent_id: str, features: FrozenSet[str]) -> List[int]:
+        sig = self.signature(features)
+        return [hash((parent_id, band, sig[band * self.rows:(band + 1) * self.rows].tobytes()))
+                for band in range(self.bands)]
+
+    def add(self, node_id: str, parent_id: str, content: str):
+        for key in self._bucket_keys(parent_id, shingles(content)):
+            self._buckets.setdefault(key, []).append(node_id)
+
+    def remove(self, node_id: str, parent_id: str, content: str):
+        for key in self._bucket_keys(parent_id, shingles(content)):
+            bucket = self._buckets.get(key)
+            if bucket and node_id in bucket:
+                bucket.remove(node_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def find(self, parent_id: str, content: str,
+             get_content: Callable[[str], Optional[str]]) -> Optional[Tuple[str, float]]:
+        """
+        返回同一分类下与 content 最相似且不低于阈值的记忆 (node_id, 相似度)。
+        get_content 按 id 取候选记忆的当前内容，已不存在时返回 None。
+        """
+        features = shingles(content)
+        candidates = set()
+        for key in self._bucket_keys(parent_id, features):
+            candidates.update(self._buckets.get(key, ()))
+        best = None
+        for node_id in candidates:
+            other = get_content(node_id)
+            if other is None:
+                continue
+            score = jaccard(features, shingles(other))
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (node_id, score)
+        return best
+
+
+def main():
+    """离线合并已有记忆树中的近似重复记忆：python memory_dedup.py memory_tree.json --storage journal"""
+    import argparse
+    import json
+
+    from memory_tree import MemoryTree
+
+    parser = argparse.ArgumentParser(description="合并各分类内的近似重复记忆")
+    parser.add_argument("tree", nargs="?", default="memory_tree.json")
+    parser.add_argument("--schema", default="schema.json")
+    parser.add_argument("--storage", default="json", choices=("json", "journal", "sqlite", "sharded"))
+    parser.add_argument("--threshold", type=float, default=0.8, help="字符二元组 Jaccard 相似度阈值")
+    args = parser.parse_args()
+
+    tree = MemoryTree(args.schema, args.tree, storage=args.storage)
+    try:
+        report = tree.consolidate(args.threshold)
+    finally:
+        tree.close()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# memory_filter.py
+import math
+import re
+from collections import Counter
+from typing import Dict
+from text_index import tokenize
+
+# 整句只由这些寒暄/应答构成时一定不值得记忆
+_CHITCHAT_RE = re.compile(
+    r"^(你好|您好|嗨|哈喽|早上好|晚上好|晚安|谢谢|谢谢你|多谢|感谢|好的|好|行|可以|嗯+|哦+|啊+|哈+|呵+|"
+    r"ok|okay|hi|hello|hey|thanks|thank you|thx|bye|再见|拜拜|在吗|在不在|是的|对|没事|没有|不用了)"
+    r"[\s,，.。!！?？~～…]*$",
+    re.IGNORECASE,
+)
+
+# 词袋模型的种子样本，运行中会继续用 LLM 的判断结果在线学习
+_SEED_NEGATIVE = [
+    "你好", "谢谢", "在吗", "帮我查一下", "你是谁", "今天天气怎么样", "讲个笑话",
+    "你能做什么", "继续", "再说一遍", "什么意思", "我叫什么", "我住在哪里",
+    "我喜欢什么", "你还记得吗", "帮我写一段代码", "翻译一下这句话",
+]
+_SEED_POSITIVE = [
+    "我叫张三", "我住在上海", "我喜欢打篮球", "我的生日是五月一号", "我在做一个AI项目",
+    "我下周去北京出差", "我买了一台MacBook", "我的电话是13800000000", "我对花生过敏",
+    "我在阿里巴巴工作", "我最近在读三体", "我女儿今年五岁",
+]
+
+
+class LocalMemoryFilter:
+    """
+    本地预过滤器：规则 + 朴素贝叶斯词袋模型。
+    只在“明显不值得记忆”时返回 True，拿不准的一律交给 LLM。
+    """
+
+    def __init__(self, skip_threshold: float = 0.95, min_length: int = 2):
+        self.skip_threshold = skip_threshold
+        self.min_length = min_length
+        self._counts: Dict[bool, Counter] = {True: Counter(), False: Counter()}
+        self._docs: Dict[bool, int] = {True: 0, False: 0}
+        for text in _SEED_POSITIVE:
+            self.learn(text, True)
+        for text in _SEED_NEGATIVE:
+            self.learn(text, False)
+
+    def learn(self, text: str, should_remember: bool):
+        """用一条已知标签（通常来自 LLM 判断）更新词袋模型"""
+        self._counts[should_remember].update(tokenize(text))
+        self._docs[should_remember] += 1
+
+    def remember_probability(self, text: str) -> float:
+        tokens = tokenize(text)
+        vocab = len(set(self._counts[True]) | set(self._counts[False])) or 1
+        total_docs = self._docs[True] + self._docs[False]
+        log_probs = {}
+        for label in (True, False):
+            counts = self._counts[label]
+            total = sum(counts.values())
+            log_p = math.log((self._docs[label] + 1) / (total_docs + 2))
+            for token in tokens:
+                log_p += math.log((counts[token] + 1) / (total + vocab))
+            log_probs[label] = log_p
+        diff = log_probs[False] - log_probs[True]
+        if diff > 50:
+            return 0.0
+        return 1.0 / (1.0 + math.exp(diff))
+
+    def should_skip(self, text: str) -> bool:
+        text = text.strip()
+        if len(text) < self.min_length or _CHITCHAT_RE.match(text):
+            return True
+        if not tokenize(text):
+            # 只有标点、表情等
+            return True
+        return 1.0 - self.remember_probability(text) >= self.skip_threshold
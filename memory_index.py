@@ -0,0 +1,200 @@
+# memory_index.py
+import math
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class VectorIndex:
+    """
+    本地稠密向量索引：每条记忆一行，查询时一次矩阵乘法给所有记忆打分。
+    通过 MemoryTree 的监听器与记忆树保持同步。
+    子类实现 _encode 将文本转换为向量。
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.node_ids: List[Optional[str]] = []  # 已删除的行为 None
+        self._positions: Dict[str, int] = {}
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+
+    def attach(self, tree) -> "VectorIndex":
+        """用现有记忆建立索引，并订阅之后的新增与删除"""
+        for entry in tree.get_flat_memory_view():
+            self.add(entry["node_id"], f"{entry['path']} {entry['content']}")
+        tree.add_listener(self._on_node_added, on_remove=self._on_node_removed)
+        return self
+
+    def _on_node_added(self, tree, node):
+        if node.name == "记忆" and node.content.strip():
+            self.add(node.id, f"{tree.get_memory_path(node.id)} {node.content.strip()}")
+
+    def _on_node_removed(self, tree, node):
+        self.remove(node.id)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def _encode_query(self, text: str) -> np.ndarray:
+        return self._encode([text])[0]
+
+    def _append_row(self, node_id: str, row: np.ndarray):
+        if node_id in self._positions:
+            self._matrix[self._positions[node_id]] = row
+            return
+        n = len(self.node_ids)
+        if n >= self._matrix.shape[0]:
+            # 容量翻倍，摊还 O(1) 追加
+            grown = np.zeros((max(16, n * 2), self.dim), dtype=np.float32)
+            grown[:n] = self._matrix[:n]
+            self._matrix = grown
+        self._matrix[n] = row
+        self._positions[node_id] = n
+        self.node_ids.append(node_id)
+
+    def add(self, node_id: str, text: str):
+        self._append_row(node_id, self._encode([text])[0])
+
+    def remove(self, node_id: str) -> Optional[int]:
+        """
+        删除一条记忆：该行清零并留空，返回原行号。
+        空行多于存活行时压缩（分片反复卸载/加载时矩阵不会无限增长）
+        """
+        pos = self._positions.pop(node_id, None)
+        if pos is not None:
+            self._matrix[pos] = 0
+            self.node_ids[pos] = None
+            if len(self.node_ids) - len(self._positions) > max(16, len(self._positions)):
+                self._compact()
+        return pos
+
+    def _compact(self) -> List[int]:
+        """去掉已删除的行并重排行号，返回保留下来的原行号；摊还 O(1)"""
+        live = [i for i, node_id in enumerate(self.node_ids) if node_id is not None]
+        self._matrix = self._matrix[live]
+        self.node_ids = [self.node_ids[i] for i in live]
+        self._positions = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        return live
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        """返回余弦相似度最高的 k 条 (node_id, score)"""
+        n = len(self.node_ids)
+        if not self._positions or k <= 0:
+            return []
+        q = self._encode_query(query)
+        scores = self._matrix[:n] @ q
+        k = min(k, len(self._positions))
+        take = min(k + n - len(self._positions), n)  # 多取已删除的行数，过滤后仍有 k 条
+        top = np.argpartition(-scores, take - 1)[:take]
+        top = top[np.argsort(-scores[top])]
+        hits = [(self.node_ids[i], float(scores[i])) for i in top if self.node_ids[i] is not None]
+        return hits[:k]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class HashedNgramIndex(VectorIndex):
+    """
+    字符 n-gram 哈希 + TF-IDF。不依赖分词，对中文同样有效。
+    IDF 随记忆增长而变化：记忆数翻倍时按当前 IDF 重新加权全部行。
+    """
+
+    def __init__(self, dim: int = 1024, ngram_range: Tuple[int, int] = (1, 3)):
+        super().__init__(dim)
+        self.ngram_range = ngram_range
+        self._raw: List[Dict[int, float]] = []  # 每行的原始 tf，用于重新加权
+        self._df = np.zeros(dim, dtype=np.float64)
+        self._built_size = 0
+
+    def _hashed_tf(self, text: str) -> Dict[int, float]:
+        text = "".join(text.lower().split())
+        counts = Counter()
+        lo, hi = self.ngram_range
+        for n in range(lo, hi + 1):
+            for i in range(len(text) - n + 1):
+                counts[zlib.crc32(text[i:i + n].encode("utf-8")) % self.dim] += 1
+        # 次线性 tf
+        return {b: 1.0 + math.log(c) for b, c in counts.items()}
+
+    def _idf(self) -> np.ndarray:
+        n = len(self._positions)
+        return np.log((1.0 + n) / (1.0 + self._df)) + 1.0
+
+    def _weighted(self, tf: Dict[int, float], idf: np.ndarray) -> np.ndarray:
+        row = np.zeros(self.dim, dtype=np.float32)
+        if tf:
+            buckets = np.fromiter(tf.keys(), dtype=np.int64)
+            row[buckets] = np.fromiter(tf.values(), dtype=np.float32) * idf[buckets]
+        return _normalize(row)
+
+    def add(self, node_id: str, text: str):
+        tf = self._hashed_tf(text)
+        if node_id in self._positions:
+            old = self._raw[self._positions[node_id]]
+            self._df[list(old.keys())] -= 1
+            self._raw[self._positions[node_id]] = tf
+        else:
+            self._raw.append(tf)
+        self._df[list(tf.keys())] += 1
+        self._append_row(node_id, self._weighted(tf, self._idf()))
+        if len(self.node_ids) >= max(16, self._built_size * 2):
+            self._reweight()
+
+    def remove(self, node_id: str) -> Optional[int]:
+        # 先更新 df：父类删除时可能压缩，之后行号不再有效
+        pos = self._positions.get(node_id)
+        if pos is not None:
+            self._df[list(self._raw[pos].keys())] -= 1
+            self._raw[pos] = {}
+        return super().remove(node_id)
+
+    def _compact(self) -> List[int]:
+        live = super()._compact()
+        self._raw = [self._raw[i] for i in live]
+        self._built_size = min(self._built_size, len(live))
+        return live
+
+    def _reweight(self):
+        idf = self._idf()
+        for i, tf in enumerate(self._raw):
+            self._matrix[i] = self._weighted(tf, idf)
+        self._built_size = len(self.node_ids)
+
+    def _encode_query(self, text: str) -> np.ndarray:
+        return self._weighted(self._hashed_tf(text), self._idf())
+
+
+class EmbeddingIndex(VectorIndex):
+    """基于本地 embedding 模型（sentence-transformers，可选依赖）"""
+
+    def __init__(self, model_name: str = "BAAI/bge-small-zh-v1.5"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("embedding 索引需要安装 sentence-transformers")
+        self.model = SentenceTransformer(model_name)
+        super().__init__(self.model.get_sentence_embedding_dimension())
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, convert_to_numpy=True)
+        return _normalize(vectors.astype(np.float32))
+
+
+def build_index(tree, index_type: Optional[str] = "ngram") -> Optional[VectorIndex]:
+    """按类型创建索引并挂到记忆树上；index_type 为 None 时不使用索引"""
+    if index_type is None:
+        return None
+    if index_type == "ngram":
+        return HashedNgramIndex().attach(tree)
+    if index_type == "embedding":
+        return EmbeddingIndex().attach(tree)
+    raise ValueError(f"不支持的索引类型: {index_type}")
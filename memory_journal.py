@@ -0,0 +1,112 @@
+# memory_journal.py
+import json
+import os
+import threading
+from typing import Dict, Any, Iterator, List
+
+
+class MemoryJournal:
+    """
+    追加式变更日志（JSON Lines）。
+    每次变更只追加一行，快照压缩由 MemoryTree 负责；
+    压缩时先把当前日志轮转为 .compacting，快照落盘后再删除。
+    """
+
+    def __init__(self, path: str, compact_every: int = 1000,
+                 compact_bytes: int = 4 * 1024 * 1024, fsync: bool = False):
+        self.path = path
+        self.rotated_path = path + ".compacting"
+        self.compact_every = compact_every
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._entries = 0
+        self._bytes = 0
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._bytes = self._file.tell()
+
+    def append(self, record: Dict[str, Any]) -> bool:
+        """追加一条记录，返回是否达到压缩阈值"""
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._open()
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._entries += 1
+            self._bytes += len(line.encode("utf-8"))
+            return self._entries >= self.compact_every or self._bytes >= self.compact_bytes
+
+    def rotate(self):
+        """将当前日志轮转到 .compacting，后续追加写入新的空日志"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                if os.path.exists(self.rotated_path):
+                    # 上一次压缩未完成：合并到同一个轮转文件，保持顺序
+                    with open(self.path, "r", encoding="utf-8") as src, \
+                            open(self.rotated_path, "a", encoding="utf-8") as dst:
+                        dst.write(src.read())
+                    os.remove(self.path)
+                else:
+                    os.replace(self.path, self.rotated_path)
+            self._entries = 0
+            self._bytes = 0
+
+    def discard_rotated(self):
+        """快照已覆盖轮转日志中的全部记录，可以删除"""
+        with self._lock:
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+
+    def has_rotated(self) -> bool:
+        return os.path.exists(self.rotated_path)
+
+    def replay(self) -> Iterator[Dict[str, Any]]:
+        """按写入顺序依次返回轮转日志与当前日志中的记录"""
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时最后一行可能只写了一半，直接跳过
+                        continue
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def atomic_write_json(path: str, data: Any, indent: int = 2):
+    """先写临时文件并 fsync，再 os.replace 覆盖，避免崩溃留下半个文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def node_records(nodes: List[Any]) -> Dict[str, Dict[str, Any]]:
+    """将节点列表转换为可序列化的 dict（不含 children，避免循环）"""
+    records = {}
+    for node in nodes:
+        node_dict = node.model_dump(exclude={"children"})
+        node_dict["children"] = {}
+        records[node.id] = node_dict
+    return records
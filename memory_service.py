@@ -0,0 +1,354 @@
+# memory_service.py
+"""
+多用户记忆服务：基于 asyncio 的 HTTP 接口，每个用户一棵独立的记忆树。
+
+用法：
+    python memory_service.py --port 8000 --data-dir users --base-url http://127.0.0.1:8001/v1
+
+接口（请求与响应均为 JSON）：
+    POST /users/{user_id}/chat     {"message": "..."}                 -> {"reply": "..."}
+    POST /users/{user_id}/store    {"content": "...", "parent_id"?}   -> {"result": "..."}
+    POST /users/{user_id}/recall   {"query": "..."}                   -> {"memory": "..."}
+    GET  /users/{user_id}/tree                                        -> 完整记忆树
+    GET  /health                                                      -> 加载情况与统计
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional, Tuple, Union
+
+import openai
+
+from chat_agent import AsyncChatAgent
+from llm_dispatcher import LLMDispatcher
+from memory_tree import MemoryTree
+
+_USER_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_ROUTE_RE = re.compile(r"^/users/([^/]+)/(chat|store|recall|tree)$")
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class ServiceError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Tenant:
+    """一个已加载的用户：记忆树 + 对话代理 + 串行化该用户请求的锁"""
+
+    def __init__(self, user_id: str, tree: MemoryTree, agent: AsyncChatAgent):
+        self.user_id = user_id
+        self.tree = tree
+        self.agent = agent
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.agent.flush()
+        self.agent.context.flush()
+        self.tree.close()
+
+
+class TenantManager:
+    """
+    按用户加载记忆树，最多同时保留 max_loaded 个（LRU），
+    空闲超过 idle_ttl 秒的用户由后台任务卸载（写回磁盘后释放内存）。
+    同一用户的请求由各自的 asyncio.Lock 串行执行，不同用户之间互不阻塞；
+    所有用户共享同一个 LLM 调度器：同一组 OpenAI 客户端（连接池）、令牌桶与并发上限，
+    上游限流按整个服务计算而不是按用户。
+    """
+
+    def __init__(self, data_dir: str, schema_path: str = "schema.json",
+                 model: str = "qwen3", base_url: Optional[str] = None,
+                 api_key: Optional[str] = None, max_loaded: int = 64,
+                 idle_ttl: float = 600.0, storage: str = "json",
+                 client: Optional[openai.OpenAI] = None,
+                 async_client: Optional[openai.AsyncOpenAI] = None,
+                 dispatcher: Optional[LLMDispatcher] = None,
+                 llm_rate: Optional[float] = None, llm_concurrency: int = 16,
+                 **agent_options):
+        self.data_dir = data_dir
+        self.schema_path = schema_path
+        self.model = model
+        self.max_loaded = max_loaded
+        self.idle_ttl = idle_ttl
+        self.storage = storage
+        self.dispatcher = dispatcher or LLMDispatcher(
+            base_url, api_key, rate=llm_rate, max_concurrency=llm_concurrency,
+            client=client, async_client=async_client)
+        self.client = self.dispatcher.client
+        self.agent_options = agent_options
+        self._tenants: "OrderedDict[str, Tenant]" = OrderedDict()
+        # 每个用户一把锁；锁对象很小，卸载用户时保留，避免等待者与新请求拿到不同的锁
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.stats = {"loads": 0, "evictions": 0, "requests": 0}
+        os.makedirs(data_dir, exist_ok=True)
+
+    def _load(self, user_id: str) -> Tenant:
+        """在线程池中执行：读盘构建记忆树"""
+        user_dir = os.path.join(self.data_dir, user_id)
+        os.makedirs(user_dir, exist_ok=True)
+        tree = MemoryTree(self.schema_path, os.path.join(user_dir, "memory_tree.json"),
+                          storage=self.storage)
+        agent = AsyncChatAgent(tree, model=self.model, dispatcher=self.dispatcher,
+                               **self.agent_options)
+        return Tenant(user_id, tree, agent)
+
+    @asynccontextmanager
+    async def acquire(self, user_id: str):
+        """持有该用户的锁并返回已加载的 Tenant；退出后按容量淘汰最久未用的用户"""
+        if not _USER_ID_RE.match(user_id):
+            raise ServiceError(400, "非法的用户 id")
+        self.stats["requests"] += 1
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            tenant = self._tenants.get(user_id)
+            if tenant is None:
+                tenant = await asyncio.to_thread(self._load, user_id)
+                self._tenants[user_id] = tenant
+                self.stats["loads"] += 1
+            self._tenants.move_to_end(user_id)
+            # 上一次请求在后台提交的记忆写入先完成
+            await tenant.agent.aflush()
+            try:
+                yield tenant
+            finally:
+                tenant.last_used = time.monotonic()
+        await self._evict(lambda index, tenant: index < len(self._tenants) - self.max_loaded)
+
+    async def _evict(self, should_evict):
+        """按 LRU 顺序卸载满足条件且当前没有请求在处理的用户"""
+        victims = [tenant for index, tenant in enumerate(list(self._tenants.values()))
+                   if should_evict(index, tenant) and not self._locks[tenant.user_id].locked()]
+        for tenant in victims:
+            async with self._locks[tenant.user_id]:
+                if self._tenants.get(tenant.user_id) is not tenant:
+                    continue
+                await tenant.agent.aflush()
+                del self._tenants[tenant.user_id]
+                await asyncio.to_thread(tenant.close)
+                self.stats["evictions"] += 1
+
+    async def _sweep(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            deadline = time.monotonic() - self.idle_ttl
+            await self._evict(lambda index, tenant: tenant.last_used < deadline)
+
+    def start(self):
+        """启动空闲卸载任务（需在事件循环中调用）"""
+        if self._sweeper is None:
+            interval = max(1.0, min(self.idle_ttl / 2, 30.0))
+            self._sweeper = asyncio.create_task(self._sweep(interval))
+
+    async def close(self):
+        """停止后台任务并卸载全部用户"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        await self._evict(lambda index, tenant: True)
+
+    @property
+    def loaded(self) -> int:
+        return len(self._tenants)
+
+    @property
+    def async_client(self) -> openai.AsyncOpenAI:
+        return self.dispatcher.async_client
+
+
+class MemoryService:
+    """极简 HTTP/1.1 服务（支持 keep-alive），把请求路由到 TenantManager"""
+
+    def __init__(self, manager: TenantManager):
+        self.manager = manager
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000) -> Tuple[str, int]:
+        self.manager.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.manager.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, data = await self._dispatch(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self._write_response(writer, status, data, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        # 请求体长度不可信时无法找到下一个请求的起点：回复错误后关闭连接
+        length = headers.get("content-length") or "0"
+        if not (length.isascii() and length.isdigit()):
+            return method, target, {"connection": "close"}, ServiceError(400, "Content-Length 不合法")
+        length = int(length)
+        if length > MAX_BODY_BYTES:
+            return method, target, {"connection": "close"}, ServiceError(413, "请求体过大")
+        body = await reader.readexactly(length) if length else b""
+        return method, target.split("?", 1)[0], headers, body
+
+    async def _dispatch(self, method: str, path: str,
+                        body: Union[bytes, ServiceError]) -> Tuple[int, Any]:
+        try:
+            if isinstance(body, ServiceError):
+                raise body  # 读取请求时已发现的错误
+            return 200, await self._route(method, path, body)
+        except ServiceError as e:
+            return e.status, {"error": str(e)}
+        except Exception as e:
+            return 500, {"error": f"内部错误：{e}"}
+
+    async def _route(self, method: str, path: str, body: bytes) -> Any:
+        if path == "/health":
+            return {"loaded": self.manager.loaded, "max_loaded": self.manager.max_loaded,
+                    "stats": self.manager.stats, "llm": self.manager.dispatcher.stats}
+        match = _ROUTE_RE.match(path)
+        if match is None:
+            raise ServiceError(404, "接口不存在")
+        user_id, action = match.groups()
+        expected = "GET" if action == "tree" else "POST"
+        if method != expected:
+            raise ServiceError(405, f"{path} 只支持 {expected}")
+        payload = self._parse_json(body) if expected == "POST" else {}
+
+        async with self.manager.acquire(user_id) as tenant:
+            if action == "chat":
+                reply = await tenant.agent.achat(self._field(payload, "message"))
+                return {"reply": reply}
+            if action == "store":
+                content = self._field(payload, "content")
+                parent_id = payload.get("parent_id")
+                if parent_id:
+                    if parent_id not in tenant.tree.nodes:
+                        raise ServiceError(404, f"父节点 {parent_id} 不存在")
+                    node_id = await asyncio.to_thread(tenant.tree.add_memory, content, parent_id)
+                    return {"result": "记忆已存", "node_id": node_id}
+                memory = tenant.agent.memory_agent
+                return {"result": await memory.aclassify_and_store(content)}
+            if action == "recall":
+                query = self._field(payload, "query")
+                return {"memory": await tenant.agent.memory_agent.asearch_memory(query)}
+            # 全树序列化是 O(树) 的，懒加载模式下还要读盘加载全部分片，放到线程池
+            return await asyncio.to_thread(tenant.tree.get_full_tree)
+
+    @staticmethod
+    def _parse_json(body: bytes) -> Dict[str, Any]:
+        try:
+            payload = json.loads(body.decode("utf-8") or "{}")
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise ServiceError(400, "请求体不是合法的 JSON")
+        if not isinstance(payload, dict):
+            raise ServiceError(400, "请求体必须是 JSON 对象")
+        return payload
+
+    @staticmethod
+    def _field(payload: Dict[str, Any], name: str) -> str:
+        value = payload.get(name)
+        if not isinstance(value, str) or not value.strip():
+            raise ServiceError(400, f"缺少字段 {name}")
+        return value.strip()
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: int, data: Any, keep_alive: bool):
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                   413: "Payload Too Large", 500: "Internal Server Error"}
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {reasons.get(status, 'Error')}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+
+
+async def _serve(args):
+    manager = TenantManager(
+        args.data_dir, schema_path=args.schema, model=args.model, base_url=args.base_url,
+        api_key=args.api_key, max_loaded=args.max_loaded, idle_ttl=args.idle_ttl,
+        storage=args.storage, llm_rate=args.llm_rate, llm_concurrency=args.llm_concurrency,
+        fused=args.fused, prompt_layout=args.prompt_layout, catalog=args.catalog,
+        catalog_top_n=args.catalog_top_n
+    )
+    service = MemoryService(manager)
+    host, port = await service.start(args.host, args.port)
+    print(f"MemGrove 服务已启动：http://{host}:{port}")
+    try:
+        await service.serve_forever()
+    finally:
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--data-dir", default="users", help="每个用户一个子目录")
+    parser.add_argument("--schema", default="schema.json")
+    parser.add_argument("--storage", default="json", choices=("json", "journal", "sqlite", "sharded"))
+    parser.add_argument("--model", default="qwen3-max")
+    parser.add_argument("--base-url", default="https://dashscope.aliyuncs.com/compatible-mode/v1")
+    parser.add_argument("--api-key", default=os.getenv("DASHSCOPE_API_KEY") or os.getenv("OPENAI_API_KEY"))
+    parser.add_argument("--max-loaded", type=int, default=64, help="同时驻留内存的用户数上限")
+    parser.add_argument("--idle-ttl", type=float, default=600.0, help="空闲多少秒后卸载用户")
+    parser.add_argument("--llm-rate", type=float, default=None, help="上游 LLM 每秒请求数上限（默认不限）")
+    parser.add_argument("--llm-concurrency", type=int, default=16, help="同时在途的上游 LLM 请求数上限")
+    parser.add_argument("--fused", action="store_true", help="合并“是否记忆”与分类为一次调用")
+    parser.add_argument("--prompt-layout", default="default", choices=("default", "prefix"),
+                        help="prefix：静态内容在前、本轮输入在后，便于本地推理服务复用前缀缓存")
+    parser.add_argument("--catalog", default="json", choices=("json", "compact"),
+                        help="compact：分类以缩进的 \"编号 分类名\" 目录交给 LLM，提示更短")
+    parser.add_argument("--catalog-top-n", type=int, default=None,
+                        help="分类数超过该值时先在本地裁剪到最可能的 N 个")
+    args = parser.parse_args()
+    if not args.api_key:
+        raise ValueError("请设置 DASHSCOPE_API_KEY（或 OPENAI_API_KEY）环境变量，或传入 --api-key")
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,588 @@
+# memory_storage.py
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from memory_journal import MemoryJournal, atomic_write_json, node_records
+
+
+class MemoryStorage:
+    """
+    MemoryTree 的存储后端接口。
+    - load(): 返回全部节点记录（dict，不含 children）
+    - put(node): 持久化单个节点的新增/变更
+    - delete(node_ids): 持久化节点删除（去重合并时使用）
+    - touch(nodes): 持久化访问统计（access_count / last_accessed）的变化
+    - save_all(): 全量写入当前内存状态
+    - batch(): 批量写入，退出时统一提交
+    支持查询下推的后端（如 SQLite）将 supports_queries 设为 True。
+    """
+
+    supports_queries = False
+
+    def attach(self, tree):
+        self.tree = tree
+
+    def exists(self) -> bool:
+        raise NotImplementedError
+
+    def load(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def on_loaded(self):
+        """记忆树根据 load() 的结果重建完成后调用"""
+
+    def put(self, node):
+        raise NotImplementedError
+
+    def delete(self, node_ids: List[str]):
+        self.save_all()
+
+    def touch(self, nodes: List[Any]):
+        with self.batch():
+            for node in nodes:
+                self.put(node)
+
+    def save_all(self):
+        raise NotImplementedError
+
+    def compact(self, background: bool = True):
+        self.save_all()
+
+    @contextmanager
+    def batch(self):
+        yield
+
+    def close(self):
+        pass
+
+
+class JsonStorage(MemoryStorage):
+    """单个 JSON 文件，每次变更整体重写（批量模式下只在结束时写一次）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._batch_depth = 0
+        self._dirty = False
+        self._touched = False
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _read_snapshot(self) -> Dict[str, Any]:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def load(self) -> List[Dict[str, Any]]:
+        return list(self._read_snapshot()["nodes"].values())
+
+    def _write_snapshot(self, nodes: List[Any], seq: int = 0):
+        data = {
+            "nodes": node_records(nodes),
+            "root_id": "root",
+            "seq": seq
+        }
+        atomic_write_json(self.path, data)
+
+    def save_all(self):
+        self._touched = False
+        self._write_snapshot(list(self.tree.nodes.values()))
+
+    def put(self, node):
+        if self._batch_depth:
+            self._dirty = True
+        else:
+            self.save_all()
+
+    def delete(self, node_ids: List[str]):
+        if self._batch_depth:
+            self._dirty = True
+        else:
+            self.save_all()
+
+    def touch(self, nodes: List[Any]):
+        # 访问统计不值得为它重写整个文件：随下一次写入或 close() 落盘
+        self._touched = True
+
+    def close(self):
+        if self._touched:
+            self.save_all()
+
+    @contextmanager
+    def batch(self):
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._dirty:
+                self._dirty = False
+                self.save_all()
+
+
+class JournalStorage(JsonStorage):
+    """
+    JSON 快照 + 追加式日志：每次变更只追加一行，
+    达到阈值后在后台线程写新快照并清理已覆盖的日志。
+    """
+
+    def __init__(self, path: str, compact_every: int = 1000,
+                 compact_bytes: int = 4 * 1024 * 1024):
+        super().__init__(path)
+        self.journal = MemoryJournal(path + ".journal", compact_every, compact_bytes)
+        self._seq = 0  # 已持久化的变更序号
+        self._needs_compact = False
+        self._compact_lock = threading.Lock()
+        self._compact_thread: Optional[threading.Thread] = None
+
+    def load(self) -> List[Dict[str, Any]]:
+        data = self._read_snapshot()
+        records = data["nodes"]
+        self._seq = data.get("seq", 0)
+        self._needs_compact = self.journal.has_rotated()
+        for record in self.journal.replay():
+            # 快照已包含的记录直接跳过
+            if record.get("seq", 0) <= self._seq:
+                continue
+            if record.get("op") == "put":
+                records[record["node"]["id"]] = record["node"]
+            elif record.get("op") == "delete":
+                records.pop(record["id"], None)
+            self._seq = record["seq"]
+        return list(records.values())
+
+    def on_loaded(self):
+        # 上次压缩中途退出：立即补做一次，清理遗留的轮转日志
+        if self._needs_compact:
+            self._needs_compact = False
+            self.compact(background=False)
+
+    def save_all(self):
+        # 全量写入即一次同步压缩（同时清理可能遗留的旧日志）
+        self.compact(background=False)
+
+    def put(self, node):
+        self._seq += 1
+        record = {"seq": self._seq, "op": "put", "node": node_records([node])[node.id]}
+        if self.journal.append(record):
+            self.compact(background=True)
+
+    def touch(self, nodes: List[Any]):
+        MemoryStorage.touch(self, nodes)
+
+    def delete(self, node_ids: List[str]):
+        compact = False
+        for node_id in node_ids:
+            self._seq += 1
+            compact = self.journal.append({"seq": self._seq, "op": "delete", "id": node_id}) or compact
+        if compact:
+            self.compact(background=True)
+
+    @contextmanager
+    def batch(self):
+        yield
+
+    def compact(self, background: bool = True):
+        """
+        将当前内存状态写为新快照并清理已覆盖的日志。
+        后台压缩进行中时再次触发会被忽略。
+        """
+        if not self._compact_lock.acquire(blocking=not background):
+            return
+        # 在调用线程中截取节点列表与序号，之后的变更会写入新日志
+        nodes = list(self.tree.nodes.values())
+        seq = self._seq
+        self.journal.rotate()
+
+        def run():
+            try:
+                self._write_snapshot(nodes, seq)
+                self.journal.discard_rotated()
+            finally:
+                self._compact_lock.release()
+
+        if background:
+            self._compact_thread = threading.Thread(target=run, daemon=True)
+            self._compact_thread.start()
+        else:
+            run()
+
+    def close(self):
+        """等待后台压缩结束并关闭日志文件"""
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+            self._compact_thread = None
+        self.journal.close()
+
+
+class ShardedStorage(MemoryStorage):
+    """
+    按顶层分类分片的存储，配合 MemoryTree 的懒加载：
+    - <dir>/index.json：全部分类节点、挂在根下的记忆，以及各分片的记忆数与内容摘要
+    - <dir>/<分片>.jsonl：一个顶层分类下的全部记忆，变更逐行追加
+    启动时只读 index.json（大小与分类数有关，与记忆数无关），
+    某个顶层分类的记忆在第一次被访问时才由 load_shard() 读取。
+    """
+
+    lazy = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = os.path.join(path, "index.json")
+        self.tree = None
+        self.shard_meta: Dict[str, Dict[str, int]] = {}
+        self._files: Dict[str, Any] = {}
+        self._batch_depth = 0
+        self._dirty = False
+
+    def exists(self) -> bool:
+        return os.path.exists(self.index_path)
+
+    def shard_path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.path, f"{name}.jsonl")
+
+    def load(self) -> List[Dict[str, Any]]:
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.shard_meta = data.get("shards", {})
+        return list(data["nodes"].values())
+
+    def load_shard(self, key: str) -> List[Dict[str, Any]]:
+        """按写入顺序重放一个分片，返回其中现存的记忆记录"""
+        records: Dict[str, Dict[str, Any]] = {}
+        path = self.shard_path(key)
+        if key in self._files:
+            self._files[key].flush()
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 崩溃时最后一行可能只写了一半
+                if record.get("op") == "put":
+                    records[record["node"]["id"]] = record["node"]
+                elif record.get("op") == "delete":
+                    records.pop(record["id"], None)
+        return list(records.values())
+
+    def _append(self, key: str, record: Dict[str, Any]):
+        f = self._files.get(key)
+        if f is None:
+            f = self._files[key] = open(self.shard_path(key), "a", encoding="utf-8")
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+
+    def _write_index(self):
+        if self._batch_depth:
+            self._dirty = True
+            return
+        nodes = [node for node in self.tree.nodes.values()
+                 if node.name != "记忆" or self.tree.shard_key(node.id) is None]
+        os.makedirs(self.path, exist_ok=True)
+        atomic_write_json(self.index_path, {"nodes": node_records(nodes), "root_id": "root",
+                                            "shards": self.tree.shard_summary()}, indent=None)
+
+    def put(self, node):
+        key = self.tree.shard_key(node.id) if node.name == "记忆" else None
+        if key is None:
+            self._write_index()
+        else:
+            self._append(key, {"op": "put", "node": node_records([node])[node.id]})
+
+    def delete(self, node_ids: List[str]):
+        for node_id in node_ids:
+            key = self.tree.shard_key(node_id)
+            if key is not None:
+                self._append(key, {"op": "delete", "id": node_id})
+        self._write_index()
+
+    def save_all(self):
+        """重写索引与所有已加载分片（去掉被覆盖的日志行）；未加载的分片保持不动"""
+        os.makedirs(self.path, exist_ok=True)
+        groups: Dict[str, List[Any]] = {key: [] for key in self.tree.loaded_shards()}
+        for node in self.tree.nodes.values():
+            if node.name == "记忆":
+                key = self.tree.shard_key(node.id)
+                if key in groups:
+                    groups[key].append(node)
+        for key, nodes in groups.items():
+            f = self._files.pop(key, None)
+            if f is not None:
+                f.close()
+            path = self.shard_path(key)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                for record in node_records(nodes).values():
+                    f.write(json.dumps({"op": "put", "node": record}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+        self._write_index()
+
+    @contextmanager
+    def batch(self):
+        # 记忆逐行追加本身就很便宜，批量模式只合并索引的重写
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._dirty:
+                self._dirty = False
+                self._write_index()
+
+    def close(self):
+        if self.tree is not None and self.exists():
+            self._write_index()  # 记下各分片最新的记忆数与摘要
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+_NODE_COLUMNS = ("id", "name", "content", "parent_id", "created_at", "last_accessed", "access_count")
+
+
+class SQLiteStorage(MemoryStorage):
+    """
+    SQLite 后端：
+    - nodes 表（parent_id 建索引），path 列保存分类路径，查询无需回溯父节点
+    - nodes_fts 为 FTS5 外部内容表（trigram 分词，支持中文子串与 BM25）
+    - WAL 模式；batch() 内的写入合并为一个事务
+    也可以不挂记忆树单独使用（MemoryTreeAgent 以路径为 id 存储）。
+    """
+
+    supports_queries = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tree = None
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS nodes (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                content TEXT NOT NULL DEFAULT '',
+                parent_id TEXT,
+                path TEXT NOT NULL DEFAULT '',
+                created_at REAL NOT NULL DEFAULT 0,
+                last_accessed REAL NOT NULL DEFAULT 0,
+                access_count INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_nodes_parent ON nodes(parent_id);
+            CREATE INDEX IF NOT EXISTS idx_nodes_name ON nodes(name);
+        """)
+        try:
+            self.db.executescript("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS nodes_fts USING fts5(
+                    name, content, content='nodes', content_rowid='rowid', tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS nodes_ai AFTER INSERT ON nodes BEGIN
+                    INSERT INTO nodes_fts(rowid, name, content) VALUES (new.rowid, new.name, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS nodes_ad AFTER DELETE ON nodes BEGIN
+                    INSERT INTO nodes_fts(nodes_fts, rowid, name, content)
+                    VALUES ('delete', old.rowid, old.name, old.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS nodes_au AFTER UPDATE OF name, content ON nodes BEGIN
+                    INSERT INTO nodes_fts(nodes_fts, rowid, name, content)
+                    VALUES ('delete', old.rowid, old.name, old.content);
+                    INSERT INTO nodes_fts(rowid, name, content) VALUES (new.rowid, new.name, new.content);
+                END;
+            """)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            # SQLite < 3.34 没有 trigram 分词器：退化为 LIKE 扫描
+            self.has_fts = False
+        self.db.commit()
+
+    # ---- 写入 ----
+
+    def exists(self) -> bool:
+        with self._lock:
+            return self.db.execute("SELECT 1 FROM nodes WHERE id = 'root'").fetchone() is not None
+
+    def upsert(self, record: Dict[str, Any]):
+        """写入一条节点记录（需包含 path）"""
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO nodes (id, name, content, parent_id, path, created_at, last_accessed, access_count) "
+                "VALUES (:id, :name, :content, :parent_id, :path, :created_at, :last_accessed, :access_count) "
+                "ON CONFLICT(id) DO UPDATE SET name = excluded.name, content = excluded.content, "
+                "parent_id = excluded.parent_id, path = excluded.path, "
+                "last_accessed = excluded.last_accessed, access_count = excluded.access_count",
+                {
+                    "content": "", "parent_id": None, "created_at": 0.0,
+                    "last_accessed": 0.0, "access_count": 0, **record,
+                },
+            )
+            if self._batch_depth == 0:
+                self.db.commit()
+
+    def _record(self, node) -> Dict[str, Any]:
+        record = {column: getattr(node, column) for column in _NODE_COLUMNS}
+        # 与扁平视图一致：路径只保留分类名
+        record["path"] = " -> ".join(
+            name for name in self.tree._paths.get(node.id, ()) if name != "记忆"
+        )
+        return record
+
+    def put(self, node):
+        self.upsert(self._record(node))
+
+    def delete(self, node_ids: List[str]):
+        node_ids = list(node_ids)
+        with self._lock:
+            for start in range(0, len(node_ids), 500):
+                chunk = node_ids[start:start + 500]
+                self.db.execute(f"DELETE FROM nodes WHERE id IN ({', '.join('?' for _ in chunk)})", chunk)
+            if self._batch_depth == 0:
+                self.db.commit()
+
+    def save_all(self):
+        with self.batch():
+            for node in self.tree.nodes.values():
+                self.upsert(self._record(node))
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield
+            except Exception:
+                if self._batch_depth == 1:
+                    self.db.rollback()
+                raise
+            finally:
+                self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.db.commit()
+
+    # ---- 读取 ----
+
+    def load(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(_NODE_COLUMNS)} FROM nodes ORDER BY rowid"
+            ).fetchall()
+        return [dict(zip(_NODE_COLUMNS, row)) for row in rows]
+
+    def get(self, node_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self.db.execute(
+                f"SELECT {', '.join(_NODE_COLUMNS)}, path FROM nodes WHERE id = ?", (node_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(_NODE_COLUMNS + ("path",), row))
+
+    def get_many(self, node_ids) -> Dict[str, Dict[str, Any]]:
+        node_ids = list(node_ids)
+        if not node_ids:
+            return {}
+        placeholders = ", ".join("?" for _ in node_ids)
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(_NODE_COLUMNS)}, path FROM nodes WHERE id IN ({placeholders})",
+                node_ids
+            ).fetchall()
+        return {row[0]: dict(zip(_NODE_COLUMNS + ("path",), row)) for row in rows}
+
+    def flat_memory_view(self) -> List[Dict[str, str]]:
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, path, content FROM nodes "
+                "WHERE name = '记忆' AND trim(content) != '' ORDER BY rowid"
+            ).fetchall()
+        return [{"node_id": node_id, "path": path or "未分类", "content": content.strip()}
+                for node_id, path, content in rows if content.strip()]
+
+    def memory_entries(self, node_ids) -> List[Dict[str, str]]:
+        node_ids = list(node_ids)
+        if not node_ids:
+            return []
+        placeholders = ", ".join("?" for _ in node_ids)
+        with self._lock:
+            rows = self.db.execute(
+                f"SELECT id, path, content FROM nodes WHERE id IN ({placeholders}) "
+                "AND name = '记忆' ORDER BY rowid", node_ids
+            ).fetchall()
+        return [{"node_id": node_id, "path": path or "未分类", "content": content.strip()}
+                for node_id, path, content in rows if content.strip()]
+
+    @staticmethod
+    def _trigram_query(text: str) -> str:
+        grams = []
+        for chunk in text.split():
+            grams.extend(chunk[i:i + 3] for i in range(len(chunk) - 2))
+        return " OR ".join('"' + g.replace('"', '""') + '"' for g in dict.fromkeys(grams))
+
+    def search(self, text: str, limit: int = 10) -> List[Tuple[str, float]]:
+        """
+        FTS5 BM25 相关性查询，返回 [(id, score)]，score 以最佳结果为 1 归一化。
+        查询过短无法构成 trigram 时退化为子串匹配。
+        """
+        query = self._trigram_query(text) if self.has_fts else ""
+        if not query:
+            return [(node_id, 1.0) for node_id in self.find_substring(text.strip(), limit)]
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT n.id, bm25(nodes_fts) FROM nodes_fts JOIN nodes n ON n.rowid = nodes_fts.rowid "
+                "WHERE nodes_fts MATCH ? ORDER BY bm25(nodes_fts) LIMIT ?", (query, limit)
+            ).fetchall()
+        if not rows:
+            return []
+        best = rows[0][1] or -1.0  # bm25() 越小越相关，且为负数
+        return [(node_id, rank / best) for node_id, rank in rows]
+
+    def find_substring(self, keyword: str, limit: Optional[int] = None) -> List[str]:
+        """name 或 content 中包含 keyword（忽略大小写）的节点 id，按相关度/写入顺序排列"""
+        limit_sql = " LIMIT ?" if limit is not None else ""
+        limit_args = (limit,) if limit is not None else ()
+        with self._lock:
+            if self.has_fts and len(keyword) >= 3:
+                phrase = '"' + keyword.replace('"', '""') + '"'
+                rows = self.db.execute(
+                    "SELECT n.id FROM nodes_fts JOIN nodes n ON n.rowid = nodes_fts.rowid "
+                    "WHERE nodes_fts MATCH ? ORDER BY bm25(nodes_fts)" + limit_sql,
+                    (phrase,) + limit_args
+                ).fetchall()
+            else:
+                keyword = keyword.lower()
+                rows = self.db.execute(
+                    "SELECT id FROM nodes WHERE instr(lower(name), ?) > 0 OR instr(lower(content), ?) > 0 "
+                    "ORDER BY rowid" + limit_sql,
+                    (keyword, keyword) + limit_args
+                ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self.db.commit()
+            self.db.close()
+
+
+def make_storage(storage, save_path: str, compact_every: int = 1000,
+                 compact_bytes: int = 4 * 1024 * 1024) -> MemoryStorage:
+    """把 MemoryTree 的 storage 参数（名称或后端实例）转换为后端实例"""
+    if isinstance(storage, MemoryStorage):
+        return storage
+    if storage == "json":
+        return JsonStorage(save_path)
+    if storage == "journal":
+        return JournalStorage(save_path, compact_every, compact_bytes)
+    if storage == "sqlite":
+        return SQLiteStorage(os.path.splitext(save_path)[0] + ".db")
+    if storage == "sharded":
+        return ShardedStorage(os.path.splitext(save_path)[0] + ".shards")
+    raise ValueError(f"不支持的存储模式: {storage}")
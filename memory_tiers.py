@@ -0,0 +1,86 @@
+# memory_tiers.py
+import hashlib
+import time
+from typing import Dict, List, Set
+
+_DAY = 86400.0
+
+
+class MemoryTiers:
+    """
+    按访问频率与最近访问时间把记忆分为 hot / warm / cold 三层，只影响检索顺序，从不删除记忆。
+    热度 frecency = (access_count + 1) * 0.5 ** (距上次访问的天数 / half_life_days)，
+    创建也算一次访问，新记忆从 warm 开始
+    - hot: 热度最高的 hot_size 条（且至少被访问过 hot_min_access 次），每轮直接注入，不经过 LLM
+    - warm: 其余热度不低于 warm_min_score 的记忆，检索时先只把这一层的候选交给 LLM
+    - cold: 其余记忆，warm 层没有命中时才检索
+    分层每隔 refresh_every 秒重算一次（需要遍历全部记忆）；
+    两次重算之间新写入的记忆不在任何已知分层中，按 warm 处理。
+    """
+
+    def __init__(self, tree, hot_size: int = 5, hot_min_access: int = 3,
+                 warm_min_score: float = 0.5, half_life_days: float = 30.0,
+                 refresh_every: float = 60.0):
+        self.tree = tree
+        self.hot_size = hot_size
+        self.hot_min_access = hot_min_access
+        self.warm_min_score = warm_min_score
+        self.half_life_days = half_life_days
+        self.refresh_every = refresh_every
+        self._hot: List[str] = []
+        self._cold: Set[str] = set()
+        self._digest = ""
+        self._computed_at = None
+
+    def frecency(self, node, now: float) -> float:
+        age_days = max(0.0, now - node.last_accessed) / _DAY
+        return (node.access_count + 1) * 0.5 ** (age_days / self.half_life_days)
+
+    def _refresh(self):
+        now = time.time()
+        if self._computed_at is not None and now - self._computed_at < self.refresh_every:
+            return
+        scored = []
+        with self.tree.lock.read():
+            for node in self.tree.nodes.values():
+                if node.name == "记忆" and node.content.strip():
+                    scored.append((self.frecency(node, now), node.access_count, node.id))
+        scored.sort(reverse=True)
+        hot = [node_id for score, count, node_id in scored
+               if count >= self.hot_min_access][:self.hot_size]
+        hot_set = set(hot)
+        self._cold = {node_id for score, _, node_id in scored
+                      if score < self.warm_min_score and node_id not in hot_set}
+        self._hot = hot
+        self._digest = hashlib.sha1(
+            ("\x00".join(hot) + "\x01" + "\x00".join(sorted(self._cold))).encode("utf-8")
+        ).hexdigest()
+        self._computed_at = now
+
+    def invalidate(self):
+        """下次使用时立即重算"""
+        self._computed_at = None
+
+    @property
+    def digest(self) -> str:
+        """当前分层的指纹，用作检索缓存键的一部分（分层变化后旧结果失效）"""
+        self._refresh()
+        return self._digest
+
+    def hot_entries(self) -> List[Dict[str, str]]:
+        self._refresh()
+        return self.tree.get_memory_entries(self._hot) if self._hot else []
+
+    def split(self, candidates: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+        """把候选记忆去掉 hot 层后分为 [warm, cold]，省略空组"""
+        self._refresh()
+        hot = set(self._hot)
+        warm = [e for e in candidates if e["node_id"] not in self._cold and e["node_id"] not in hot]
+        cold = [e for e in candidates if e["node_id"] in self._cold]
+        return [group for group in (warm, cold) if group]
+
+    def tier_of(self, node_id: str) -> str:
+        self._refresh()
+        if node_id in self._hot:
+            return "hot"
+        return "cold" if node_id in self._cold else "warm"
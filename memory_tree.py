@@ -1,10 +1,21 @@
 # memory_tree.py
+import hashlib
 import json
 import time
-import os
-from typing import Dict, Any, Optional, List
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import MappingProxyType
+from typing import Dict, Any, Optional, List, Callable, Tuple, Union
 from pydantic import BaseModel
 from datetime import datetime
+from memory_storage import MemoryStorage, make_storage
+from memory_journal import node_records
+from memory_dedup import MinHashLSH
+from conversation_context import count_tokens
+from text_index import InvertedIndex
+from rwlock import NullLock, RWLock
+from instrumentation import instruments
 
 class MemoryNode(BaseModel):
     id: str
@@ -20,18 +31,144 @@ class MemoryNode(BaseModel):
         self.last_accessed = time.time()
         self.access_count += 1
 
+    def add_child(self, child: "MemoryNode"):
+        self.children[child.id] = child
+
+    def remove_child(self, child_id: str):
+        self.children.pop(child_id, None)
+
+_NO_CHILDREN = MappingProxyType({})
+
+class CompactMemoryNode:
+    """
+    紧凑节点：__slots__ 存储、构造时不做校验，叶子节点不分配 children 字典，
+    重复出现的名称与父 id 字符串做驻留。接口与 MemoryNode 保持一致。
+    """
+    __slots__ = ("id", "name", "content", "parent_id", "_children",
+                 "created_at", "last_accessed", "access_count")
+
+    def __init__(self, id: str, name: str, content: str = "", parent_id: Optional[str] = None,
+                 created_at: float = 0.0, last_accessed: float = 0.0, access_count: int = 0,
+                 children: Optional[Dict[str, "CompactMemoryNode"]] = None):
+        self.id = id
+        self.name = sys.intern(name)
+        self.content = content
+        self.parent_id = sys.intern(parent_id) if parent_id is not None else None
+        self._children = dict(children) if children else None
+        self.created_at = created_at
+        self.last_accessed = last_accessed
+        self.access_count = access_count
+
+    @property
+    def children(self):
+        # 叶子节点返回共享的只读空映射，新增子节点请用 add_child
+        return self._children if self._children is not None else _NO_CHILDREN
+
+    def add_child(self, child: "CompactMemoryNode"):
+        if self._children is None:
+            self._children = {}
+        self._children[child.id] = child
+
+    def remove_child(self, child_id: str):
+        if self._children is not None:
+            self._children.pop(child_id, None)
+            if not self._children:
+                self._children = None
+
+    def touch(self):
+        self.last_accessed = time.time()
+        self.access_count += 1
+
+    def model_dump(self, exclude=None) -> Dict[str, Any]:
+        data = {
+            "id": self.id,
+            "name": self.name,
+            "content": self.content,
+            "parent_id": self.parent_id,
+            "children": {},
+            "created_at": self.created_at,
+            "last_accessed": self.last_accessed,
+            "access_count": self.access_count,
+        }
+        for key in exclude or ():
+            data.pop(key, None)
+        return data
+
 class MemoryTree:
-    def __init__(self, schema_path: str = "schema.json", save_path: str = "memory_tree.json"):
+    def __init__(self, schema_path: str = "schema.json", save_path: str = "memory_tree.json",
+                 storage: Union[str, MemoryStorage] = "json", compact_every: int = 1000,
+                 compact_bytes: int = 4 * 1024 * 1024, compact_nodes: bool = False,
+                 thread_safe: bool = False, dedup_threshold: Optional[float] = None,
+                 max_loaded_shards: Optional[int] = None):
+        """
+        storage: 存储后端名称或 MemoryStorage 实例
+        - "json": 每次变更整体重写 save_path（默认）
+        - "journal": 变更追加到 save_path + ".journal"，达到 compact_every 条
+          或 compact_bytes 字节后在后台线程压缩为新快照
+        - "sqlite": SQLite 数据库（save_path 换成 .db 后缀），
+          关键词匹配与扁平视图直接下推到数据库查询
+        - "sharded": 按顶层分类分片（save_path 换成 .shards 目录）并懒加载：
+          启动时只读分类索引，某个顶层分类下的记忆在第一次访问时才加载
+        compact_nodes: 使用 CompactMemoryNode 代替 pydantic 的 MemoryNode，
+          适合百万级节点的大树（见 benchmarks/bench_nodes.py）
+        thread_safe: 用读写锁保护树结构与视图，可在线程池中并发读写：
+          查询之间互不阻塞，写入独占；视图方法返回副本
+        dedup_threshold: 写入时去重的相似度阈值（字符二元组 Jaccard，如 0.8）。
+          同一分类下已有相似记忆时不新建节点，而是合并到已有记忆（访问次数 +1）；
+          None 表示不去重。离线合并已有的重复记忆见 consolidate()
+        max_loaded_shards: 懒加载模式下最多同时加载的分片数，超出时卸载最久未用的分片；
+          None 表示不限制（也可以调用 evict_idle() 按空闲时间卸载）。
+          pin_shards() 期间（如一次检索）暂不卸载，materialize_all() 加载的分片
+          在下一次访问分片时再按上限卸载
+        """
         self.save_path = save_path
+        self.thread_safe = thread_safe
+        self.dedup_threshold = dedup_threshold
+        if max_loaded_shards is not None and max_loaded_shards < 1:
+            raise ValueError("max_loaded_shards 至少为 1")
+        self.max_loaded_shards = max_loaded_shards
+        self.lock = RWLock() if thread_safe else NullLock()
+        self._last_id_stamp = 0  # 最近一次分配的记忆 id 时间戳（毫秒）
+        self.storage = make_storage(storage, save_path, compact_every, compact_bytes)
+        self.storage.attach(self)
+        # 后端支持查询时不在内存中物化扁平视图，由数据库回答
+        self._push_down = self.storage.supports_queries
+        # 懒加载：未加载分片（顶层分类 id）-> 其记忆数与摘要；已加载分片按最近使用排序
+        self._lazy = getattr(self.storage, "lazy", False)
+        self._unloaded: Dict[str, Dict[str, int]] = {}
+        self._shard_used: "OrderedDict[str, float]" = OrderedDict()
+        self._shard_nodes: Dict[str, List[str]] = {}  # 已加载分片 -> 其记忆节点 id，卸载时用
+        self._pins = 0  # 进行中的 pin_shards() 数
+        self._node_cls = CompactMemoryNode if compact_nodes else MemoryNode
         self.nodes: Dict[str, MemoryNode] = {}
-        
-        # 尝试从持久化文件加载
-        if os.path.exists(self.save_path):
+        self._listeners: List[Callable[["MemoryTree", MemoryNode], None]] = []
+        self._remove_listeners: List[Callable[["MemoryTree", MemoryNode], None]] = []
+        # 增量维护的物化视图：每次新增节点只追加，不再整树遍历
+        self.version = 0  # 每次节点变更 +1，消费者可据此判断缓存是否过期
+        # 内容摘要：与进程无关、重启后不变，可作为持久化缓存的键
+        self.memory_digest = 0    # 所有记忆 (id, 路径, 内容) 的异或哈希
+        self.category_digest = 0  # 所有分类 (id, 路径) 的异或哈希
+        self.memory_count = 0     # 有内容的记忆条数
+        self._paths: Dict[str, tuple] = {}  # node_id -> 从根开始的名称路径（不含 ROOT）
+        self._flat_view: List[Dict[str, str]] = []
+        self._flat_pos: Dict[str, int] = {}
+        self._flat_cache: Optional[tuple] = None  # 下推模式：(version, 扁平视图)
+        self._category_view: List[Dict[str, str]] = []
+        self.catalog_version = 0  # 分类视图按 DFS 重排（加载、consolidate）时 +1，紧凑目录编号随之改变
+        self._catalog_cache: Optional[tuple] = None  # (catalog_version, category_digest, 分类数, 紧凑目录)
+        self._text_index: Optional[InvertedIndex] = None  # 首次使用时构建，之后增量维护
+        self._dedup: Optional[MinHashLSH] = None  # 写入时去重的索引，同样懒构建
+        # 写入时去重合并的条数，以及因此少写的存储字节与检索提示 token（估算）
+        self.dedup_stats = {"merged_on_insert": 0, "bytes_saved": 0, "prompt_tokens_saved": 0}
+
+        # 尝试从持久化存储加载
+        if self.storage.exists():
             self._load_from_file()
         else:
             # 首次启动：从 schema 初始化
             self._load_initial_schema(schema_path)
             self._assign_ids(self.root, None)
+            self._rebuild_views()
             self.save_to_file()  # 保存初始结构
 
     def _load_initial_schema(self, path: str):
@@ -41,11 +178,11 @@ class MemoryTree:
         self.nodes["root"] = self.root
 
     def _dict_to_node(self, node_id: str, name: str, data: Dict) -> MemoryNode:
-        node = MemoryNode(id=node_id, name=name, created_at=time.time(), last_accessed=time.time())
+        node = self._node_cls(id=node_id, name=name, created_at=time.time(), last_accessed=time.time())
         for k, v in data.items():
             child_id = f"{node_id}:{k}"
             child = self._dict_to_node(child_id, k, v)
-            node.children[k] = child
+            node.add_child(child)
             self.nodes[child_id] = child
         return node
 
@@ -55,98 +192,380 @@ class MemoryTree:
         for child in node.children.values():
             self._assign_ids(child, node.id)
 
+    @instruments.traced("tree.load")
     def _load_from_file(self):
-        """从 JSON 文件加载记忆树"""
-        with open(self.save_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
+        """从存储后端加载记忆树（journal 模式下包括重放快照之后的日志）"""
         # 重建所有节点
         self.nodes = {}
-        for node_id, node_data in data["nodes"].items():
+        for node_data in self.storage.load():
             # 移除 children 字段（稍后重建）
-            children_data = node_data.pop("children", {})
-            node = MemoryNode(**node_data)
-            self.nodes[node_id] = node
+            node_data.pop("children", None)
+            node = self._node_cls(**node_data)
+            self.nodes[node.id] = node
         
         # 重建父子关系
-        for node_id, node_data in data["nodes"].items():
-            parent_id = self.nodes[node_id].parent_id
+        for node_id, node in self.nodes.items():
+            parent_id = node.parent_id
             if parent_id and parent_id in self.nodes:
-                self.nodes[parent_id].children[node_id] = self.nodes[node_id]
+                self.nodes[parent_id].add_child(node)
         
         self.root = self.nodes["root"]
+        if self._lazy:
+            # 索引里没有元数据的分片（如上次异常退出）同样视为未加载，访问时再校正计数
+            meta = self.storage.shard_meta
+            self._unloaded = {key: dict(meta.get(key, {"memories": 0, "digest": 0}))
+                              for key, node in self.root.children.items() if node.name != "记忆"}
+        self._rebuild_views()
+        self.storage.on_loaded()
+        self._report_size()
 
+    @instruments.traced("tree.save")
     def save_to_file(self):
-        """将记忆树保存到 JSON 文件"""
-        # 转换所有节点为 dict
-        nodes_dict = {}
-        for node_id, node in self.nodes.items():
-            node_dict = node.model_dump()
-            # 移除 children 引用，避免循环
-            node_dict["children"] = {}
-            nodes_dict[node_id] = node_dict
-        
-        data = {
-            "nodes": nodes_dict,
-            "root_id": "root"
+        """全量保存当前记忆树（JSON 后端：写临时文件后原子替换）"""
+        with self.lock.write():
+            self.storage.save_all()
+
+    def batch(self):
+        """批量写入：with tree.batch(): ... 期间的变更在退出时统一提交"""
+        return self.storage.batch()
+
+    @contextmanager
+    def transaction(self):
+        """
+        原子的多步写入（如先建分类再挂记忆）：期间独占写锁，
+        其他线程看不到中间状态；变更按批量写入在退出时统一提交。
+        """
+        with self.lock.write(), self.storage.batch():
+            yield self
+
+    @instruments.traced("tree.compact")
+    def compact(self, background: bool = True):
+        """写入新快照并清理已覆盖的日志（journal 后端），其他后端等同全量保存"""
+        with self.lock.write():
+            self.storage.compact(background)
+
+    def close(self):
+        """等待后台压缩结束并关闭存储"""
+        self.storage.close()
+
+    def _rebuild_views(self):
+        """加载后一次性构建路径缓存与扁平视图（按 DFS 顺序，保证父节点先于子节点）"""
+        self._paths = {}
+        self._flat_view = []
+        self._flat_pos = {}
+        self._category_view = []
+        self.catalog_version += 1
+        self._text_index = None
+        self._dedup = None
+        self.memory_digest = 0
+        self.category_digest = 0
+        self.memory_count = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            self._index_node(node)
+            stack.extend(reversed(list(node.children.values())))
+        # 未加载分片的记忆不在内存中，摘要与计数取自分片索引
+        for meta in self._unloaded.values():
+            self.memory_digest ^= meta["digest"]
+            self.memory_count += meta["memories"]
+
+    def _index_node(self, node: MemoryNode):
+        """把单个新节点加入路径缓存与物化视图，O(1)"""
+        if node.id == "root":
+            path = ()
+        else:
+            path = self._paths.get(node.parent_id, ()) + (node.name,)
+        self._paths[node.id] = path
+        if self._text_index is not None:
+            self._text_index.add(node.id, node.name + " " + node.content)
+        if node.name != "记忆":
+            # 只收录非“记忆”节点（即分类节点）
+            entry = {
+                "node_id": node.id,
+                "path": " -> ".join(path) if path else "ROOT"
+            }
+            self._category_view.append(entry)
+            self.category_digest ^= self._entry_hash(entry)
+        elif node.content.strip():
+            entry = self._memory_entry(node)
+            if not self._push_down:
+                self._flat_pos[node.id] = len(self._flat_view)
+                self._flat_view.append(entry)
+            self.memory_digest ^= self._entry_hash(entry)
+            self.memory_count += 1
+            if self._dedup is not None:
+                self._dedup.add(node.id, node.parent_id, node.content)
+        self.version += 1
+
+    def _memory_entry(self, node: MemoryNode) -> Dict[str, str]:
+        return {
+            "node_id": node.id,
+            "path": self._memory_path(self._paths.get(node.id, ())),
+            "content": node.content.strip()
         }
-        
-        with open(self.save_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
 
+    @staticmethod
+    def _entry_hash(entry: Dict[str, str]) -> int:
+        text = "\x00".join(entry.values())
+        return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+    @property
+    def text_index(self) -> InvertedIndex:
+        """
+        节点名称+内容的倒排索引；大树加载时不构建，第一次查询时才建立。
+        可能要加载分片、构建索引（需要写锁），不要在持有读锁时访问
+        """
+        if self._unloaded or self._text_index is None:
+            with self.lock.write():
+                self.materialize_all()
+                if self._text_index is None:
+                    index = InvertedIndex()
+                    for node in self.nodes.values():
+                        index.add(node.id, node.name + " " + node.content)
+                    self._text_index = index
+        return self._text_index
+
+    @property
+    def dedup_index(self) -> MinHashLSH:
+        """各分类内记忆的 MinHash/LSH 索引；首次写入时构建，之后增量维护"""
+        if self._dedup is None:
+            index = MinHashLSH(self.dedup_threshold or 0.8)
+            for node in self.nodes.values():
+                if node.name == "记忆" and node.content.strip():
+                    index.add(node.id, node.parent_id, node.content)
+            self._dedup = index
+        return self._dedup
+
+    def _node_content(self, node_id: str) -> Optional[str]:
+        node = self.nodes.get(node_id)
+        return node.content if node is not None else None
+
+    @staticmethod
+    def _memory_path(path: tuple) -> str:
+        # 跳过"记忆"本身，保留分类名
+        parts = [name for name in path if name != "记忆"]
+        return " -> ".join(parts) if parts else "未分类"
+
+    def _commit_node(self, node: MemoryNode):
+        """新节点挂到树上之后：更新视图、通知监听器、持久化"""
+        self._index_node(node)
+        for callback in self._listeners:
+            callback(self, node)
+        self._persist(node)
+        self._report_size()
+
+    def _report_size(self):
+        if instruments.enabled:
+            instruments.gauge("tree.nodes", len(self.nodes))
+            instruments.gauge("tree.memories", self.memory_count)
+
+    def add_listener(self, callback: Callable[["MemoryTree", MemoryNode], None],
+                     on_remove: Optional[Callable[["MemoryTree", MemoryNode], None]] = None):
+        """订阅节点新增（及可选的删除）事件（如本地检索索引），回调参数为 (tree, node)"""
+        self._listeners.append(callback)
+        if on_remove is not None:
+            self._remove_listeners.append(on_remove)
+
+    def _persist(self, node: MemoryNode):
+        """持久化一次节点变更"""
+        self.storage.put(node)
+
+    def _node_hits(self, index: Optional[InvertedIndex], text: str, db_limit: int) -> List[tuple]:
+        """
+        全部节点按 BM25 排序的 [(node_id, score)]；数据库后端（index 为 None）只取前 db_limit 个。
+        index 在取读锁之前准备好（见 text_index），调用方持有读锁
+        """
+        if index is None:
+            return self.storage.search(text, limit=db_limit)
+        return index.search(text)
+
+    @instruments.traced("tree.branch_scores")
+    def branch_scores(self, text: str, db_limit: int = 200) -> Dict[str, float]:
+        """
+        命中得分沿父链向上传播（取最大值）：
+        分类的得分 = 自身及其子树中最佳命中的得分，用于逐层下钻检索。
+        """
+        scores: Dict[str, float] = {}
+        # 固定分片：取到索引之后、读锁之内不会有分片被卸载
+        with self.pin_shards():
+            index = None if self._push_down else self.text_index
+            with self.lock.read():
+                for node_id, score in self._node_hits(index, text, db_limit):
+                    # 命中按得分降序，祖先已有更高分时更上层也一定有
+                    while node_id is not None and scores.get(node_id, 0.0) < score:
+                        scores[node_id] = score
+                        node = self.nodes.get(node_id)
+                        node_id = node.parent_id if node is not None else None
+        return scores
+
+    @instruments.traced("tree.find_best_node")
     def find_best_node(self, text: str) -> List[Dict[str, Any]]:
+        """基于倒排索引（或数据库全文索引）的 BM25 匹配，返回得分最高的 3 个节点"""
         candidates = []
-        def dfs(node: MemoryNode, path: List[str]):
-            if node.id == "root": 
-                path = []
-            score = self._simple_match_score(text, node.name + " " + node.content)
-            if score > 0.3:
-                candidates.append({
-                    "node_id": node.id,
-                    "path": " -> ".join(path + [node.name]),
-                    "score": score,
-                    "has_content": bool(node.content.strip())
-                })
-            for name, child in node.children.items():
-                dfs(child, path + [node.name])
-        dfs(self.root, [])
-        return sorted(candidates, key=lambda x: -x["score"])[:3]
-
-    def _simple_match_score(self, text: str, target: str) -> float:
-        text, target = text.lower(), target.lower()
-        if len(target) < 2: return 0
-        overlap = len(set(text.split()) & set(target.split()))
-        return overlap / max(len(text.split()), 1)
+        with self.pin_shards():
+            index = None if self._push_down else self.text_index
+            with self.lock.read():
+                for node_id, score in self._node_hits(index, text, 10):
+                    if node_id not in self.nodes:
+                        continue
+                    if score <= 0.3:
+                        break
+                    node = self.nodes[node_id]
+                    if len(node.name + " " + node.content) < 2:
+                        continue
+                    path = ("ROOT",) + self._paths[node_id] if node_id != "root" else ("ROOT",)
+                    candidates.append({
+                        "node_id": node_id,
+                        "path": " -> ".join(path),
+                        "score": score,
+                        "has_content": bool(node.content.strip())
+                    })
+                    if len(candidates) == 3:
+                        break
+        return candidates
+
+    def _new_memory_id(self, parent_id: str) -> str:
+        """
+        生成记忆 id：毫秒时间戳，但保证严格递增且不与已有节点重复
+        （同一毫秒内的多次写入不会互相覆盖）。调用方需持有写锁。
+        """
+        stamp = max(int(time.time() * 1000), self._last_id_stamp + 1)
+        while f"{parent_id}:mem{stamp}" in self.nodes:
+            stamp += 1
+        self._last_id_stamp = stamp
+        return f"{parent_id}:mem{stamp}"
 
+    @instruments.traced("tree.add_memory")
     def add_memory(self, content: str, parent_id: str) -> str:
-        if parent_id not in self.nodes:
-            return f"父节点 {parent_id} 不存在"
-        node_id = f"{parent_id}:mem{int(time.time()*1000)}"
-        node = MemoryNode(
-            id=node_id, name="记忆", content=content,
-            parent_id=parent_id, created_at=time.time(), last_accessed=time.time()
-        )
-        parent = self.nodes[parent_id]
-        parent.children[node_id] = node
-        self.nodes[node_id] = node
-        self.save_to_file()  # 持久化
-        return node_id
+        with self.lock.write():
+            if parent_id not in self.nodes:
+                return f"父节点 {parent_id} 不存在"
+            key = self.shard_key(parent_id) if self._lazy else None
+            self._use_shard(key)
+            if self.dedup_threshold is not None and content.strip():
+                duplicate = self.dedup_index.find(parent_id, content, self._node_content)
+                if duplicate is not None:
+                    return self._merge_on_insert(self.nodes[duplicate[0]])
+            node_id = self._new_memory_id(parent_id)
+            node = self._node_cls(
+                id=node_id, name="记忆", content=content,
+                parent_id=parent_id, created_at=time.time(), last_accessed=time.time()
+            )
+            parent = self.nodes[parent_id]
+            parent.add_child(node)
+            self.nodes[node_id] = node
+            if key is not None:
+                self._shard_nodes.setdefault(key, []).append(node_id)
+            self._commit_node(node)  # 更新视图并持久化
+            return node_id
+
+    def _merge_on_insert(self, existing: MemoryNode) -> str:
+        """重复陈述合并到已有记忆：保留原内容与创建时间，记一次访问"""
+        existing.touch()
+        self._persist(existing)
+        # 少写的节点与已有记忆几乎相同，用已有记忆估算节省量
+        size, tokens = self._memory_cost(existing)
+        self.dedup_stats["merged_on_insert"] += 1
+        self.dedup_stats["bytes_saved"] += size
+        self.dedup_stats["prompt_tokens_saved"] += tokens
+        return existing.id
+
+    def _memory_cost(self, node: MemoryNode) -> tuple:
+        """一条记忆占用的存储字节数（序列化记录）与检索提示中的 token 数"""
+        record = json.dumps(node_records([node])[node.id], ensure_ascii=False)
+        line = f"[{self.get_memory_path(node.id)}] {node.content.strip()}"
+        return len(record.encode("utf-8")), count_tokens(line)
+
+    @instruments.traced("tree.consolidate")
+    def consolidate(self, threshold: Optional[float] = None) -> Dict[str, int]:
+        """
+        离线去重：在每个分类内用 MinHash/LSH 找出相似度不低于 threshold 的记忆，
+        按创建时间保留最早的一条，其余合并进来后删除。
+        合并保留历史：访问次数相加，创建时间取最早，最近访问取最晚。
+        返回合并前后的记忆条数，以及回收的存储字节与检索提示 token 数。
+        """
+        threshold = threshold or self.dedup_threshold or 0.8
+        with self.lock.write():
+            self.materialize_all()
+            index = MinHashLSH(threshold)
+            memories = sorted((node for node in self.nodes.values()
+                               if node.name == "记忆" and node.content.strip()),
+                              key=lambda node: node.created_at)
+            report = {"memories_before": len(memories), "memories_after": len(memories),
+                      "clusters": 0, "merged": 0, "bytes_before": 0, "bytes_reclaimed": 0,
+                      "prompt_tokens_before": 0, "prompt_tokens_reclaimed": 0}
+            survivors: Dict[str, MemoryNode] = {}
+            duplicates: List[str] = []
+            for node in memories:
+                size, tokens = self._memory_cost(node)
+                report["bytes_before"] += size
+                report["prompt_tokens_before"] += tokens
+                match = index.find(node.parent_id, node.content, self._node_content)
+                if match is None:
+                    index.add(node.id, node.parent_id, node.content)
+                    continue
+                survivor = self.nodes[match[0]]
+                survivor.access_count += node.access_count
+                survivor.created_at = min(survivor.created_at, node.created_at)
+                survivor.last_accessed = max(survivor.last_accessed, node.last_accessed)
+                survivors[survivor.id] = survivor
+                duplicates.append(node.id)
+                report["bytes_reclaimed"] += size
+                report["prompt_tokens_reclaimed"] += tokens
+            if duplicates:
+                with self.storage.batch():
+                    self._remove_nodes(duplicates)
+                    for survivor in survivors.values():
+                        self._persist(survivor)
+                self._report_size()
+            report["clusters"] = len(survivors)
+            report["merged"] = len(duplicates)
+            report["memories_after"] = len(memories) - len(duplicates)
+        return report
+
+    def _remove_nodes(self, node_ids: List[str]):
+        """删除叶子节点并持久化，之后重建视图与摘要（文本索引等懒构建结构随之失效）"""
+        for node_id in node_ids:
+            node = self.nodes.pop(node_id)
+            parent = self.nodes.get(node.parent_id)
+            if parent is not None:
+                parent.remove_child(node_id)
+            for callback in self._remove_listeners:
+                callback(self, node)
+        self.storage.delete(node_ids)
+        self._rebuild_views()
 
+    @instruments.traced("tree.create_subcategory")
     def create_subcategory(self, parent_id: str, category_name: str) -> str:
-        if parent_id not in self.nodes:
-            return "父节点不存在"
-        child_id = f"{parent_id}:{category_name}"
-        if child_id in self.nodes:
-            return "分类已存在"
-        node = MemoryNode(id=child_id, name=category_name, parent_id=parent_id,
-                          created_at=time.time(), last_accessed=time.time())
-        self.nodes[parent_id].children[child_id] = node
-        self.nodes[child_id] = node
-        self.save_to_file()  # 持久化
-        return child_id
+        with self.lock.write():
+            if parent_id not in self.nodes:
+                return "父节点不存在"
+            child_id = f"{parent_id}:{category_name}"
+            if child_id in self.nodes:
+                return "分类已存在"
+            node = self._node_cls(id=child_id, name=category_name, parent_id=parent_id,
+                                  created_at=time.time(), last_accessed=time.time())
+            self.nodes[parent_id].add_child(node)
+            self.nodes[child_id] = node
+            self._commit_node(node)  # 更新视图并持久化
+            return child_id
+
+    def touch(self, node_ids) -> int:
+        """记录一次访问（检索命中等）并持久化访问统计，忽略不存在的 id，返回更新的节点数"""
+        with self.lock.write():
+            nodes = [self.nodes[node_id] for node_id in node_ids if node_id in self.nodes]
+            for node in nodes:
+                node.touch()
+            if nodes:
+                self.storage.touch(nodes)
+        return len(nodes)
 
     def get_full_tree(self) -> Dict:
-        return self._node_to_dict(self.root)
+        with self.pin_shards():
+            self.materialize_all()
+            with self.lock.read():
+                return self._node_to_dict(self.root)
 
     def _node_to_dict(self, node: MemoryNode) -> Dict:
         return {
@@ -163,43 +582,243 @@ class MemoryTree:
     def get_all_nodes_for_classification(self) -> List[Dict[str, str]]:
         """
         返回所有可用于挂载新记忆的分类节点（排除 name='记忆' 的叶子记忆节点）
+        返回的是增量维护的缓存列表，调用方不要修改（线程安全模式下返回副本）。
         """
-        candidates = []
-        def dfs(node: MemoryNode, path: List[str]):
-            if node.id == "root":
-                current_path = []
-            else:
-                current_path = path + [node.name]
-            # 只收录非“记忆”节点（即分类节点）
-            if node.name != "记忆":
-                candidates.append({
-                    "node_id": node.id,
-                    "path": " -> ".join(current_path) if current_path else "ROOT"
-                })
-            for child in node.children.values():
-                dfs(child, current_path)
-        dfs(self.root, [])
-        return candidates
+        with self.lock.read():
+            return list(self._category_view) if self.thread_safe else self._category_view
+
+    def get_category_catalog(self, node_ids=None) -> Tuple[str, List[str]]:
+        """
+        紧凑的分类目录，替代 JSON 形式的分类列表：每行 "编号 分类名"，
+        按层级缩进（每层两个空格），编号 0 为根。返回 (目录文本, 编号 -> node_id 列表)。
+        编号即分类在分类视图中的位置：新增分类只追加在末尾，但重新加载或 consolidate
+        会按 DFS 顺序重建视图（catalog_version +1），已有编号可能改变，
+        因此编号只能用随目录一起返回的列表解析。
+        node_ids 不为 None 时只列出这些分类及其祖先（编号不变），否则返回按
+        (catalog_version, category_digest) 缓存的完整目录。
+        """
+        with self.lock.read():
+            key = (self.catalog_version, self.category_digest, len(self._category_view))
+            if node_ids is None and self._catalog_cache is not None and self._catalog_cache[:3] == key:
+                return self._catalog_cache[3]
+            ids = [entry["node_id"] for entry in self._category_view]
+            by_path = {self._paths[node_id]: node_id for node_id in ids}
+            children: Dict[Optional[str], List[str]] = {}
+            for node_id in ids:
+                path = self._paths[node_id]
+                parent = by_path.get(path[:-1]) if path else None
+                children.setdefault(parent, []).append(node_id)
+            keep = None
+            if node_ids is not None:
+                keep = set()
+                for node_id in node_ids:
+                    path = self._paths.get(node_id)
+                    if path is None or path not in by_path:
+                        continue
+                    # 连同祖先一起列出，层级关系不丢失
+                    for depth in range(len(path) + 1):
+                        ancestor = by_path.get(path[:depth])
+                        if ancestor is not None:
+                            keep.add(ancestor)
+            number = {node_id: i for i, node_id in enumerate(ids)}
+            lines = []
+            stack = [(node_id, 0) for node_id in reversed(children.get(None, []))]
+            while stack:
+                node_id, depth = stack.pop()
+                if keep is None or node_id in keep:
+                    path = self._paths[node_id]
+                    lines.append(f"{'  ' * max(depth - 1, 0)}{number[node_id]} {path[-1] if path else 'ROOT'}")
+                stack.extend((child, depth + 1) for child in reversed(children.get(node_id, [])))
+            catalog = ("\n".join(lines), ids)
+            if node_ids is None:
+                self._catalog_cache = key + (catalog,)
+            return catalog
 
     def get_flat_memory_view(self) -> List[Dict[str, str]]:
         """
         返回扁平化的记忆视图，仅包含有内容的记忆节点。
-        格式：[{"path": "个人信息 -> 基本信息", "content": "张三"}, ...]
+        格式：[{"node_id": "...", "path": "个人信息 -> 基本信息", "content": "张三"}, ...]
+        返回的是增量维护的缓存列表（按写入顺序追加），调用方不要修改（线程安全模式下返回副本）。
+        懒加载模式下会先加载全部分片。
         """
-        flat_memories = []
+        with self.pin_shards():
+            self.materialize_all()
+            with self.lock.read():
+                if self._push_down:
+                    if self._flat_cache is None or self._flat_cache[0] != self.version:
+                        self._flat_cache = (self.version, self.storage.flat_memory_view())
+                    return self._flat_cache[1]
+                return list(self._flat_view) if self.thread_safe else self._flat_view
+
+    def get_memory_entries(self, node_ids) -> List[Dict[str, str]]:
+        """按扁平视图中的顺序返回指定记忆的条目，忽略不存在的 id"""
+        if self._push_down:
+            return self.storage.memory_entries(node_ids)
+        with self.lock.read():
+            positions = sorted(self._flat_pos[i] for i in node_ids if i in self._flat_pos)
+            return [self._flat_view[pos] for pos in positions]
+
+    def get_memory_path(self, node_id: str) -> str:
+        """记忆节点所在的分类路径，如：个人信息 -> 基本信息"""
+        return self._memory_path(self._paths.get(node_id, ()))
+
+    # ===== 懒加载（storage="sharded"）=====
+
+    def shard_key(self, node_id: str) -> Optional[str]:
+        """节点所在的分片，即其所属顶层分类的 id；根节点与直接挂在根下的记忆返回 None"""
+        for child_id, child in self.root.children.items():
+            if child.name != "记忆" and (node_id == child_id or node_id.startswith(child_id + ":")):
+                return child_id
+        return None
+
+    def loaded_shards(self) -> List[str]:
+        return [child_id for child_id, child in self.root.children.items()
+                if child.name != "记忆" and child_id not in self._unloaded]
+
+    def shard_summary(self) -> Dict[str, Dict[str, int]]:
+        """各分片的记忆数与内容摘要（异或哈希），由分片存储写入索引"""
+        summary = {key: dict(meta) for key, meta in self._unloaded.items()}
+        loaded = set(self.loaded_shards())
+        for key in loaded:
+            summary[key] = {"memories": 0, "digest": 0}
         for node in self.nodes.values():
             if node.name == "记忆" and node.content.strip():
-                # 构建完整路径
-                path_parts = []
-                current = node
-                while current and current.id != "root":
-                    if current.name != "记忆":  # 跳过"记忆"本身，保留分类名
-                        path_parts.append(current.name)
-                    current = self.nodes.get(current.parent_id)
-                path_parts.reverse()
-                full_path = " -> ".join(path_parts) if path_parts else "未分类"
-                flat_memories.append({
-                    "path": full_path,
-                    "content": node.content.strip()
-                })
-        return flat_memories
\ No newline at end of file
+                key = self.shard_key(node.id)
+                if key in loaded:
+                    summary[key]["memories"] += 1
+                    summary[key]["digest"] ^= self._entry_hash(self._memory_entry(node))
+        return summary
+
+    def materialize(self, node_id: str):
+        """懒加载模式下确保 node_id 所在的分片已加载；其他模式下什么也不做"""
+        if not self._lazy:
+            return
+        key = self.shard_key(node_id)
+        if key is None:
+            return
+        with self.lock.write():
+            self._use_shard(key)
+
+    def materialize_all(self):
+        """
+        加载全部分片（扁平视图、全文索引等需要看到所有记忆的操作会调用）。
+        这里不按 max_loaded_shards 卸载（调用方马上要用全部记忆），
+        超出上限的分片在下一次访问分片或 evict_idle() 时卸载。
+        """
+        if self._unloaded:
+            with self.lock.write():
+                now = time.monotonic()
+                for key in list(self._unloaded):
+                    self._load_shard(key)
+                    self._shard_used[key] = now
+                    self._shard_used.move_to_end(key)
+
+    @contextmanager
+    def pin_shards(self):
+        """
+        期间不卸载任何分片：检索先收集记忆 id、再取内容并记录访问，
+        中途卸载会让已收集的命中丢失。可嵌套；全部退出后再按上限卸载。
+        """
+        if not self._lazy:
+            yield self
+            return
+        with self.lock.write():
+            self._pins += 1
+        try:
+            yield self
+        finally:
+            with self.lock.write():
+                self._pins -= 1
+                self._enforce_shard_limit()
+
+    def _use_shard(self, key: Optional[str]):
+        """标记分片最近被使用，需要时加载，并按 max_loaded_shards 卸载最久未用的分片"""
+        if key is None:
+            return
+        self._load_shard(key)
+        self._shard_used[key] = time.monotonic()
+        self._shard_used.move_to_end(key)
+        self._enforce_shard_limit()
+
+    def _enforce_shard_limit(self):
+        if self.max_loaded_shards is None or self._pins:
+            return
+        for victim in list(self._shard_used)[:-self.max_loaded_shards]:
+            self._evict_shard(victim)
+
+    @instruments.traced("tree.load_shard")
+    def _load_shard(self, key: str):
+        meta = self._unloaded.pop(key, None)
+        if meta is None:
+            return
+        # 先去掉索引里的摘要，再由 _index_node 按实际内容加回
+        self.memory_digest ^= meta["digest"]
+        self.memory_count -= meta["memories"]
+        shard_nodes = self._shard_nodes.setdefault(key, [])
+        for record in self.storage.load_shard(key):
+            record.pop("children", None)
+            parent = self.nodes.get(record.get("parent_id"))
+            if parent is None or record["id"] in self.nodes:
+                continue
+            node = self._node_cls(**record)
+            parent.add_child(node)
+            self.nodes[node.id] = node
+            if node.name == "记忆":
+                shard_nodes.append(node.id)
+            self._index_node(node)
+            for callback in self._listeners:
+                callback(self, node)
+        self._report_size()
+
+    def _evict_shard(self, key: str):
+        """
+        卸载一个分片的记忆（变更已逐条写入分片文件，卸载不需要落盘）。
+        只处理该分片自己的记忆节点；全树的记忆摘要与计数不变（移到未加载分片的元数据中）。
+        """
+        summary = {"memories": 0, "digest": 0}
+        removed = set()
+        for node_id in self._shard_nodes.pop(key, []):
+            node = self.nodes.pop(node_id, None)
+            if node is None:
+                continue  # 已被合并删除
+            removed.add(node_id)
+            if node.content.strip():
+                summary["memories"] += 1
+                summary["digest"] ^= self._entry_hash(self._memory_entry(node))
+                if self._dedup is not None:
+                    self._dedup.remove(node_id, node.parent_id, node.content)
+            if self._text_index is not None:
+                self._text_index.remove(node_id)
+            self._paths.pop(node_id, None)
+            parent = self.nodes.get(node.parent_id)
+            if parent is not None:
+                parent.remove_child(node_id)
+            for callback in self._remove_listeners:
+                callback(self, node)
+        if removed and not self._push_down:
+            start = min((self._flat_pos[i] for i in removed if i in self._flat_pos),
+                        default=len(self._flat_view))
+            # 新列表而非原地修改：调用方手里的旧视图不受影响
+            self._flat_view = self._flat_view[:start] + [
+                entry for entry in self._flat_view[start:] if entry["node_id"] not in removed]
+            for pos in range(start, len(self._flat_view)):
+                self._flat_pos[self._flat_view[pos]["node_id"]] = pos
+            for node_id in removed:
+                self._flat_pos.pop(node_id, None)
+        self._shard_used.pop(key, None)
+        self._unloaded[key] = summary
+        self.version += 1
+        self._report_size()
+
+    def evict_idle(self, idle_seconds: float) -> int:
+        """卸载超过 idle_seconds 未被访问的分片，返回卸载的分片数"""
+        if not self._lazy:
+            return 0
+        with self.lock.write():
+            if self._pins:
+                return 0  # 有检索正在使用已加载的分片
+            cutoff = time.monotonic() - idle_seconds
+            victims = [key for key, used in self._shard_used.items() if used < cutoff]
+            for key in victims:
+                self._evict_shard(key)
+        return len(victims)
@@ -1,4 +1,7 @@
 # memory_tree_agent.py
+from typing import Optional
+from text_index import InvertedIndex
+from memory_storage import SQLiteStorage
 
 class MemoryNode:
     def __init__(self, key: str, value: str = "", parent=None):
@@ -31,18 +34,72 @@ class MemoryNode:
 
 
 class MemoryTreeAgent:
-    def __init__(self):
+    def __init__(self, db_path: Optional[str] = None):
+        """
+        db_path: 指定时记忆保存在 SQLite 中（以路径为 id），
+                 store/retrieve/recall 直接在数据库上执行，不在内存中建树
+        """
         self.root = MemoryNode(key="root")
+        # 路径 -> 节点，以及共享的倒排索引（文档 id 为路径）
+        self._nodes = {"/": self.root}
+        self.index = InvertedIndex()
+        self._index_node("/", self.root)
+        self.db: Optional[SQLiteStorage] = None
+        if db_path is not None:
+            self.db = SQLiteStorage(db_path)
+            if self.db.get("/") is None:
+                self.db.upsert({"id": "/", "name": "root", "path": "/"})
+
+    def _index_node(self, path: str, node: MemoryNode):
+        # key 与 value 用 \x00 隔开，子串匹配不会跨越两者
+        self.index.add(path, node.key + "\x00" + node.value)
+
+    def _rebuild_index(self):
+        self._nodes = {}
+        self.index = InvertedIndex()
+        stack = [("/", self.root)]
+        while stack:
+            path, node = stack.pop()
+            self._nodes[path] = node
+            self._index_node(path, node)
+            prefix = path.rstrip("/")
+            stack.extend((f"{prefix}/{k}", child) for k, child in node.children.items())
 
     def store(self, path: str, value: str):
         keys = [k for k in path.strip("/").split("/") if k]
+        if self.db is not None:
+            self._db_store(keys, value)
+            return
         current = self.root
+        current_path = ""
         for key in keys:
+            current_path += "/" + key
+            is_new = current.get_child(key) is None
             current = current.add_child(key)
+            if is_new:
+                self._nodes[current_path] = current
+                self._index_node(current_path, current)
         current.value = value
+        self._index_node(current_path or "/", current)
+
+    def _db_store(self, keys: list, value: str):
+        with self.db.batch():
+            parent, current_path = "/", ""
+            for key in keys[:-1]:
+                current_path += "/" + key
+                if self.db.get(current_path) is None:
+                    self.db.upsert({"id": current_path, "name": key,
+                                    "parent_id": parent, "path": current_path})
+                parent = current_path
+            path = current_path + "/" + keys[-1] if keys else "/"
+            self.db.upsert({"id": path, "name": keys[-1] if keys else "root", "content": value,
+                            "parent_id": parent if keys else None, "path": path})
 
     def retrieve(self, path: str) -> str:
         keys = [k for k in path.strip("/").split("/") if k]
+        if self.db is not None:
+            record = self.db.get("/" + "/".join(keys))
+            return record["content"] if record else ""
         current = self.root
         for key in keys:
             current = current.get_child(key)
@@ -51,21 +108,23 @@ class MemoryTreeAgent:
         return current.value
 
     def search_by_keyword(self, keyword: str) -> list:
-        results = []
-        stack = [self.root]
-        while stack:
-            node = stack.pop()
-            if keyword.lower() in node.value.lower() or keyword.lower() in node.key.lower():
-                # Reconstruct full path
-                path_parts = []
-                tmp = node
-                while tmp.parent:
-                    path_parts.append(tmp.key)
-                    tmp = tmp.parent
-                path = "/" + "/".join(reversed(path_parts))
-                results.append({"path": path, "value": node.value})
-            stack.extend(node.children.values())
-        return results
+        """
+        子串匹配 key 或 value（忽略大小写），通过倒排索引取候选，
+        结果按 BM25 相关度排序。
+        """
+        if self.db is not None:
+            # 下推到 FTS5：关键词不少于 3 个字时走 trigram 索引，否则在库内扫描
+            matched = self.db.find_substring(keyword)
+            records = self.db.get_many(matched)
+            return [{"path": p, "value": records[p]["content"]} for p in matched if p in records]
+        return [{"path": path, "value": self._nodes[path].value} for path in self._ranked_matches(keyword)]
+
+    def _ranked_matches(self, keyword: str) -> list:
+        matched = self.index.find_substring(keyword)
+        if not matched:
+            return []
+        scores = dict(self.index.search(keyword, doc_ids=matched))
+        return sorted(matched, key=lambda p: (-scores.get(p, 0.0), p))
 
     def recall(self, query_data: dict) -> list:
         """
@@ -91,13 +150,79 @@ class MemoryTreeAgent:
         else:
             raise ValueError(f"不支持的回忆类型: {recall_type}")
 
+    def recall_many(self, queries: list) -> list:
+        """
+        批量回忆：返回与 queries 一一对应的结果列表，每项与 recall 的返回值相同。
+        相同的路径或关键词只查一次；数据库模式下所有命中记录用一次 get_many 取回，
+        而不是每条查询各自读库。任一查询类型不支持时抛 ValueError，不执行任何查询。
+        """
+        for query_data in queries:
+            if query_data.get("type") not in ("exact", "keyword"):
+                raise ValueError(f"不支持的回忆类型: {query_data.get('type')}")
+        # 原始路径 -> 规范化后的节点 id；关键词 -> 按相关度排列的命中 id
+        paths = {}
+        keywords = {}
+        for query_data in queries:
+            if query_data["type"] == "exact":
+                path = query_data.get("path", "")
+                paths[path] = "/" + "/".join(k for k in path.strip("/").split("/") if k)
+            else:
+                keywords[query_data.get("keyword", "")] = None
+
+        find = self.db.find_substring if self.db is not None else self._ranked_matches
+        for keyword in keywords:
+            keywords[keyword] = find(keyword)
+        wanted = set(paths.values()).union(*keywords.values())
+        if self.db is not None:
+            values = {node_id: record["content"] for node_id, record in self.db.get_many(wanted).items()}
+        else:
+            values = {node_id: self._nodes[node_id].value for node_id in wanted if node_id in self._nodes}
+
+        results = []
+        for query_data in queries:
+            if query_data["type"] == "exact":
+                path = query_data.get("path", "")
+                value = values.get(paths[path])
+                results.append([{"path": path, "value": value}] if value else [])
+            else:
+                matched = keywords[query_data.get("keyword", "")]
+                results.append([{"path": p, "value": values[p]} for p in matched if p in values])
+        return results
+
     def save_to_file(self, filepath: str):
         import json
+        root = self._db_export() if self.db is not None else self.root
         with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(self.root.to_dict(), f, ensure_ascii=False, indent=2)
+            json.dump(root.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def _db_export(self) -> MemoryNode:
+        """从数据库重建内存树，用于导出 JSON"""
+        nodes = {}
+        for record in sorted(self.db.load(), key=lambda r: r["id"].count("/")):
+            parent = nodes.get(record["parent_id"])
+            if record["id"] == "/":
+                nodes["/"] = MemoryNode(key="root", value=record["content"])
+            elif parent is not None:
+                nodes[record["id"]] = parent.add_child(record["name"], record["content"])
+        return nodes.get("/", MemoryNode(key="root"))
 
     def load_from_file(self, filepath: str):
         import json
         with open(filepath, "r", encoding="utf-8") as f:
             data = json.load(f)
-        self.root = MemoryNode.from_dict(data)
\ No newline at end of file
+        self.root = MemoryNode.from_dict(data)
+        if self.db is not None:
+            self._db_import(self.root)
+            self.root = MemoryNode(key="root")
+            return
+        self._rebuild_index()
+
+    def _db_import(self, root: MemoryNode):
+        with self.db.batch():
+            stack = [("/", None, root)]
+            while stack:
+                path, parent, node = stack.pop()
+                self.db.upsert({"id": path, "name": node.key, "content": node.value,
+                                "parent_id": parent, "path": path})
+                prefix = path.rstrip("/")
+                stack.extend((f"{prefix}/{k}", path, child) for k, child in node.children.items())
\ No newline at end of file
@@ -0,0 +1,69 @@
+# migrate_to_sqlite.py
+"""
+把已有的 JSON 记忆存储迁移到 SQLite 后端（或按顶层分类分片的懒加载存储）。
+
+用法：
+    python migrate_to_sqlite.py memory_tree.json memory_tree.db
+    python migrate_to_sqlite.py memory_tree.json memory_tree.db --journal   # 含 .journal 日志
+    python migrate_to_sqlite.py kv_memory.json kv_memory.db --agent         # MemoryTreeAgent 导出文件
+    python migrate_to_sqlite.py memory_tree.json memory_tree.shards --sharded
+
+迁移后以 MemoryTree(storage="sqlite") 或 MemoryTree(storage=SQLiteStorage(...)) 打开；
+分片存储以 MemoryTree(storage="sharded") 打开。
+"""
+import argparse
+import os
+import sys
+import time
+
+
+def migrate_tree(src: str, dst: str, schema: str, journal: bool, sharded: bool = False) -> int:
+    from memory_tree import MemoryTree
+    from memory_storage import ShardedStorage, SQLiteStorage
+
+    tree = MemoryTree(schema, src, storage="journal" if journal else "json")
+    target = ShardedStorage(dst) if sharded else SQLiteStorage(dst)
+    target.attach(tree)
+    with target.batch():
+        target.save_all()
+    count = len(tree.nodes)
+    tree.close()
+    target.close()
+    return count
+
+
+def migrate_agent(src: str, dst: str) -> int:
+    from memory_tree_agent import MemoryTreeAgent
+
+    agent = MemoryTreeAgent(db_path=dst)
+    agent.load_from_file(src)
+    count = len(agent.db.load())
+    agent.db.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("src", help="源 JSON 文件")
+    parser.add_argument("dst", help="目标 SQLite 数据库（--sharded 时为分片目录）")
+    parser.add_argument("--schema", default="schema.json", help="记忆树 schema（源文件存在时不会用到）")
+    parser.add_argument("--journal", action="store_true", help="同时回放 src.journal 中的增量日志")
+    parser.add_argument("--agent", action="store_true", help="源文件是 MemoryTreeAgent.save_to_file 的导出")
+    parser.add_argument("--sharded", action="store_true", help="迁移到按顶层分类分片的懒加载存储")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.src):
+        sys.exit(f"源文件不存在：{args.src}")
+    if os.path.exists(args.dst):
+        sys.exit(f"目标已存在：{args.dst}")
+
+    start = time.perf_counter()
+    if args.agent:
+        count = migrate_agent(args.src, args.dst)
+    else:
+        count = migrate_tree(args.src, args.dst, args.schema, args.journal, args.sharded)
+    print(f"已迁移 {count} 个节点到 {args.dst}（{time.perf_counter() - start:.2f}s）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# rate_limit.py
+import asyncio
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    令牌桶限流：平均每秒补充 rate 个令牌，最多积攒 capacity 个（允许的突发量）。
+    采用预占方式：令牌不足时先记账为负数，再按欠额等待，先来的请求先获得令牌。
+    acquire/aacquire 返回实际等待的秒数，便于统计排队延迟。
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate 必须大于 0")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        wait = self._reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens: float = 1.0) -> float:
+        wait = self._reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
@@ -0,0 +1,82 @@
+# rwlock.py
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class RWLock:
+    """
+    读写锁：多个读者可以同时持有，写者独占。
+    - 写者优先：有写者在等待时新的读者排队，避免写者饿死
+    - 可重入：同一线程可以嵌套 read()/write()，持有写锁时也可以 read()
+    - 不支持升级：只持有读锁时调用 write() 会抛出 RuntimeError（否则会死锁）
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None        # 持有写锁的线程 id
+        self._write_depth = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        depth = getattr(self._local, "reads", 0)
+        if self._writer == me or depth:
+            # 已持有写锁或读锁：直接进入，不再排队（否则会被等待中的写者卡死）
+            self._local.reads = depth + 1
+            try:
+                yield
+            finally:
+                self._local.reads = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+            else:
+                if getattr(self._local, "reads", 0):
+                    raise RuntimeError("持有读锁时不能获取写锁")
+                self._waiting_writers += 1
+                try:
+                    while self._writer is not None or self._readers:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writers -= 1
+                self._writer = me
+                self._write_depth = 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._write_depth -= 1
+                if not self._write_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class NullLock:
+    """单线程模式下的空锁，接口与 RWLock 相同"""
+
+    def read(self):
+        return nullcontext()
+
+    def write(self):
+        return nullcontext()
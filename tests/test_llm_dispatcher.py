@@ -0,0 +1,36 @@
+# tests/test_llm_dispatcher.py
+"""用 benchmarks/fake_openai 假服务器测试 LLM 调度器：python -m pytest tests"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+import fake_openai  # noqa: E402
+from llm_dispatcher import LLMDispatcher  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server, url = fake_openai.start()
+    yield url
+    server.shutdown()
+
+
+def test_async_calls_across_event_loops(base_url):
+    """同一个调度器先后在两个 asyncio.run 中调用：第二个循环不能复用第一个循环的连接池"""
+    dispatcher = LLMDispatcher(base_url, "test")
+
+    async def ask(text):
+        return await asyncio.gather(*(
+            dispatcher.acomplete("m", [{"role": "user", "content": f"{text}{i}"}]) for i in range(3)))
+
+    for run in ("第一次", "第二次"):
+        responses = asyncio.run(ask(run))
+        assert all(r.choices[0].message.content for r in responses)
+    assert dispatcher.stats["calls"] == 6
+    assert dispatcher.stats["failures"] == 0
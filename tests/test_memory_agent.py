@@ -0,0 +1,26 @@
+# tests/test_memory_agent.py
+"""记忆代理的写入路径：python -m pytest tests"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from memory_agent import MemoryAgent  # noqa: E402
+from memory_tree import MemoryTree  # noqa: E402
+
+
+def test_merged_statement_counted_once(tmp_path):
+    """重复陈述去重合并到已有记忆时只记一次访问"""
+    tree = MemoryTree(os.path.join(ROOT_DIR, "schema.json"), str(tmp_path / "tree.json"),
+                      dedup_threshold=0.8)
+    agent = MemoryAgent(tree, "m", base_url="http://127.0.0.1:1/v1", api_key="test")
+    decision = {"action": "attach", "target_id": "root:兴趣爱好:运动", "new_category": None,
+                "summary": "喜欢打篮球和游泳"}
+    agent.apply_classification(dict(decision))
+    agent.apply_classification(dict(decision))
+
+    memories = [node for node in tree.nodes.values() if node.name == "记忆"]
+    assert len(memories) == 1
+    assert tree.dedup_stats["merged_on_insert"] == 1
+    assert memories[0].access_count == 2
@@ -0,0 +1,46 @@
+# tests/test_memory_service.py
+"""多用户记忆服务的 HTTP 解析：python -m pytest tests"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+import fake_openai  # noqa: E402
+from memory_service import MemoryService, TenantManager  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server, url = fake_openai.start()
+    yield url
+    server.shutdown()
+
+
+@pytest.mark.parametrize("length, status", [
+    ("abc", b"400"), ("-5", b"400"), ("1.5", b"400"), ("99999999999", b"413"),
+])
+def test_bad_content_length(base_url, tmp_path, length, status):
+    """非法或过大的 Content-Length 得到错误响应，而不是直接断开连接"""
+    async def request():
+        manager = TenantManager(str(tmp_path), schema_path=os.path.join(ROOT_DIR, "schema.json"),
+                                model="m", base_url=base_url, api_key="test")
+        service = MemoryService(manager)
+        host, port = await service.start("127.0.0.1", 0)
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f"POST /users/u1/recall HTTP/1.1\r\nContent-Length: {length}\r\n\r\n{{}}"
+                         .encode("latin-1"))
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), timeout=5)
+            writer.close()
+            return response
+        finally:
+            await service.close()
+
+    response = asyncio.run(request())
+    assert response.split(b" ", 2)[1] == status
@@ -0,0 +1,32 @@
+# tests/test_memory_tree.py
+"""记忆树的紧凑分类目录：python -m pytest tests"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from memory_tree import MemoryTree  # noqa: E402
+
+
+def _numbers(catalog):
+    """目录文本 -> {分类名: 编号}"""
+    pairs = (line.split(None, 1) for line in catalog.splitlines())
+    return {name: int(number) for number, name in pairs}
+
+
+def test_catalog_renumbered_after_rebuild(tmp_path):
+    """新分类先追加在末尾；重新加载后按 DFS 重建视图，编号改变"""
+    schema, save_path = os.path.join(ROOT_DIR, "schema.json"), str(tmp_path / "tree.json")
+    tree = MemoryTree(schema, save_path)
+    new_id = tree.create_subcategory("root:个人信息", "教育经历")
+    text, ids = tree.get_category_catalog()
+    before = _numbers(text)
+    assert before["教育经历"] == len(ids) - 1
+
+    text, ids = MemoryTree(schema, save_path).get_category_catalog()
+    after = _numbers(text)
+    assert after["教育经历"] != before["教育经历"]
+    # 编号只用随目录返回的列表解析
+    assert ids[after["教育经历"]] == new_id
+    assert ids[after["联系方式"]] == "root:个人信息:联系方式"
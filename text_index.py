@@ -0,0 +1,134 @@
+# text_index.py
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# 连续的字母数字视为一个词；中日韩文字没有空格，按单字 + 相邻双字切分
+_TOKEN_RE = re.compile(r"[0-9a-z]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+_ASCII_RE = re.compile(r"[0-9a-z]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    CJK 感知的分词：
+    "我住在Shanghai" -> ["我", "住", "在", "我住", "住在", "shanghai"]
+    """
+    tokens = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _ASCII_RE.fullmatch(run):
+            tokens.append(run)
+            continue
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _char_grams(text: str) -> Set[str]:
+    """子串匹配用的字符双字组"""
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class InvertedIndex:
+    """
+    倒排索引：token -> {doc_id: tf}，支持增量增删。
+    - search: BM25 排序的相关性查询，只遍历查询词的倒排表
+    - find_substring: 与原来 `keyword in text` 语义完全一致的子串查询，
+      先用双字组倒排表求交得到候选，再逐个校验
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._doc_len: Dict[str, int] = {}
+        self._total_len = 0
+        self._texts: Dict[str, str] = {}
+        self._grams: Dict[str, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._texts
+
+    def add(self, doc_id: str, text: str):
+        if doc_id in self._texts:
+            self.remove(doc_id)
+        text = text.lower()
+        self._texts[doc_id] = text
+        counts = Counter(tokenize(text))
+        for token, tf in counts.items():
+            self._postings.setdefault(token, {})[doc_id] = tf
+        length = sum(counts.values())
+        self._doc_len[doc_id] = length
+        self._total_len += length
+        for gram in _char_grams(text) | set(text):
+            self._grams.setdefault(gram, set()).add(doc_id)
+
+    def remove(self, doc_id: str):
+        text = self._texts.pop(doc_id, None)
+        if text is None:
+            return
+        for token in set(tokenize(text)):
+            posting = self._postings.get(token)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self._postings[token]
+        self._total_len -= self._doc_len.pop(doc_id, 0)
+        for gram in _char_grams(text) | set(text):
+            docs = self._grams.get(gram)
+            if docs is not None:
+                docs.discard(doc_id)
+                if not docs:
+                    del self._grams[gram]
+
+    def _idf(self, token: str) -> float:
+        df = len(self._postings.get(token, ()))
+        n = len(self._texts)
+        return math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, limit: Optional[int] = None,
+               doc_ids: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """
+        BM25 排序，返回 [(doc_id, score)]。
+        score 按查询词 idf 之和归一化到 [0, 1]，便于沿用固定阈值。
+        doc_ids 不为空时只对这些文档打分。
+        """
+        terms = set(tokenize(query))
+        if not terms or not self._texts:
+            return []
+        allowed = set(doc_ids) if doc_ids is not None else None
+        avg_len = self._total_len / len(self._texts) or 1.0
+        scores: Dict[str, float] = {}
+        max_score = 0.0
+        for token in terms:
+            idf = self._idf(token)
+            max_score += idf
+            for doc_id, tf in self._postings.get(token, {}).items():
+                if allowed is not None and doc_id not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self._doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        if max_score <= 0:
+            return []
+        ranked = sorted(((d, min(1.0, s / max_score)) for d, s in scores.items()),
+                        key=lambda x: -x[1])
+        return ranked[:limit] if limit is not None else ranked
+
+    def find_substring(self, keyword: str) -> Set[str]:
+        """返回文本中包含 keyword（忽略大小写）的全部文档"""
+        keyword = keyword.lower()
+        if not keyword:
+            return set(self._texts)
+        grams = _char_grams(keyword) if len(keyword) > 1 else {keyword}
+        postings = sorted((self._grams.get(g, set()) for g in grams), key=len)
+        if not postings[0]:
+            return set()
+        candidates = set(postings[0])
+        for docs in postings[1:]:
+            candidates &= docs
+            if not candidates:
+                return set()
+        return {d for d in candidates if keyword in self._texts[d]}